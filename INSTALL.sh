@@ -25,6 +25,14 @@ CFG_DIR=$BIN_DIR
 
 cp $SRC_DIR/__init__.py   $BIN_DIR/
 cp $SRC_DIR/sonarqube.py  $BIN_DIR/
+cp $SRC_DIR/client.py     $BIN_DIR/
+cp $SRC_DIR/archive.py    $BIN_DIR/
+cp $SRC_DIR/preflight.py  $BIN_DIR/
+cp $SRC_DIR/shards.py     $BIN_DIR/
+cp $SRC_DIR/sinks.py      $BIN_DIR/
+cp $SRC_DIR/state.py      $BIN_DIR/
+cp $SRC_DIR/watch.py      $BIN_DIR/
+cp $SRC_DIR/webhook.py    $BIN_DIR/
 echo "Binaries deployed to $BIN_DIR"
 
 CFG=sonarqube.cfg
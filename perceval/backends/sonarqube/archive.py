@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+"""Archive keys and body deduplication of the Sonarqube client."""
+
+import argparse
+import copy
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import urllib.parse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from ...archive import Archive
+from ...errors import ArchiveError
+
+logger = logging.getLogger(__name__)
+
+# Parameters holding comma-separated sets, whose order doesn't matter
+SET_PARAMETERS = ('metricKeys', 'metrics', 'additionalFields')
+
+# Headers left out of the archive keys, as they vary between runs,
+# but for the responses they make conditional (304 Not Modified)
+VOLATILE_HEADERS = ('If-None-Match',)
+
+# Header of the archived responses whose body is in a `BodyStore`
+BODY_HEADER = 'X-Sonar-Archived-Body'
+
+# Name of the body store shared by the archives of an archive manager
+BODY_STORE_FILE = 'sonarqube-bodies.sqlite3'
+
+# Directory and file names of the archives created by an archive manager
+MANAGED_ARCHIVE = re.compile(r'[0-9a-f]{2}/[0-9a-f]{30}\.sqlite3')
+
+# Seconds to wait for a store locked by another process
+BUSY_TIMEOUT = 30
+
+
+def fingerprint(url):
+    """Get the canonical form of a request URL.
+
+    The same logical request always gets the same fingerprint: the
+    parameters are sorted, the metric key sets are sorted and without
+    repetitions, and the first page is the one without page number.
+
+    :param url: URL of the request, including its query
+    :returns: the canonical URL
+    """
+    parts = urllib.parse.urlsplit(url)
+
+    params = []
+    for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True):
+        if name in SET_PARAMETERS:
+            value = ','.join(sorted(set(key for key in value.split(',') if key)))
+        elif name == 'p' and value == '1':
+            continue
+        params.append((name, value))
+
+    query = urllib.parse.urlencode(sorted(params), safe=',')
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+def archive_headers(headers):
+    """Get the request headers which are part of the archive key.
+
+    Requests left without headers get the key of requests sent without.
+    """
+    if not headers:
+        return None
+    return {name: value for name, value in headers.items() if name not in VOLATILE_HEADERS} or None
+
+
+def default_body_store(archive):
+    """Get the path of the body store of an archive.
+
+    Archives created by an `ArchiveManager` live in a subdirectory of
+    its root, where the store is shared by all of them. Any other
+    archive gets a store next to it.
+    """
+    path = os.path.abspath(archive.archive_path)
+    directory = os.path.dirname(path)
+    if MANAGED_ARCHIVE.fullmatch(os.path.join(os.path.basename(directory), os.path.basename(path))):
+        directory = os.path.dirname(directory)
+    return os.path.join(directory, BODY_STORE_FILE)
+
+
+def archived_bodies(archive_path):
+    """Get the digests of the bodies the responses of an archive point at."""
+
+    db = sqlite3.connect(archive_path, timeout=BUSY_TIMEOUT)
+    try:
+        rows = db.execute('SELECT data FROM ' + Archive.ARCHIVE_TABLE).fetchall()
+    finally:
+        db.close()
+
+    digests = set()
+    for row in rows:
+        data = pickle.loads(row[0])
+        if isinstance(data, requests.Response) and BODY_HEADER in data.headers:
+            digests.add(data.headers[BODY_HEADER])
+    return digests
+
+
+class BodyStore:
+    """Response bodies, stored once by their content hash.
+
+    It is a SQLite database shared by any number of archives, so runs
+    getting identical payloads only add the small archive entries
+    pointing at them. Several processes can share the same file.
+
+    :param path: path of the database, created when missing
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bodies (
+            digest TEXT PRIMARY KEY,
+            body BLOB NOT NULL
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(self.SCHEMA)
+        self._db.commit()
+
+    def put(self, body):
+        """Store a body, unless it is already stored.
+
+        :returns: the digest the body is stored by
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO bodies (digest, body) VALUES (?, ?)', (digest, body))
+            self._db.commit()
+        return digest
+
+    def get(self, digest):
+        """Get a stored body, or `None` when it isn't stored."""
+
+        with self._lock:
+            row = self._db.execute('SELECT body FROM bodies WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def prune(self, archive_paths):
+        """Remove the bodies no archive points at anymore.
+
+        Bodies are put before the archive entries pointing at them, so
+        no archive should be written meanwhile.
+
+        :param archive_paths: paths of every archive using the store
+        :returns: the number of bodies removed
+        """
+        digests = set()
+        for path in archive_paths:
+            digests |= archived_bodies(path)
+
+        with self._lock:
+            stored = [row[0] for row in self._db.execute('SELECT digest FROM bodies')]
+            unused = [(digest,) for digest in stored if digest not in digests]
+            self._db.executemany('DELETE FROM bodies WHERE digest = ?', unused)
+            self._db.commit()
+
+        logger.info("%s unused bodies removed from %s", len(unused), self.path)
+        return len(unused)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM bodies').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class DedupArchive:
+    """Archive keeping response bodies in a `BodyStore`.
+
+    The responses are archived without their body, with a header giving
+    its digest in the `BodyStore`, and get it back when retrieved.
+    Other archived data, like errors, and entries archived before,
+    are kept as they are. Everything else is left to the archive.
+
+    Entries are keyed without `VOLATILE_HEADERS`, so they are found
+    whatever ETag was sent, but for 304 (Not Modified) responses,
+    which only answer the ETag they were sent with. Those are looked
+    up first.
+
+    :param archive: perceval `Archive`
+    :param bodies: `BodyStore` of the response bodies
+    """
+
+    def __init__(self, archive, bodies):
+        self.archive = archive
+        self.bodies = bodies
+
+    def __getattr__(self, name):
+        return getattr(self.archive, name)
+
+    def store(self, uri, payload, headers, data):
+        conditional = isinstance(data, requests.Response) and data.status_code == 304
+        if not conditional:
+            headers = archive_headers(headers)
+
+        if isinstance(data, requests.Response):
+            digest = self.bodies.put(data.content)
+            data = copy.copy(data)
+            data.headers = CaseInsensitiveDict(data.headers)
+            data.headers[BODY_HEADER] = digest
+            data._content = b''
+
+        try:
+            self.archive.store(uri, payload, headers, data)
+        except ArchiveError as e:
+            # Requests with the same fingerprint get the same response
+            if 'duplicated entry' not in str(e):
+                raise
+            logger.debug("%s already archived", uri)
+
+    def retrieve(self, uri, payload, headers):
+        data = None
+        if headers != archive_headers(headers):
+            try:
+                data = self.archive.retrieve(uri, payload, headers)
+            except ArchiveError as e:
+                if 'not found' not in str(e):
+                    raise
+        if data is None:
+            data = self.archive.retrieve(uri, payload, archive_headers(headers))
+
+        if isinstance(data, requests.Response) and BODY_HEADER in data.headers:
+            digest = data.headers.pop(BODY_HEADER)
+            body = self.bodies.get(digest)
+            if body is None:
+                msg = "body %s of %s not found in %s" % (digest, uri, self.bodies.path)
+                raise ArchiveError(cause=msg)
+            data._content = body
+
+        return data
+
+
+def prune_bodies(dirpath, store=None):
+    """Remove the bodies no archive of a directory points at anymore.
+
+    :param dirpath: root of the archives, e.g. of an `ArchiveManager`
+    :param store: path of the body store; `BODY_STORE_FILE` at the
+        root by default
+    :returns: the number of bodies removed
+    """
+    store = store or os.path.join(dirpath, BODY_STORE_FILE)
+    paths = [path for path in glob.glob(os.path.join(dirpath, '**', '*.sqlite3'), recursive=True)
+             if os.path.basename(path) != BODY_STORE_FILE]
+
+    bodies = BodyStore(store)
+    try:
+        return bodies.prune(paths)
+    finally:
+        bodies.close()
+
+
+def main(args=None):
+    """Remove the bodies of deleted archives from the command line."""
+
+    parser = argparse.ArgumentParser(description="Sonarqube archived bodies pruning")
+    parser.add_argument('--body-store', dest='store', default=None,
+                        help="Body store to prune, if not at the root of the archives")
+    parser.add_argument('dirpath',
+                        help="Root directory of the archives")
+    args = parser.parse_args(args)
+
+    print(prune_bodies(args.dirpath, store=args.store))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1047 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Assad Montasser <assad.montasser@ow2.org>
+#     Valerio Cosentino <valcos@bitergia.com>
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+"""HTTP client of the Sonarqube backend.
+
+It holds everything that needs `requests`, so the backend module can be
+imported, and its command line parsed, without loading the HTTP stack.
+It is imported on the first fetch.
+"""
+
+import collections
+import configparser
+import concurrent.futures
+import datetime
+import logging
+import threading
+import urllib.parse
+
+from grimoirelab_toolkit.datetime import (datetime_to_utc,
+                                          datetime_utcnow,
+                                          str_to_datetime)
+from grimoirelab_toolkit.uris import urijoin
+
+from ...client import HttpClient
+import requests
+import urllib3
+from requests.auth import HTTPBasicAuth
+
+from .archive import (BodyStore,
+                      DedupArchive,
+                      default_body_store,
+                      fingerprint)
+from .preflight import (DEFAULT_PREFLIGHT_FILE,
+                        DEFAULT_PREFLIGHT_TTL,
+                        PreflightCache)
+from .sonarqube import (BRANCH_PARAMS,
+                        CONFIGURATION_FILE,
+                        DEFAULT_DATETIME,
+                        SONAR_URL,
+                        InvalidArgument)
+
+# Range before sleeping until rate limit reset
+MIN_RATE_LIMIT = 10
+MAX_RATE_LIMIT = 500
+
+# Largest page of the paginated endpoints, but for search_history
+PER_PAGE = 500
+HISTORY_PER_PAGE = 1000
+
+# Largest page of metrics/search
+METRICS_PER_PAGE = 500
+
+# Maximum number of metric keys accepted by measures/component_tree
+MAX_TREE_METRIC_KEYS = 15
+
+# Maximum number of results reachable through issues/search for a query
+# and shortest time slice (in seconds) the queries are split into
+ISSUES_CAP = 10000
+MIN_ISSUES_SLICE = 1
+
+# Default sleep time and retries to deal with connection/server problems
+DEFAULT_SLEEP_TIME = 1
+MAX_RETRIES = 5
+
+# Connections kept alive per Sonarqube host and default transport
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TRANSPORT = 'http1'
+
+
+logger = logging.getLogger(__name__)
+
+
+class SonarClient(HttpClient):
+    """Client for retrieving information from Sonarqube API
+
+    :param component: Sonar component (ie project)
+    :param base_url: Sonar URL in enterprise edition case;
+        when no value is set the backend will be fetch the data
+        from the Sonar public site.
+    :param archive: archive to store/retrieve items; requests are
+        archived by their fingerprint, and response bodies once in
+        a `BodyStore` shared by the archives (`BODY_STORE` of the
+        `archive` configuration section, or next to the archives)
+    """
+
+    RATE_LIMIT_HEADER = "RateLimit-Remaining"
+    RATE_LIMIT_RESET_HEADER = "RateLimit-Reset"
+
+    _users = {}       # users cache
+
+    # Request budget shared by the clients of a process (see shards.RateBudget)
+    budget = None
+
+    # Caps of the pages requested ahead of the consumer (see `pages`)
+    buffer_pages = None
+    buffer_bytes = None
+
+    def __init__(self, component, base_url=SONAR_URL, archive=None, from_archive=False, config=CONFIGURATION_FILE):
+        self.component = component
+        self._metric_definitions = None
+        self._metric_keys = None
+        self.last_etag = None
+        self.buffer = None
+
+        logger.info("Reading sonarqube backend configuration from %s", config)
+        configuration = configparser.RawConfigParser()
+        configuration.read( config )
+
+        try:
+            ssl_verify_text = configuration.get( 'connection' , 'SSL_VERIFY' )
+            self.ssl_verify = not ssl_verify_text.lower() in ('false', 'no', 'n')
+        except configparser.NoSectionError:
+            self.ssl_verify = True
+        except configparser.NoOptionError:
+            self.ssl_verify = True
+
+        try:
+            token = configuration.get( 'connection' , 'API_TOKEN' )
+            self.auth = HTTPBasicAuth(token, '')
+        except configparser.NoSectionError:
+            self.auth = None
+        except configparser.NoOptionError:
+            self.auth = None
+
+        try:
+            self.pool_size = configuration.getint( 'connection' , 'POOL_SIZE' )
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            self.pool_size = DEFAULT_POOL_SIZE
+
+        try:
+            self.transport = configuration.get( 'connection' , 'HTTP_TRANSPORT' ).lower()
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            self.transport = DEFAULT_TRANSPORT
+
+        try:
+            self.preflight_file = configuration.get( 'preflight' , 'CACHE_FILE' ) or None
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            self.preflight_file = DEFAULT_PREFLIGHT_FILE
+
+        try:
+            self.preflight_ttl = configuration.getint( 'preflight' , 'TTL' )
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            self.preflight_ttl = DEFAULT_PREFLIGHT_TTL
+
+        try:
+            body_store = configuration.get( 'archive' , 'BODY_STORE' )
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            body_store = None
+
+        base_url = urijoin(base_url, 'api')
+
+        super().__init__(base_url, sleep_time=DEFAULT_SLEEP_TIME, max_retries=MAX_RETRIES,
+                         archive=archive, from_archive=from_archive,
+                         ssl_verify=self.ssl_verify)
+
+        if archive:
+            bodies = BodyStore(body_store or default_body_store(archive))
+            self.archive = DedupArchive(archive, bodies)
+
+    def fetch(self, url, payload=None, headers=None, method=HttpClient.GET, stream=False, auth=None):
+        """Fetch the data from a given URL.
+
+        Requests sent to Sonarqube wait for the shared `budget`, if any.
+        See `HttpClient.fetch` for the parameters.
+        """
+        if self.budget and not self.from_archive:
+            self.budget.acquire()
+
+        return super().fetch(url, payload=payload, headers=headers, method=method,
+                             stream=stream, auth=auth)
+
+    @staticmethod
+    def sanitize_for_archive(url, headers, payload):
+        """Key archived requests by their fingerprint.
+
+        The same logical request is archived, and found, under the same
+        key whatever the order of its parameters or metric keys (see
+        `archive.fingerprint`) and, but for 304 responses, the ETag it
+        was sent with (see `archive.DedupArchive`).
+        """
+        return fingerprint(url), headers, payload
+
+    def _create_http_session(self):
+        """Take the pooled session shared by the clients of the same host."""
+
+        self.session = pooled_session(self)
+
+    def _close_http_session(self):
+        """Leave the pooled session open for other clients.
+
+        Pooled sessions are closed by `close_pooled_sessions`.
+        """
+        pass
+
+    def metric_keys_configured_on_client(self):
+        """Get list of metric keys configured for the client.
+
+        The configuration is read once per client.
+
+        :returns: a list of metrics
+        """
+        if self._metric_keys is None:
+            config = configparser.RawConfigParser()
+            config.read( CONFIGURATION_FILE )
+            metric_list = config.get( 'sonarqube' , 'TARGET_METRIC_FIELDS' )
+            self._metric_keys = metric_list.split(',')
+        return list(self._metric_keys)
+
+    def metrics_configured_on_server(self):
+        """Get list of metric keys enabled on the Sonarqube instance.
+
+        :returns: a generator of metric keys
+        """
+        endpoint = self.base_url + '/metrics/search'
+        response = self.fetch(endpoint, auth=self.auth)
+        return response.json()
+
+    def metric_definitions(self):
+        """Get the definition of every metric of the Sonarqube instance.
+
+        All the pages of `metrics/search` are walked once per client.
+
+        :returns: a list of metric definitions
+        """
+        if self._metric_definitions is None:
+            definitions = []
+            page = 1
+            while True:
+                endpoint = '{b}/metrics/search?ps={s}&p={p}'.format(b=self.base_url, s=METRICS_PER_PAGE, p=page)
+                response = self.fetch(endpoint, auth=self.auth).json()
+                definitions.extend(response['metrics'])
+                if not response['metrics'] or \
+                        page * int(response.get('ps', METRICS_PER_PAGE)) >= int(response.get('total', 0)):
+                    break
+                page += 1
+            self._metric_definitions = definitions
+        return self._metric_definitions
+
+    def metric_keys_on_server(self):
+        """Get every metric key of the Sonarqube instance."""
+
+        return [metric['key'] for metric in self.metric_definitions()]
+
+    def component_exists(self):
+        """Check whether the component exists on the Sonarqube instance."""
+
+        endpoint = '{b}/components/show?component={c}'.format(b=self.base_url, c=self.component)
+        try:
+            self.fetch(endpoint, auth=self.auth)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+        return True
+
+    def preflight(self, metric_keys=None):
+        """Check the component, and the metric keys, before fetching.
+
+        The component is looked up through `components/show`, and the
+        metric keys against every metric of the instance. The results
+        are kept in the `PreflightCache` of `CACHE_FILE` (configuration
+        section `preflight`) for `TTL` seconds, shared in memory by the
+        clients of the process, so later fetches and runs don't ask again.
+        Missing components aren't kept, so they are looked up every time.
+
+        :param metric_keys: list of metric keys to check, if any
+
+        :raises InvalidArgument: when the component doesn't exist or some
+            metric keys are unknown
+        """
+        cache = PreflightCache.open(self.preflight_file, self.preflight_ttl)
+
+        key = 'component {} {}'.format(self.base_url, self.component)
+        exists = cache.get(key)
+        if exists is None:
+            exists = self.component_exists()
+            # Missing components may be created any time
+            if exists:
+                cache.put(key, exists)
+        if not exists:
+            raise InvalidArgument('component: {} not found in {}'.format(self.component, self.base_url))
+
+        if not metric_keys:
+            return
+
+        key = 'metrics {}'.format(self.base_url)
+        known = cache.get(key)
+        if known is None:
+            known = self.metric_keys_on_server()
+            cache.put(key, known)
+        known = set(known)
+        unknown = [metric for metric in metric_keys if metric not in known]
+        if unknown:
+            raise InvalidArgument('metricKeys: {} unknown to {}'.format(','.join(unknown), self.base_url))
+
+    def metric_types(self):
+        """Get the type of each metric enabled on the Sonarqube instance.
+
+        :returns: a dict of metric types by metric key
+        """
+        return {metric['key']: metric.get('type') for metric in self.metric_definitions()}
+
+    def measures(self, **kwargs):
+        """Get metrics for a given component.
+
+        The ETag of the response is kept in `last_etag`.
+
+        :param from_date: obtain metrics updated since this date. Not implemented yet.
+        :param etag: ETag of a previous response, to get `None` when
+            the measures weren't modified since then
+        :param additional_fields: comma-separated list of the additional
+            fields (ie `periods`, `metrics`) to get along with the measures
+        :param branch: branch to get the measures of, instead of the main one
+        :param pullRequest: pull request to get the measures of
+        :returns: a generator of metrics
+        """
+        try:
+            metricKeys = kwargs['metricKeys']
+        except KeyError as ke:
+            metricKeys = ','.join(self.metric_keys_configured_on_client())
+        endpoint = '{b}/measures/component?component={c}&metricKeys={k}'
+        endpoint = endpoint.format(b=self.base_url, c=self.component, k=metricKeys)
+
+        additional_fields = kwargs.get('additional_fields')
+        if additional_fields:
+            endpoint += '&additionalFields=' + additional_fields
+        endpoint += self._branch_query(kwargs)
+
+        etag = kwargs.get('etag')
+        headers = {'If-None-Match': etag} if etag else None
+
+        response = self.fetch(endpoint, headers=headers, auth=self.auth)
+        if response.status_code == 304:
+            return None
+
+        self.last_etag = response.headers.get('ETag')
+        return response.json()
+
+    def analysis_date(self):
+        """Get the date of the last analysis of the component.
+
+        :returns: the date, as given by Sonarqube, or `None` when the
+            component was never analysed
+        """
+        endpoint = '{b}/project_analyses/search?project={c}&ps=1'
+        endpoint = endpoint.format(b=self.base_url, c=self.component)
+
+        analyses = self.fetch(endpoint, auth=self.auth).json()['analyses']
+        return analyses[0]['date'] if analyses else None
+
+    def branches_and_pull_requests(self):
+        """Get the branches and pull requests of the component.
+
+        Instances without pull requests (e.g. the Community Edition)
+        answer the pull request list with an error, taken as no pull
+        requests.
+
+        :returns: a list of (target, analysis date) pairs, where the
+            target holds the request parameters selecting the branch or
+            pull request; it is empty for the main branch
+        """
+        endpoint = '{b}/project_branches/list?project={c}'.format(b=self.base_url, c=self.component)
+        targets = []
+        for branch in self.fetch(endpoint, auth=self.auth).json()['branches']:
+            target = {} if branch.get('isMain') else {'branch': branch['name']}
+            targets.append((target, branch.get('analysisDate')))
+
+        endpoint = '{b}/project_pull_requests/list?project={c}'.format(b=self.base_url, c=self.component)
+        try:
+            pull_requests = self.fetch(endpoint, auth=self.auth).json()['pullRequests']
+        except requests.exceptions.HTTPError as e:
+            logger.debug("No pull requests of %s: %s", self.component, e)
+            pull_requests = []
+        for pull_request in pull_requests:
+            targets.append(({'pullRequest': pull_request['key']}, pull_request.get('analysisDate')))
+
+        return targets
+
+    def history(self, **kwargs):
+        """Get histories of metrics for a given component.
+
+        :param from_date: obtain metrics updated since this date. Not implemented yet.
+        :returns: a dict of measures by metric
+        """
+        output = {}
+        for chunk in self.history_pages(**kwargs):
+            for metric, history in chunk.items():
+                output.setdefault(metric, []).extend(history)
+
+        return output
+
+    def history_pages(self, **kwargs):
+        """Get histories of metrics for a given component, page by page.
+
+        Only one page is held in memory at a time.
+
+        :param from_date: obtain metrics updated since this date. Not implemented yet.
+        :param since: obtain measures taken since this date
+        :param branch: branch to get the histories of, instead of the main one
+        :param pullRequest: pull request to get the histories of
+        :returns: a generator of dicts of measures by metric, one per page
+        """
+        def _format(measures):
+            '''Formats the histories of measures for easier accumulation.'''
+            output = {}
+            for metric in measures:
+                key = metric['metric']
+                output[key] = metric['history']
+            return output
+
+        try:
+            metricKeys = kwargs['metricKeys']
+        except KeyError as ke:
+            metricKeys = ','.join(self.metric_keys_configured_on_client())
+        endpoint = '{b}/measures/search_history?component={c}&metrics={k}'
+        endpoint = endpoint.format(b=self.base_url, c=self.component, k=metricKeys)
+
+        since = kwargs.get('since')
+        if since:
+            since = datetime_to_utc(since).strftime('%Y-%m-%dT%H:%M:%S%z')
+            endpoint += '&from=' + urllib.parse.quote(since)
+        endpoint += self._branch_query(kwargs)
+
+        for page in self.pages(endpoint, page_size=HISTORY_PER_PAGE):
+            yield _format(page['measures'])
+
+    def component_tree(self, **kwargs):
+        """Get metrics for every descendant of a given component, page by page.
+
+        Metric keys are requested in batches of `MAX_TREE_METRIC_KEYS`,
+        walking the whole tree once per batch.
+
+        :param metricKeys: comma-separated list of metrics to fetch
+        :param prefetch: number of pages to request ahead concurrently
+        :returns: a generator of measures/component_tree pages
+        """
+        metricKeys = kwargs.get('metricKeys') or ','.join(self.metric_keys_configured_on_client())
+        metricKeys = metricKeys.split(',')
+        prefetch = kwargs.get('prefetch') or 0
+
+        for start in range(0, len(metricKeys), MAX_TREE_METRIC_KEYS):
+            batch = ','.join(metricKeys[start:start + MAX_TREE_METRIC_KEYS])
+            endpoint = '{b}/measures/component_tree?component={c}&metricKeys={k}'
+            endpoint = endpoint.format(b=self.base_url, c=self.component, k=batch)
+
+            yield from self.pages(endpoint, prefetch=prefetch, page_size=PER_PAGE)
+
+    def hotspots(self, prefetch=0):
+        """Get the security hotspots of a given component, page by page.
+
+        :param prefetch: number of pages to request ahead concurrently
+        :returns: a generator of hotspots/search pages
+        """
+        endpoint = '{b}/hotspots/search?projectKey={c}'.format(b=self.base_url, c=self.component)
+
+        return self.pages(endpoint, prefetch=prefetch, page_size=PER_PAGE)
+
+    def duplications(self, prefetch=0):
+        """Get the duplicated blocks of the files of a given component.
+
+        Files are listed through measures/component_tree and only those
+        with duplicated blocks are requested to duplications/show.
+
+        :param prefetch: number of pages and files to request ahead concurrently
+        :returns: a generator of (file key, duplications/show response) pairs
+        """
+        fetch = self.fetch
+        endpoint = '{b}/measures/component_tree?component={c}&metricKeys=duplicated_blocks&qualifiers=FIL'
+        endpoint = endpoint.format(b=self.base_url, c=self.component)
+
+        def _duplicated_files():
+            for page in self.pages(endpoint, prefetch=prefetch, page_size=PER_PAGE):
+                for component in page['components']:
+                    measures = component.get('measures', [])
+                    if any(float(measure.get('value', 0)) > 0 for measure in measures):
+                        yield component['key']
+
+        def _show(key):
+            url = '{b}/duplications/show?key={k}'.format(b=self.base_url, k=urllib.parse.quote(key))
+            response = fetch(url, auth=self.auth)
+            aux = response.json()
+            response.close()
+            return key, aux
+
+        return ordered_map(_show, _duplicated_files(), self._concurrency(prefetch))
+
+    def issues(self, from_date=DEFAULT_DATETIME, workers=1):
+        """Get the issues of a given component.
+
+        `issues/search` only reaches the first `ISSUES_CAP` results of a
+        query. A full fetch splits the creation dates into time slices
+        holding fewer issues than that, halving them as needed, and
+        harvests up to `workers` slices concurrently. An incremental
+        fetch, from a date later than `DEFAULT_DATETIME`, walks the issues
+        by descending update date until that date, falling back to a full
+        fetch when there are too many. Issues are yielded once per key.
+
+        :param from_date: obtain issues updated since this date
+        :param workers: number of slices to harvest concurrently
+        :returns: a generator of issues
+        """
+        endpoint = '{b}/issues/search?componentKeys={c}'.format(b=self.base_url, c=self.component)
+        seen = set()
+
+        def _unseen(issues):
+            for issue in issues:
+                if issue['key'] not in seen:
+                    seen.add(issue['key'])
+                    yield issue
+
+        if from_date > DEFAULT_DATETIME:
+            updated = endpoint + '&s=UPDATE_DATE&asc=false'
+            nissues = 0
+            for page in self.pages(updated, limit=ISSUES_CAP, page_size=PER_PAGE):
+                for issue in page['issues']:
+                    if str_to_datetime(issue['updateDate']) < from_date:
+                        return
+                    nissues += 1
+                    yield from _unseen([issue])
+            if nissues < ISSUES_CAP:
+                return
+            logger.warning("More than %s issues updated since %s; fetching them all",
+                           ISSUES_CAP, from_date)
+
+        slices = self._issue_slices(endpoint, DEFAULT_DATETIME,
+                                    datetime_utcnow().replace(microsecond=0) + datetime.timedelta(seconds=1))
+
+        def _harvest(window):
+            sliced = self._issue_window(endpoint, *window)
+            pages = self.pages(sliced, limit=ISSUES_CAP, page_size=PER_PAGE)
+            return [issue for page in pages for issue in page['issues']]
+
+        workers = workers if workers > 1 else 0
+        for harvested in ordered_map(_harvest, slices, self._concurrency(workers)):
+            yield from _unseen(harvested)
+
+    def _issue_slices(self, endpoint, start, end):
+        """Split a creation date range into slices of at most `ISSUES_CAP` issues.
+
+        :returns: a list of (start, end) slices, in chronological order
+        """
+        response = self.fetch(self._issue_window(endpoint, start, end) + '&ps=1', auth=self.auth)
+        total = int(response.json()['paging']['total'])
+        response.close()
+
+        length = int((end - start).total_seconds())
+        if total == 0:
+            return []
+        elif total <= ISSUES_CAP:
+            return [(start, end)]
+        elif length <= MIN_ISSUES_SLICE:
+            logger.warning("Only %s out of %s issues created at %s can be fetched",
+                           ISSUES_CAP, total, start)
+            return [(start, end)]
+
+        middle = start + datetime.timedelta(seconds=length // 2)
+        return self._issue_slices(endpoint, start, middle) + self._issue_slices(endpoint, middle, end)
+
+    @staticmethod
+    def _issue_window(endpoint, start, end):
+        """Restrict an issues/search endpoint to a creation date range."""
+
+        window = '{e}&createdAfter={a}&createdBefore={b}'
+        return window.format(e=endpoint,
+                             a=urllib.parse.quote(start.strftime('%Y-%m-%dT%H:%M:%S%z')),
+                             b=urllib.parse.quote(end.strftime('%Y-%m-%dT%H:%M:%S%z')))
+
+    def pages(self, endpoint, prefetch=0, limit=None, page_size=None):
+        """Get, in order, the pages of a paginated endpoint.
+
+        The first page is requested with `page_size` items, or the
+        default page size of the server when not given; the rest use the
+        page size it answers with. Up to `prefetch` pages are requested
+        ahead concurrently, so no more than that many pages wait in
+        memory for the consumer. Pages are always requested one by one
+        when archiving or reading from an archive.
+
+        When `buffer_pages` or `buffer_bytes` are set, pages are
+        requested on a producer thread into a `BoundedBuffer`, kept in
+        `buffer` while the pages are walked, which blocks the producer
+        while the consumer lags behind.
+
+        :param endpoint: URL of the endpoint, including its query
+        :param prefetch: number of pages to request ahead concurrently
+        :param limit: maximum number of results the endpoint can reach
+        :param page_size: number of items requested per page, usually the
+            largest the endpoint allows, so there are as few requests as
+            possible
+        :returns: a generator of decoded pages
+        """
+        pages = self._sized_pages(endpoint, prefetch, limit, page_size)
+
+        if (self.buffer_pages or self.buffer_bytes) and self._concurrency(1):
+            self.buffer = BoundedBuffer(max_items=self.buffer_pages, max_bytes=self.buffer_bytes)
+            pages = self.buffer.drain(pages, sizeof=lambda sized: sized[1])
+
+        for page, _ in pages:
+            yield page
+
+    def _sized_pages(self, endpoint, prefetch=0, limit=None, page_size=None):
+        """Get the pages of a paginated endpoint along with their size in bytes."""
+
+        fetch = self.fetch
+
+        def _get_page(page, page_size):
+            if page > 1:
+                pager = '&ps={s}&p={p}'.format(s=page_size, p=page)
+            else:
+                pager = '&ps={s}'.format(s=page_size) if page_size else ''
+            response = fetch(endpoint + pager, auth=self.auth)
+            aux = response.json()
+            nbytes = len(response.content)
+            response.close()
+            return aux, nbytes
+
+        first = _get_page(1, page_size)
+        yield first
+
+        paging = first[0]['paging']
+        page_size = int(paging['pageSize'])
+        total = int(paging['total'])
+        if limit:
+            total = min(total, limit)
+        last_page = -(-total // page_size)
+        remaining = range(2, last_page + 1)
+
+        yield from ordered_map(lambda page: _get_page(page, page_size), remaining,
+                               self._concurrency(prefetch))
+
+    @staticmethod
+    def _branch_query(kwargs):
+        """Query selecting the branch or pull request given in the arguments, if any."""
+
+        return ''.join('&{}={}'.format(param, urllib.parse.quote(str(kwargs[param]), safe=''))
+                       for param in BRANCH_PARAMS if kwargs.get(param))
+
+    def _concurrency(self, workers):
+        """Number of concurrent requests allowed; archives are written one by one."""
+
+        if self.archive or self.from_archive:
+            return 0
+        return workers
+
+
+def ordered_map(function, iterable, workers=0):
+    """Apply a function to every element, yielding the results in order.
+
+    Up to `workers` calls run ahead concurrently on a thread pool, so
+    no more than that many results wait for the consumer. Without
+    workers, each call is made when its result is consumed.
+
+    :param function: callable to apply
+    :param iterable: elements to apply the function to
+    :param workers: number of calls to run ahead concurrently
+    :returns: a generator of results
+    """
+    if workers < 1:
+        for element in iterable:
+            yield function(element)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for element in iterable:
+            pending.append(executor.submit(function, element))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class BoundedBuffer:
+    """Queue between a producer thread and a consumer, capped in items or bytes.
+
+    The producer blocks while the buffer is full, so the memory taken
+    by the elements waiting for the consumer never goes beyond the
+    caps, whatever the speed of the consumer. An element larger than
+    `max_bytes` is only let in when the buffer is empty.
+
+    :param max_items: maximum number of elements waiting; `None` for no cap
+    :param max_bytes: maximum size of the elements waiting; `None` for no cap
+    """
+
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._elements = collections.deque()
+        self._nbytes = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def depth(self):
+        """Number of elements waiting for the consumer."""
+
+        return len(self._elements)
+
+    @property
+    def nbytes(self):
+        """Size of the elements waiting for the consumer."""
+
+        return self._nbytes
+
+    def drain(self, iterable, sizeof=lambda element: 0):
+        """Walk an iterable on a producer thread, yielding its elements.
+
+        Exceptions raised by the iterable are raised to the consumer
+        once the elements produced before them are consumed. Closing the
+        generator stops the producer.
+
+        :param iterable: elements to produce
+        :param sizeof: callable returning the size in bytes of an element
+        :returns: a generator of the elements
+        """
+        yield from self.start(iterable, sizeof)
+
+    def start(self, iterable, sizeof=lambda element: 0):
+        """Start walking an iterable on a producer thread right away.
+
+        Unlike `drain`, the producer fills the buffer before the
+        elements are asked for. Call `close` to stop it when the
+        returned generator is never walked.
+
+        :param iterable: elements to produce
+        :param sizeof: callable returning the size in bytes of an element
+        :returns: a generator of the elements
+        """
+        end = object()
+        failure = []
+
+        def _produce():
+            try:
+                for element in iterable:
+                    if not self._put(element, sizeof(element)):
+                        return
+            except Exception as e:
+                failure.append(e)
+            self._put(end, 0)
+
+        def _consume():
+            try:
+                while True:
+                    element = self._get()
+                    if element is end:
+                        break
+                    yield element
+            finally:
+                self.close()
+                producer.join()
+
+            if failure:
+                raise failure[0]
+
+        producer = threading.Thread(target=_produce, daemon=True)
+        producer.start()
+        return _consume()
+
+    def _full(self, nbytes):
+        if not self._elements:
+            return False
+        if self.max_items and len(self._elements) >= self.max_items:
+            return True
+        return bool(self.max_bytes and self._nbytes + nbytes > self.max_bytes)
+
+    def _put(self, element, nbytes):
+        with self._condition:
+            while not self._closed and self._full(nbytes):
+                self._condition.wait()
+            if self._closed:
+                return False
+            self._elements.append((element, nbytes))
+            self._nbytes += nbytes
+            self._condition.notify_all()
+            return True
+
+    def _get(self):
+        with self._condition:
+            while not self._elements:
+                self._condition.wait()
+            element, nbytes = self._elements.popleft()
+            self._nbytes -= nbytes
+            self._condition.notify_all()
+            return element
+
+    def close(self):
+        """Stop the producer, dropping the elements waiting."""
+
+        with self._condition:
+            self._closed = True
+            self._elements.clear()
+            self._nbytes = 0
+            self._condition.notify_all()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _http1_adapter(client, retries):
+    return requests.adapters.HTTPAdapter(pool_connections=client.pool_size,
+                                         pool_maxsize=client.pool_size,
+                                         max_retries=retries)
+
+
+def _http2_adapter(client, retries):
+    try:
+        import httpx
+    except ImportError:
+        raise InvalidArgument('transport http2: it needs the httpx[http2] package.')
+    return HTTP2Adapter(pool_size=client.pool_size, max_retries=retries)
+
+
+TRANSPORTS = {
+    'http1': _http1_adapter,
+    'http2': _http2_adapter
+}
+
+
+def register_transport(name, factory):
+    """Make a transport available for the clients.
+
+    :param name: name of the transport, as set in HTTP_TRANSPORT
+    :param factory: callable returning a `requests` transport adapter
+        out of a client and its `urllib3.util.Retry` policy
+    """
+    TRANSPORTS[name.lower()] = factory
+
+
+def pooled_session(client):
+    """Get the HTTP session shared by the clients of a Sonarqube host.
+
+    Sessions are kept for the whole process and keyed by the scheme
+    and location of the base URL, the SSL verification, the pool size
+    and the transport of the client, so they can be reused across
+    clients, components and backends without setting up new TCP and
+    TLS connections.
+
+    :param client: `SonarClient` asking for the session
+    :returns: a `requests.Session`
+    """
+    url = urllib.parse.urlsplit(client.base_url)
+    key = (url.scheme, url.netloc, client.ssl_verify, client.pool_size, client.transport)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session:
+            return session
+
+        try:
+            factory = TRANSPORTS[client.transport]
+        except KeyError:
+            raise InvalidArgument('transport {}.'.format(client.transport))
+
+        retries = urllib3.util.Retry(total=client.max_retries,
+                                     connect=client.max_retries_on_connect,
+                                     read=client.max_retries_on_read,
+                                     redirect=client.max_retries_on_redirect,
+                                     status=client.max_retries_on_status,
+                                     allowed_methods=client.method_whitelist,
+                                     status_forcelist=client.status_forcelist,
+                                     backoff_factor=client.sleep_time,
+                                     raise_on_redirect=client.raise_on_redirect,
+                                     raise_on_status=client.raise_on_status,
+                                     respect_retry_after_header=client.respect_retry_after_header)
+
+        session = requests.Session()
+        session.headers.update(client.headers)
+        adapter = factory(client, retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        _sessions[key] = session
+        logger.debug("New pooled session for %s://%s", url.scheme, url.netloc)
+
+    return session
+
+
+def close_pooled_sessions():
+    """Close and forget all the pooled sessions."""
+
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    """Transport adapter sending `requests` calls over HTTP/2.
+
+    It relies on the optional `httpx[http2]` package and multiplexes
+    the requests to a host over a single connection. Requests are
+    retried after the same `urllib3` `Retry` policy as the HTTP/1.1
+    transport: connection errors, read errors of idempotent methods
+    and the statuses it lists back off and are sent again until the
+    policy runs out. `httpx` sets TLS and proxies per client, so one
+    client is kept for each `verify`, `cert` and proxy of the requests.
+
+    :param pool_size: maximum number of connections kept alive by each client
+    :param max_retries: `urllib3.util.Retry` policy, or number of retries
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_retries=0):
+        super().__init__()
+        self.pool_size = pool_size
+        self.max_retries = urllib3.util.Retry.from_int(max_retries)
+
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        """Send a prepared request and wrap the answer as a `requests.Response`."""
+
+        import httpx
+
+        client = self._client(verify, cert, requests.utils.select_proxy(request.url, proxies))
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(None, connect=timeout[0], read=timeout[1])
+
+        retries = self.max_retries
+        while True:
+            try:
+                answer = client.send(client.build_request(request.method, request.url,
+                                                          headers=dict(request.headers),
+                                                          content=request.body,
+                                                          timeout=timeout),
+                                     stream=stream)
+            except httpx.TransportError as e:
+                retries = self._retry_error(retries, request, e)
+                retries.sleep()
+                continue
+
+            if not retries.is_retry(request.method, answer.status_code, 'Retry-After' in answer.headers):
+                return self._response(request, answer, stream)
+
+            status = urllib3.response.HTTPResponse(headers=dict(answer.headers), status=answer.status_code)
+            try:
+                retries = retries.increment(request.method, request.url, response=status)
+            except urllib3.exceptions.MaxRetryError as e:
+                if retries.raise_on_status:
+                    answer.close()
+                    raise requests.exceptions.RetryError(e, request=request)
+                return self._response(request, answer, stream)
+            answer.close()
+            retries.sleep(status)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+    def _client(self, verify, cert, proxy):
+        import httpx
+
+        key = (verify, cert, proxy)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                limits = httpx.Limits(max_connections=self.pool_size,
+                                      max_keepalive_connections=self.pool_size)
+                client = httpx.Client(http2=True, verify=verify, cert=cert, proxy=proxy, limits=limits)
+                self._clients[key] = client
+            return client
+
+    @staticmethod
+    def _retry_error(retries, request, error):
+        """Count a transport error against the retries, raising it once they run out."""
+
+        import httpx
+
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+            cause = urllib3.exceptions.ConnectTimeoutError(str(error))
+        elif isinstance(error, httpx.ReadTimeout):
+            cause = urllib3.exceptions.ReadTimeoutError(None, request.url, str(error))
+        else:
+            cause = urllib3.exceptions.ProtocolError(str(error))
+
+        try:
+            return retries.increment(request.method, request.url, error=cause)
+        except urllib3.exceptions.HTTPError as e:
+            if isinstance(error, httpx.ConnectTimeout):
+                raise requests.exceptions.ConnectTimeout(e, request=request)
+            if isinstance(error, httpx.ReadTimeout):
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+    def _response(self, request, answer, stream):
+        response = requests.Response()
+        response.status_code = answer.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(answer.headers)
+        response.reason = answer.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.encoding = answer.encoding
+        if stream:
+            response.raw = _StreamedAnswer(answer)
+        else:
+            response._content = answer.content
+        response.connection = self
+        return response
+
+
+class _StreamedAnswer:
+    """Raw body of a streamed `httpx` answer, read as `requests` does."""
+
+    def __init__(self, answer):
+        self._answer = answer
+        self._chunks = None
+
+    def stream(self, chunk_size=None, decode_content=True):
+        yield from self._answer.iter_bytes(chunk_size)
+
+    def read(self, amt=None, decode_content=True):
+        if amt is None:
+            return self._answer.read()
+        if self._chunks is None:
+            self._chunks = self._answer.iter_bytes(amt)
+        return next(self._chunks, b'')
+
+    def close(self):
+        self._answer.close()
+
+    def release_conn(self):
+        # Called by `requests` on closing, even once the body was read
+        self._answer.close()
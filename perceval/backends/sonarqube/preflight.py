@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Where the preflight results are kept, and for how many seconds
+DEFAULT_PREFLIGHT_FILE = os.path.expanduser('~/.perceval/sonarqube-preflight.json')
+DEFAULT_PREFLIGHT_TTL = 24 * 3600
+
+
+class PreflightCache:
+    """Results of the preflight checks, kept in memory and on disk.
+
+    Each entry expires `ttl` seconds after it was put. The file is a
+    JSON object read once and rewritten, atomically, on every `put`,
+    merged with what other processes wrote meanwhile. Use `open` to
+    share the same cache among the clients of a process.
+
+    :param path: path of the file; `None` to keep entries in memory only
+    :param ttl: seconds the entries are valid for
+    :param clock: callable returning the current time, in seconds
+    """
+
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, path=None, ttl=DEFAULT_PREFLIGHT_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = self._read()
+
+    @classmethod
+    def open(cls, path=None, ttl=DEFAULT_PREFLIGHT_TTL):
+        """Get the cache of a path, shared by the whole process."""
+
+        with cls._caches_lock:
+            cache = cls._caches.get(path)
+            if cache is None:
+                cache = cls(path, ttl)
+                cls._caches[path] = cache
+            cache.ttl = ttl
+            return cache
+
+    def get(self, key):
+        """Get the value of a key, or `None` when missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry['expires'] <= self.clock():
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        """Set the value of a key, until it expires."""
+
+        entry = {'value': value, 'expires': self.clock() + self.ttl}
+        with self._lock:
+            self._entries[key] = entry
+            if self.path:
+                entries = self._read()
+                entries[key] = entry
+                self._write(entries)
+                self._entries = entries
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Preflight cache %s ignored: %s", self.path, e)
+            return {}
+
+    def _write(self, entries):
+        now = self.clock()
+        entries = {key: entry for key, entry in entries.items() if entry['expires'] > now}
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.preflight-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import queue as queues
+import shutil
+import sys
+import tempfile
+import time
+
+from grimoirelab_toolkit.datetime import str_to_datetime
+
+from .sonarqube import (DEFAULT_CATEGORY,
+                        HISTORY_RESOLUTIONS,
+                        SONAR_URL,
+                        Sonar)
+from .state import StateStore
+
+logger = logging.getLogger(__name__)
+
+SHARD_FILE = 'shard-{}.jsonl'
+BUDGET_FILE = 'budget'
+
+# Command line arguments passed to `Sonar.fetch`, when given
+FETCH_ARGS = ('from_date', 'metricKeys', 'all_branches', 'flatten_measures', 'compact_history',
+              'history_resolution', 'prefetch', 'workers')
+
+# Seconds to wait for news of the processes before checking they are alive
+POLL_INTERVAL = 1
+
+
+def shard_of(component, nshards):
+    """Get the shard of a component.
+
+    The shard only depends on the component key, so it is the same
+    across runs, processes and Python versions.
+
+    :param component: Sonar component (ie project)
+    :param nshards: number of shards
+    :returns: the shard number, from 0 to `nshards - 1`
+    """
+    digest = hashlib.sha1(component.encode('utf-8')).hexdigest()
+    return int(digest, 16) % nshards
+
+
+def partition(components, nshards):
+    """Split a list of components into shards, keeping their order.
+
+    :returns: a list with the (position, component) pairs of each shard
+    """
+    shards = [[] for _ in range(nshards)]
+    for position, component in enumerate(components):
+        shards[shard_of(component, nshards)].append((position, component))
+    return shards
+
+
+class RateBudget:
+    """Request rate shared by several processes through a file.
+
+    It is a token bucket whose state, the available tokens and the time
+    they were counted, is kept in a small file locked on every access.
+    Each request takes a token; tokens come back at `rate` per second up
+    to `burst`.
+
+    :param path: coordination file, created when missing
+    :param rate: requests per second allowed to all the processes
+    :param burst: maximum number of requests sent at once
+    """
+
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+
+    def acquire(self):
+        """Wait until a request can be sent."""
+
+        while True:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                state = f.read().split()
+                now = time.time()
+
+                if state:
+                    tokens, counted = float(state[0]), float(state[1])
+                    tokens = min(self.burst, tokens + (now - counted) * self.rate)
+                else:
+                    tokens = self.burst
+
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / self.rate
+
+                f.seek(0)
+                f.truncate()
+                f.write('{} {}'.format(tokens, now))
+
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class ShardedRunner:
+    """Fetch the items of many components on several processes.
+
+    Components are split by `shard_of` across `nshards` processes, each
+    one fetching its components one after the other with its own
+    `Sonar` backend and client. When a `rate` is given, all of them
+    share a `RateBudget`. Each process writes the items of its shard,
+    as JSON lines, to its own file; the items of every component are
+    written together. Items fetched before a component fails are kept.
+    When a process dies, the components it didn't report fail.
+
+    :param components: list of Sonar components
+    :param nshards: number of processes
+    :param base_url: Sonar URL
+    :param category: category of the items to fetch
+    :param tag: label used to mark the data
+    :param fetch_args: dict of extra arguments for `Sonar.fetch`
+    :param output_dir: directory for the shard files; a temporary one,
+        removed after merging, when not given
+    :param rate: requests per second allowed to all the processes
+    :param state: path of a `StateStore` shared by all the processes
+    :param start_method: multiprocessing start method
+    """
+
+    def __init__(self, components, nshards, base_url=SONAR_URL, category=DEFAULT_CATEGORY,
+                 tag=None, fetch_args=None, output_dir=None, rate=None, state=None,
+                 start_method='spawn'):
+        self.components = list(components)
+        self.nshards = nshards
+        self.base_url = base_url
+        self.category = category
+        self.tag = tag
+        self.fetch_args = fetch_args or {}
+        self.output_dir = output_dir
+        self.rate = rate
+        self.state = state
+        self.start_method = start_method
+        self.failed = []
+
+    def run(self):
+        """Fetch every shard into its own file.
+
+        :returns: the list of shard files
+        """
+        for _ in self._run():
+            pass
+        return self._paths
+
+    def items(self):
+        """Fetch every shard, merging the items into one ordered stream.
+
+        Items are yielded component by component, in the order of
+        `components`, as soon as each component is done. They are read
+        back from the shard files, so they are never held in memory.
+
+        :returns: a generator of items
+        """
+        temporary = self.output_dir is None
+        try:
+            pending = {}
+            following = 0
+            for done in self._run():
+                pending[done[0]] = done
+                while following in pending:
+                    position, shard, start, end, error = pending.pop(following)
+                    yield from self._read(shard, start, end)
+                    following += 1
+        finally:
+            if temporary:
+                shutil.rmtree(self._dir, ignore_errors=True)
+
+    def _run(self):
+        """Start the processes and report each component when it is done."""
+
+        self._dir = self.output_dir or tempfile.mkdtemp(prefix='sonarqube-shards-')
+        os.makedirs(self._dir, exist_ok=True)
+        self._paths = [os.path.join(self._dir, SHARD_FILE.format(n)) for n in range(self.nshards)]
+        budget = os.path.join(self._dir, BUDGET_FILE) if self.rate else None
+
+        import multiprocessing
+
+        context = multiprocessing.get_context(self.start_method)
+        queue = context.Queue()
+        settings = {
+            'base_url': self.base_url,
+            'category': self.category,
+            'tag': self.tag,
+            'fetch_args': self.fetch_args,
+            'budget': budget,
+            'rate': self.rate,
+            'state': self.state
+        }
+
+        shards = partition(self.components, self.nshards)
+        processes = []
+        for shard, components in enumerate(shards):
+            process = context.Process(target=_run_shard,
+                                      args=(shard, components, settings, self._paths[shard], queue))
+            process.start()
+            processes.append(process)
+
+        # Components not reported yet, by running shard
+        running = {shard: [position for position, _ in components]
+                   for shard, components in enumerate(shards)}
+
+        def _report(message):
+            position, shard, start, end, error = message
+            if position is None:
+                del running[shard]
+                return
+            running[shard].remove(position)
+            if error:
+                logger.error("Fetch of %s failed: %s", self.components[position], error)
+                self.failed.append(self.components[position])
+            yield message
+
+        while running:
+            try:
+                yield from _report(queue.get(timeout=POLL_INTERVAL))
+                continue
+            except queues.Empty:
+                pass
+
+            exited = [shard for shard in running if not processes[shard].is_alive()]
+            if not exited:
+                continue
+
+            # Whatever they sent before exiting is already in the queue
+            try:
+                while True:
+                    yield from _report(queue.get_nowait())
+            except queues.Empty:
+                pass
+
+            for shard in exited:
+                if shard not in running:
+                    continue
+                error = 'shard {} exited with code {}'.format(shard, processes[shard].exitcode)
+                for position in list(running[shard]):
+                    yield from _report((position, shard, 0, 0, error))
+                del running[shard]
+
+        for process in processes:
+            process.join()
+
+    def _read(self, shard, start, end):
+        # Shards dying early may not have a file
+        if start >= end:
+            return
+        with open(self._paths[shard], 'rb') as f:
+            f.seek(start)
+            while start < end:
+                line = f.readline()
+                start += len(line)
+                yield json.loads(line)
+
+
+def _run_shard(shard, components, settings, path, queue):
+    """Fetch the components of a shard; runs on its own process."""
+
+    from .client import SonarClient, close_pooled_sessions
+
+    # Connections inherited from a forked parent can't be shared
+    close_pooled_sessions()
+
+    if settings['budget']:
+        SonarClient.budget = RateBudget(settings['budget'], settings['rate'])
+
+    state = StateStore(settings['state']) if settings['state'] else None
+
+    with open(path, 'wb') as f:
+        for position, component in components:
+            start = f.tell()
+            try:
+                backend = Sonar(component, base_url=settings['base_url'], tag=settings['tag'],
+                                state=state)
+                for item in backend.fetch(category=settings['category'], **settings['fetch_args']):
+                    f.write(json.dumps(item, sort_keys=True).encode('utf-8') + b'\n')
+            except Exception as e:
+                # Items written before the failure are kept, as the
+                # state store may have recorded them already
+                error = repr(e)
+            else:
+                error = None
+
+            f.flush()
+            queue.put((position, shard, start, f.tell(), error))
+
+    queue.put((None, shard, None, None, None))
+
+
+def main(args=None):
+    """Fetch many components on several processes from the command line."""
+
+    parser = argparse.ArgumentParser(description="Sharded Sonarqube fetch")
+    parser.add_argument('--base-url', dest='base_url', default=SONAR_URL,
+                        help="Base URL for Sonarqube instance")
+    parser.add_argument('--category', default=DEFAULT_CATEGORY,
+                        choices=Sonar.CATEGORIES, help="Category of items to fetch")
+    parser.add_argument('--tag', default=None,
+                        help="Tag the items generated during the fetching process")
+    parser.add_argument('--from-date', dest='from_date', type=str_to_datetime, default=None,
+                        help="Fetch items updated since this date")
+    parser.add_argument('--metricKeys', dest='metricKeys', default=None,
+                        help="Comma-separated list of Sonarqube metrics to fetch")
+    parser.add_argument('--all-branches', dest='all_branches', action='store_true',
+                        help="Fetch measures and histories of every branch and pull request too")
+    parser.add_argument('--flatten-measures', dest='flatten_measures', action='store_true',
+                        help="Flatten measures with typed values, periods and metric definitions")
+    history = parser.add_mutually_exclusive_group()
+    history.add_argument('--compact-history', dest='compact_history', action='store_true',
+                         help="Collapse repeated history values into intervals")
+    history.add_argument('--history-resolution', dest='history_resolution',
+                         choices=HISTORY_RESOLUTIONS, default=None,
+                         help="Reduce histories to one value per day, week or month")
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help="Number of pages (or files) to request ahead concurrently")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of issue time slices, or of branches and pull requests, to fetch concurrently")
+    parser.add_argument('--shards', type=int, default=os.cpu_count(),
+                        help="Number of processes")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Requests per second allowed to all the processes")
+    parser.add_argument('--output-dir', dest='output_dir', default=None,
+                        help="Write one file per shard here instead of merging them to stdout")
+    parser.add_argument('--state-file', dest='state', default=None,
+                        help="State store to resume fetches from (created when missing)")
+    parser.add_argument('components', nargs='+',
+                        help="Sonarqube components/projects")
+    args = parser.parse_args(args)
+
+    fetch_args = {name: getattr(args, name) for name in FETCH_ARGS if getattr(args, name)}
+
+    runner = ShardedRunner(args.components, args.shards, base_url=args.base_url,
+                           category=args.category, tag=args.tag, fetch_args=fetch_args,
+                           output_dir=args.output_dir, rate=args.rate, state=args.state)
+    if args.output_dir:
+        for path in runner.run():
+            print(path)
+    else:
+        for item in runner.items():
+            sys.stdout.write(json.dumps(item, sort_keys=True) + '\n')
+
+    return 1 if runner.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
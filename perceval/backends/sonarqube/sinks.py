@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+"""Output sinks writing items in batches.
+
+Sinks take items one by one, with `write` or by calling them, and
+write them in batches of `batch_size` items, or once they waited
+`flush_interval` seconds, so the cost of each write is shared by the
+whole batch.
+"""
+
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Items written at once, and seconds an item may wait to be written
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5
+
+# Compressions of the file sinks, and the file suffixes implying them
+COMPRESSIONS = ('gzip', 'zstd')
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+
+DEFAULT_INDEX = 'sonarqube'
+DEFAULT_TABLE = 'items'
+
+# Value of the options `open_sink` leaves to their default
+NOT_GIVEN = object()
+
+
+class Sink:
+    """Base of the sinks writing items in batches.
+
+    Subclasses write each batch with `_write_batch` and release their
+    resources with `_close`.
+
+    Pending items are written on a timer thread once they waited
+    `flush_interval` seconds, even when no more items arrive. Batches
+    are written under a lock, so `_write_batch` never runs twice at
+    once, but it may run on the timer thread.
+
+    :param path: path to write the items to
+    :param batch_size: number of items written at once
+    :param flush_interval: seconds after which the pending items are
+        written, even when the batch isn't full; `None` to only write
+        full batches
+    :param clock: callable returning the current time, in seconds
+    """
+
+    # Options taken by the sink, besides the path
+    OPTIONS = ('batch_size', 'flush_interval', 'clock')
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 clock=time.monotonic):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.nitems = 0
+        self.nbatches = 0
+
+        self._batch = []
+        self._flushed_at = self.clock()
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._timer = None
+
+    def write(self, item):
+        """Add an item, writing the batch when it is due."""
+
+        with self._lock:
+            self._batch.append(item)
+            if len(self._batch) >= self.batch_size or self._expired():
+                self.flush()
+            if self._timer is None and self.flush_interval is not None and self.flush_interval > 0:
+                self._timer = threading.Thread(target=self._flush_on_time, daemon=True)
+                self._timer.start()
+
+    def __call__(self, item):
+        self.write(item)
+
+    def flush(self):
+        """Write the pending items."""
+
+        with self._lock:
+            if self._batch:
+                self._write_batch(self._batch)
+                self.nitems += len(self._batch)
+                self.nbatches += 1
+                self._batch = []
+            self._flushed_at = self.clock()
+
+    def close(self):
+        """Write the pending items and close the sink."""
+
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
+        self._close()
+        logger.info("%s items written to %s in %s batches", self.nitems, self.path, self.nbatches)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _expired(self):
+        return self.flush_interval is not None and self.clock() - self._flushed_at >= self.flush_interval
+
+    def _flush_on_time(self):
+        wait = self.flush_interval
+        while not self._closed.wait(max(wait, 0)):
+            with self._lock:
+                if self._closed.is_set():
+                    return
+                if self._expired():
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        # The items are kept, for the next write or close to fail
+                        logger.error("Timed flush of %s failed: %s", self.path, e)
+                        return
+                wait = self.flush_interval - (self.clock() - self._flushed_at)
+
+    def _write_batch(self, items):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class NdjsonSink(Sink):
+    """Write items as JSON lines, optionally compressed.
+
+    Each batch is serialized into a single buffer and written at once.
+
+    :param compression: `gzip`, `zstd` (needs the `zstandard` package)
+        or `None`; guessed from the suffix of the path when not given
+    :param kwargs: see `Sink`
+    """
+
+    OPTIONS = Sink.OPTIONS + ('compression',)
+
+    def __init__(self, path, compression=None, **kwargs):
+        super().__init__(path, **kwargs)
+
+        if compression is None:
+            compression = next((compression for suffix, compression in COMPRESSION_SUFFIXES.items()
+                                if path.endswith(suffix)), None)
+        if compression not in COMPRESSIONS + (None,):
+            raise ValueError('Unknown compression: %s' % compression)
+        self.compression = compression
+
+        self._file = self._open(path, compression)
+
+    @staticmethod
+    def _open(path, compression):
+        if compression == 'gzip':
+            return gzip.open(path, 'wb')
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError('zstd compression needs the zstandard package')
+            return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+        return open(path, 'wb')
+
+    def _lines(self, item):
+        yield item
+
+    def _write_batch(self, items):
+        lines = [json.dumps(line, separators=(',', ':'), sort_keys=True)
+                 for item in items for line in self._lines(item)]
+        self._file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def _close(self):
+        self._file.close()
+
+
+class ElasticBulkSink(NdjsonSink):
+    """Write items as an Elasticsearch bulk request body.
+
+    Each item is indexed by its `uuid` into `index`, so the file can be
+    posted to the `_bulk` endpoint as it is, or in pieces.
+
+    :param index: name of the index
+    :param kwargs: see `NdjsonSink`
+    """
+
+    OPTIONS = NdjsonSink.OPTIONS + ('index',)
+
+    def __init__(self, path, index=DEFAULT_INDEX, **kwargs):
+        self.index = index
+        super().__init__(path, **kwargs)
+
+    def _lines(self, item):
+        yield {'index': {'_index': self.index, '_id': item['uuid']}}
+        yield item
+
+
+class SqliteSink(Sink):
+    """Write items into a SQLite table, one transaction per batch.
+
+    The table holds the `uuid`, `category` and `updated_on` of each item
+    along with the whole item as JSON. Items already written are
+    replaced, so fetches can be written again over the same table.
+
+    :param table: name of the table, created when missing
+    :param kwargs: see `Sink`
+    """
+
+    OPTIONS = Sink.OPTIONS + ('table',)
+
+    def __init__(self, path, table=DEFAULT_TABLE, **kwargs):
+        super().__init__(path, **kwargs)
+        self.table = table
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS "{}" ('
+                         'uuid TEXT PRIMARY KEY, category TEXT, updated_on REAL, item TEXT)'.format(table))
+        self._db.commit()
+
+    def _write_batch(self, items):
+        rows = [(item['uuid'], item.get('category'), item.get('updated_on'),
+                 json.dumps(item, separators=(',', ':'), sort_keys=True))
+                for item in items]
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO "{}" (uuid, category, updated_on, item) '
+                                 'VALUES (?, ?, ?, ?)'.format(self.table), rows)
+
+    def _close(self):
+        self._db.close()
+
+
+SINKS = {
+    'ndjson': NdjsonSink,
+    'es-bulk': ElasticBulkSink,
+    'sqlite': SqliteSink
+}
+
+
+def open_sink(kind, path, **kwargs):
+    """Open a sink by its name in `SINKS`.
+
+    :param kind: name of the sink
+    :param path: path to write the items to
+    :param kwargs: options of the sink; those set to `NOT_GIVEN` take
+        their default value, and those of other kinds of sinks are left
+        out, so callers can pass every option to any kind of sink
+
+    :raises ValueError: when the kind or an option is unknown
+    """
+    try:
+        cls = SINKS[kind]
+    except KeyError:
+        raise ValueError('Unknown sink: %s' % kind)
+
+    known = set(option for sink in SINKS.values() for option in sink.OPTIONS)
+    unknown = set(kwargs) - known
+    if unknown:
+        raise ValueError('Unknown sink options: %s' % ', '.join(sorted(unknown)))
+
+    options = {}
+    for name, value in kwargs.items():
+        if value is NOT_GIVEN:
+            continue
+        if name not in cls.OPTIONS:
+            logger.warning("Option %s ignored by the %s sink", name, kind)
+            continue
+        options[name] = value
+
+    return cls(path, **options)
@@ -22,41 +22,86 @@
 #     Igor Zubiaurre <izubiaurre@bitergia.com>
 #
 
-import configparser
+import collections
+import datetime
+import hashlib
 import json
 import logging
 import os
 
-from grimoirelab_toolkit.datetime import (datetime_to_utc,
-                                          datetime_utcnow)
+from grimoirelab_toolkit.datetime import (InvalidDateError,
+                                          datetime_to_utc,
+                                          datetime_utcnow,
+                                          str_to_datetime)
 from grimoirelab_toolkit.uris import urijoin
 
 from ...backend import (Backend,
                         BackendCommand,
                         BackendCommandArgumentParser,
+                        BackendItemsGenerator,
                         uuid)
-from ...client import HttpClient
-from ...utils import DEFAULT_DATETIME
-from requests.auth import HTTPBasicAuth
-
 CONFIGURATION_FILE = os.path.dirname(os.path.abspath(__file__)) + '/sonarqube.cfg'
 DEFAULT_CATEGORY = 'measures'
 
+# Field of the items holding their category
+CATEGORY_FIELD = 'category'
+
 SONAR_URL = "https://sonarcloud.io/"
 
-# Range before sleeping until rate limit reset
-MIN_RATE_LIMIT = 10
-MAX_RATE_LIMIT = 500
+# Same as `perceval.utils.DEFAULT_DATETIME`; that module imports `requests`
+DEFAULT_DATETIME = datetime.datetime(1970, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+# Time buckets and per metric type reductions of downsampled histories
+HISTORY_RESOLUTIONS = ('day', 'week', 'month')
+MEAN_METRIC_TYPES = ('FLOAT', 'PERCENT')
+RANGE_METRIC_TYPES = ('INT', 'WORK_DUR', 'MILLISEC')
+
+# Fields requested along with flattened measures, and the metric
+# definition fields and value types of the flattened items
+MEASURE_ADDITIONAL_FIELDS = 'periods,metrics'
+METRIC_DEFINITION_FIELDS = ('name', 'type', 'domain', 'direction', 'qualitative', 'description')
+INT_METRIC_TYPES = ('INT', 'WORK_DUR', 'MILLISEC')
+FLOAT_METRIC_TYPES = ('FLOAT', 'PERCENT', 'RATING')
+
+# Items consumed between commits of the fetch state
+STATE_BATCH = 100
+
+# Request parameters (and item fields) selecting a branch or a pull request
+BRANCH_PARAMS = ('branch', 'pullRequest')
 
-PER_PAGE = 100
+# Items of each branch or pull request fetched ahead of the consumer
+BRANCH_BUFFER_ITEMS = 1000
 
-# Default sleep time and retries to deal with connection/server problems
-DEFAULT_SLEEP_TIME = 1
-MAX_RETRIES = 5
+# Fields of the items which don't take part in their digests
+VOLATILE_FIELDS = ('id', 'fetched_on', CATEGORY_FIELD)
 
 
 logger = logging.getLogger(__name__)
 
+# Names of the HTTP client module, kept importable from this one
+CLIENT_NAMES = ('SonarClient', 'BoundedBuffer', 'HTTP2Adapter', 'TRANSPORTS',
+                'ordered_map', 'register_transport', 'pooled_session',
+                'close_pooled_sessions')
+
+# Names of the other modules the backend uses, kept importable from this one
+LAZY_NAMES = {
+    'client': CLIENT_NAMES,
+    'sinks': ('COMPRESSIONS', 'SINKS', 'open_sink'),
+    'state': ('CATEGORY_RECORD', 'StateStore')
+}
+
+
+def __getattr__(name):
+    """Get the names of the modules in `LAZY_NAMES`, importing them on first use."""
+
+    import importlib
+
+    for module, names in LAZY_NAMES.items():
+        if name in names:
+            return getattr(importlib.import_module('.' + module, __package__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 def read_file(filename, mode='r'):
     '''Taken from test_gitlab.
 
@@ -83,12 +128,16 @@ class Sonar(Backend):
         from the Sonar public site.
     :param tag: label used to mark the data
     :param archive: archive to store/retrieve items
+    :param state: `StateStore`, or path to one, remembering what was
+        fetched to resume later fetches from it
     """
-    version = '0.5.0'
+    version = '0.6.0'
 
-    CATEGORIES = ('metric', 'measures', 'history')
+    # Filled in by `register_category`
+    CATEGORIES = ()
+    CATEGORY_REGISTRY = {}
 
-    def __init__(self, component, base_url=SONAR_URL, tag=None, archive=None):
+    def __init__(self, component, base_url=SONAR_URL, tag=None, archive=None, state=None):
         if not component:
             raise MandatoryArgumentMissig('a component.')
         origin = urijoin(base_url, 'api/')
@@ -96,7 +145,12 @@ class Sonar(Backend):
         super().__init__(origin, tag=tag, archive=archive)
         self.base_url = base_url
         self.component = component
-        self.client = SonarClient(component, base_url=base_url, archive=archive)
+        self._client = None
+
+        if isinstance(state, str):
+            from .state import StateStore
+            state = StateStore(state)
+        self.state = state
 
     def fetch(self, **kwargs):
         """Fetch the metrics from the component.
@@ -128,20 +182,102 @@ class Sonar(Backend):
     def fetch_items(self, category, **kwargs):
         """Fetch the metrics
 
+        The items are fetched as declared by the category in
+        `CATEGORY_REGISTRY`, which also sets their id, when it isn't
+        set by the fetcher, and tags them with the category. With a
+        `state`, the checkpoints of the items are recorded as they are
+        consumed (see `_checkpoint`). `buffer_pages` and `buffer_bytes`
+        cap the pages fetched ahead of the consumer (see
+        `SonarClient.pages`). With `preflight`, the component and the
+        metric keys are checked first (see `SonarClient.preflight`).
+
         :param category: the category of items to fetch
         :param kwargs: backend arguments
 
         :returns: a generator of items
         """
-        if category == 'metric':
-            return self._fetch_metrics(**kwargs)
-        elif category == 'measures':
-            return self._fetch_measures(**kwargs)
-        elif category == 'history':
-            return self._fetch_history(**kwargs)
-        else:
+        try:
+            declared = self.CATEGORY_REGISTRY[category]
+        except KeyError:
             raise NotImplementedError
 
+        self.client.buffer_pages = kwargs.get('buffer_pages')
+        self.client.buffer_bytes = kwargs.get('buffer_bytes')
+
+        if kwargs.get('preflight') and not self.client.from_archive:
+            metric_keys = None
+            if declared.metric_keys:
+                metric_keys = self._metric_keys(kwargs)
+            self.client.preflight(metric_keys)
+
+        items = self._tag(declared, declared.fetcher(self)(**kwargs), branch_of(kwargs))
+        if self.state:
+            items = self._checkpoint(declared, items)
+        return items
+
+    @classmethod
+    def register_category(cls, category):
+        """Plug a category of items into the backend.
+
+        :param category: a `SonarCategory`
+        """
+        cls.CATEGORY_REGISTRY = dict(cls.CATEGORY_REGISTRY)
+        cls.CATEGORY_REGISTRY[category.name] = category
+        cls.CATEGORIES = tuple(cls.CATEGORY_REGISTRY)
+
+    def _tag(self, category, items, target=None):
+        """Set the id, when declared by the category, and tag the items.
+
+        Items fetched for a single branch or pull request (`target`)
+        carry it, as those of `_fetch_branches` do, and it takes part
+        in their ids.
+        """
+        label = branch_label(target) if target else None
+
+        for item in items:
+            if category.item_id:
+                item['id'] = category.item_id(self, item)
+            if label:
+                item.update(target)
+                item['id'] = uuid(item['id'], label)
+            item[CATEGORY_FIELD] = category.name
+            yield item
+
+    def _checkpoint(self, category, items):
+        """Record the state of the items once they are consumed.
+
+        An item is recorded when the next one is requested, and the
+        records are committed every `STATE_BATCH` items and when the
+        generator ends or is closed. Records buffered by the fetcher
+        (e.g. analysis dates) are committed with them.
+        """
+        nitems = 0
+        try:
+            for item in items:
+                yield item
+
+                if category.checkpoint and not branch_of(item):
+                    metric, fields = category.checkpoint(self, item)
+                    self.state.put(self.component, category.name, metric, **fields)
+                nitems += 1
+                if nitems % STATE_BATCH == 0:
+                    self.state.commit()
+        finally:
+            self.state.commit()
+
+    def _metric_keys(self, kwargs):
+        """Get the metric keys requested in the arguments, or configured."""
+
+        metric_keys = kwargs.get('metricKeys') or ','.join(self.client.metric_keys_configured_on_client())
+        return metric_keys.split(',')
+
+    def _last_state(self, category):
+        """Get the committed state records of a category, if any."""
+
+        if not self.state:
+            return {}
+        return self.state.get(self.component, category)
+
     def _fetch_metrics(self, **kwargs):
         """Fetch enabled metric keys"""
 
@@ -158,18 +294,64 @@ class Sonar(Backend):
         logger.info("Fetch process completed: %s metric keys fetched", nmetrics)
 
     def _fetch_measures(self, **kwargs):
-        """Fetch current metric values"""
+        """Fetch current metric values
+
+        When `flatten_measures` is set, the periods and the metric
+        definitions are requested along with the values, and each
+        measure is flattened (see `flatten_measures`).
+
+        With a `state`, nothing is fetched when the component wasn't
+        analysed again since the last fetch for the same metric keys and
+        form, the last response ETag is sent along, and only the
+        measures which changed are yielded.
+
+        When `all_branches` is set, the measures of every branch and
+        pull request are fetched too (see `_fetch_branches`).
+        """
         try:
             _ = kwargs['from_date']
         except KeyError as ke:
             kwargs['from_date'] = DEFAULT_DATETIME
 
+        if kwargs.get('all_branches'):
+            yield from self._fetch_branches(self._fetch_measures, 'measures', **kwargs)
+            return
+
+        stateful = self.state and not branch_of(kwargs)
+
         nmetrics = 0
         fetched_on = datetime_utcnow().timestamp()
+
+        flatten = kwargs.get('flatten_measures', False)
+        if flatten:
+            kwargs['additional_fields'] = MEASURE_ADDITIONAL_FIELDS
+
+        last = self._last_state('measures') if stateful else {}
+        if stateful:
+            analysis_date = self.client.analysis_date()
+            query = measure_digest({'metricKeys': sorted(set(self._metric_keys(kwargs))), 'flatten': flatten})
+            from .state import CATEGORY_RECORD
+            record = last.get(CATEGORY_RECORD, {})
+            if record.get('digest') == query:
+                if analysis_date and analysis_date == record.get('analysis_date'):
+                    logger.info("Fetch process skipped: %s not analysed since %s", self.component, analysis_date)
+                    return
+                kwargs['etag'] = record.get('etag')
+
         component_metrics_raw = self.client.measures(**kwargs)
+        if component_metrics_raw is None:
+            logger.info("Fetch process skipped: measures of %s not modified", self.component)
+            component_metrics_raw = {'component': {'key': self.component, 'measures': []}}
 
         component = component_metrics_raw['component']
-        for metric in component['measures']:
+        if flatten:
+            measures = flatten_measures(component_metrics_raw)
+        else:
+            measures = component['measures']
+
+        for metric in measures:
+            if last.get(metric['metric'], {}).get('digest') == measure_digest(metric):
+                continue
 
             id_args = [component['key'], metric['metric'], str(fetched_on)]
             metric['id'] = uuid(*id_args)
@@ -178,32 +360,331 @@ class Sonar(Backend):
             yield metric
             nmetrics += 1
 
+        if stateful:
+            self.state.put(self.component, 'measures', analysis_date=analysis_date,
+                           digest=query, etag=self.client.last_etag)
+
         logger.info("Fetch process completed: %s metrics fetched", nmetrics)
 
     def _fetch_history(self, **kwargs):
-        """Fetch current metric values"""
+        """Fetch current metric values
+
+        When `compact_history` is set, consecutive identical values of
+        each metric are collapsed into interval items (see
+        `HistoryCompactor`) instead of emitting one item per point.
+        When `history_resolution` is set, each metric is reduced to one
+        item per day, week or month (see `HistoryDownsampler`). Pages
+        are reduced as they arrive, so they are never held together.
+
+        With a `state`, points are fetched from the last one recorded
+        and only newer points of each metric are yielded. Histories are
+        fetched whole while any requested metric has no record yet, so
+        metrics added later get their past points; metrics without any
+        point are recorded at the fetch time. Compacted and
+        downsampled histories are always fetched whole, as their open
+        runs and buckets span past points.
+
+        When `all_branches` is set, the histories of every branch and
+        pull request are fetched too (see `_fetch_branches`).
+        """
         try:
             _ = kwargs['from_date']
         except KeyError as ke:
             kwargs['from_date'] = DEFAULT_DATETIME
 
-        nmetrics = 0
+        if kwargs.get('all_branches'):
+            yield from self._fetch_branches(self._fetch_history, 'history', **kwargs)
+            return
+        compact = kwargs.get('compact_history', False)
+        resolution = kwargs.get('history_resolution', None)
+
+        if compact and resolution:
+            raise InvalidArgument('combination: compact_history and history_resolution are exclusive.')
+
+        stateful = self.state and not (compact or resolution or branch_of(kwargs))
+
+        last = {}
+        if stateful:
+            last = self._last_state('history')
+            last = {metric: record['measured_on'] for metric, record in last.items() if record['measured_on']}
+            requested = self._metric_keys(kwargs)
+            if all(metric in last for metric in requested):
+                kwargs['since'] = _parse_date(min(last[metric] for metric in requested))
+
+        reducer = None
+        if compact:
+            reducer = HistoryCompactor()
+            build = self._history_interval
+        elif resolution:
+            reducer = HistoryDownsampler(resolution, self.client.metric_types())
+            build = self._history_bucket
+
+        metrics = set()
+        measured = set()
+        now = datetime_utcnow()
+        fetched_on = now.timestamp()
+
+        for chunk in self.client.history_pages(**kwargs):
+            for metric, history in chunk.items():
+                metrics.add(metric)
+                for measure in history:
+                    if not reducer:
+                        if metric in last and utc_date(measure['date']) <= last[metric]:
+                            continue
+                        measured.add(metric)
+                        yield self._history_point(metric, measure, fetched_on)
+                        continue
+                    closed = reducer.feed(metric, measure)
+                    if closed:
+                        yield build(closed, fetched_on)
+
+        if reducer:
+            for closed in reducer.flush():
+                yield build(closed, fetched_on)
+
+        if stateful:
+            for metric in set(requested) - set(last) - measured:
+                self.state.put(self.component, 'history', metric, measured_on=now.replace(microsecond=0).isoformat())
+
+        nmetrics = len(metrics)
+        logger.info("Fetch process completed: histories for %s metrics fetched", nmetrics)
+
+    def _fetch_branches(self, fetch, category, **kwargs):
+        """Fan out a fetch to every branch and pull request of the component.
+
+        The main branch is fetched first, as usual. Then the other
+        branches and the pull requests, found through
+        `project_branches/list` and `project_pull_requests/list`, are
+        fetched up to `workers` at a time, each one into a `BoundedBuffer`
+        of `BRANCH_BUFFER_ITEMS` items, and yielded one after the other
+        as their items arrive. Their items carry the `branch` or `pullRequest` they
+        belong to, which also takes part in their ids.
+
+        With a `state`, branches and pull requests whose analysis date
+        didn't change since the last fetch are skipped, and their items
+        are never recorded one by one.
+
+        :param fetch: fetcher of the category
+        :param category: name of the category
+        """
+        from .client import BoundedBuffer
+
+        kwargs['all_branches'] = False
+        yield from fetch(**kwargs)
+
+        last = self._last_state(category)
+        targets = []
+        for target, analysis_date in self.client.branches_and_pull_requests():
+            if not target:
+                continue
+            label = branch_label(target)
+            if not analysis_date:
+                logger.debug("%s of %s skipped: never analysed", label, self.component)
+                continue
+            if analysis_date == last.get(label, {}).get('analysis_date'):
+                logger.debug("%s of %s skipped: not analysed since %s", label, self.component, analysis_date)
+                continue
+            targets.append((target, analysis_date))
+
+        workers = self.client._concurrency(kwargs.get('workers', 1))
+        remaining = collections.deque(targets)
+        started = collections.deque()
+        try:
+            while remaining or started:
+                while remaining and (not started or len(started) < workers):
+                    target, analysis_date = remaining.popleft()
+                    items = fetch(**dict(kwargs, **target))
+                    buffer = None
+                    if workers:
+                        buffer = BoundedBuffer(max_items=BRANCH_BUFFER_ITEMS)
+                        items = buffer.start(items)
+                    started.append((target, analysis_date, buffer, items))
+
+                target, analysis_date, buffer, items = started.popleft()
+                label = branch_label(target)
+                for item in items:
+                    item.update(target)
+                    item['id'] = uuid(item['id'], label)
+                    yield item
+
+                if self.state:
+                    self.state.put(self.component, category, label, analysis_date=analysis_date)
+        finally:
+            for target, analysis_date, buffer, items in started:
+                if buffer:
+                    buffer.close()
+
+        logger.info("Fetch process completed: %s branches and pull requests of %s fetched",
+                    len(targets), self.component)
+
+    def _fetch_component_tree(self, **kwargs):
+        """Fetch current metric values of every directory and file
+
+        Items are yielded as each page of the tree arrives, one per
+        measure of each component.
+        """
+        try:
+            _ = kwargs['from_date']
+        except KeyError as ke:
+            kwargs['from_date'] = DEFAULT_DATETIME
+
+        nmeasures = 0
         fetched_on = datetime_utcnow().timestamp()
 
-        histories = self.client.history(**kwargs)
-        for metric, history in histories.items():
-            for measure in history:
-                id_args = [self.component, metric, measure['date']]
-                yield {
-                    'id': uuid(*id_args),
-                    'metric': metric,
-                    'value': measure['value'],
-                    'measured_on': measure['date'],
-                    'fetched_on': fetched_on
-                }
-            nmetrics += 1
+        for page in self.client.component_tree(**kwargs):
+            for component in page['components']:
+                for measure in component.get('measures', []):
+                    id_args = [component['key'], measure['metric'], str(fetched_on)]
+                    item = dict(measure)
+                    item['id'] = uuid(*id_args)
+                    item['component'] = component['key']
+                    item['qualifier'] = component['qualifier']
+                    item['path'] = component.get('path')
+                    item['language'] = component.get('language')
+                    item['fetched_on'] = fetched_on
+
+                    yield item
+                    nmeasures += 1
+
+        logger.info("Fetch process completed: %s component tree measures fetched", nmeasures)
+
+    def _fetch_issues(self, **kwargs):
+        """Fetch the issues created or updated since a given date
+
+        With a `state` and no `from_date`, issues updated since the last
+        recorded update are fetched. Issues don't come in update order,
+        so the latest update is only recorded once every issue has been
+        consumed; a broken fetch is resumed from the previous record.
+        """
+        from_date = kwargs.get('from_date') or DEFAULT_DATETIME
+        if isinstance(from_date, str):
+            from_date = str_to_datetime(from_date)
+        from_date = datetime_to_utc(from_date)
 
-        logger.info("Fetch process completed: histories for %s metrics fetched", nmetrics)
+        from .state import CATEGORY_RECORD
+
+        last = self._last_state('issues').get(CATEGORY_RECORD, {}).get('measured_on')
+        if last and from_date == DEFAULT_DATETIME:
+            from_date = _parse_date(last)
+        # A window starting after the record would leave a gap behind it
+        resumable = not last or from_date <= _parse_date(last)
+
+        issues = self.client.issues(from_date=from_date, workers=kwargs.get('workers') or 1)
+
+        latest = None
+        for issue in self._stream(issues, 'issues'):
+            yield issue
+            updated_on = utc_date(issue['updateDate'])
+            latest = max(latest or updated_on, updated_on)
+
+        if self.state and resumable and latest:
+            self.state.put(self.component, 'issues', measured_on=latest)
+
+    def _fetch_hotspots(self, **kwargs):
+        """Fetch the security hotspots"""
+
+        pages = self.client.hotspots(prefetch=kwargs.get('prefetch') or 0)
+        hotspots = (hotspot for page in pages for hotspot in page['hotspots'])
+
+        return self._stream(hotspots, 'hotspots')
+
+    def _fetch_duplications(self, **kwargs):
+        """Fetch the groups of duplicated blocks
+
+        A group is listed by every file it spans, but it is only yielded
+        from the first one (see `_duplication_id`).
+        """
+        seen = set()
+
+        def _groups():
+            for key, response in self.client.duplications(prefetch=kwargs.get('prefetch') or 0):
+                files = response.get('files', {})
+                for duplication in response.get('duplications', []):
+                    blocks = []
+                    for block in duplication['blocks']:
+                        blocks.append({
+                            'file': files.get(block['_ref'], {}).get('key', key),
+                            'from': block['from'],
+                            'size': block['size']
+                        })
+                    group = {'file': key, 'blocks': blocks}
+                    group_id = self._duplication_id(group)
+                    if group_id not in seen:
+                        seen.add(group_id)
+                        yield group
+
+        return self._stream(_groups(), 'duplication groups')
+
+    def _duplication_id(self, group):
+        """Id of a group of duplicated blocks.
+
+        It only depends on the blocks, so every copy of the group fetched
+        from the files it spans gets the same one.
+        """
+        spans = sorted('{}:{}:{}'.format(b['file'], b['from'], b['size']) for b in group['blocks'])
+        return uuid(self.component, *spans)
+
+    def _stream(self, items, name):
+        """Stream raw items as they come, adding their fetch time.
+
+        :param items: iterable of raw items
+        :param name: name of the items, for logging
+        :returns: a generator of items
+        """
+        nitems = 0
+        fetched_on = datetime_utcnow().timestamp()
+
+        for item in items:
+            item['fetched_on'] = fetched_on
+
+            yield item
+            nitems += 1
+
+        logger.info("Fetch process completed: %s %s fetched", nitems, name)
+
+    def _history_point(self, metric, measure, fetched_on):
+        """Build a history item out of a single point."""
+
+        id_args = [self.component, metric, measure['date']]
+        return {
+            'id': uuid(*id_args),
+            'metric': metric,
+            'value': measure['value'],
+            'measured_on': measure['date'],
+            'fetched_on': fetched_on
+        }
+
+    def _history_interval(self, run, fetched_on):
+        """Build a history item out of a compacted run of values.
+
+        The item id matches the one of the point which opens the run,
+        so a run that keeps growing is updated in place across fetches.
+        """
+        id_args = [self.component, run['metric'], run['first_date']]
+        return {
+            'id': uuid(*id_args),
+            'metric': run['metric'],
+            'value': run['value'],
+            'measured_on': run['first_date'],
+            'first_date': run['first_date'],
+            'last_date': run['last_date'],
+            'count': run['count'],
+            'fetched_on': fetched_on
+        }
+
+    def _history_bucket(self, bucket, fetched_on):
+        """Build a history item out of a downsampled time bucket.
+
+        The item is measured on the last date of the bucket, while its id
+        only depends on the bucket, so a bucket still open when fetched is
+        updated in place by later fetches.
+        """
+        id_args = [self.component, bucket['metric'], bucket['resolution'], bucket['bucket']]
+        item = dict(bucket)
+        item['id'] = uuid(*id_args)
+        item['measured_on'] = bucket['last_date']
+        item['fetched_on'] = fetched_on
+        return item
 
     @classmethod
     def has_archiving(cls):
@@ -227,171 +708,306 @@ class Sonar(Backend):
 
         return str(item['id'])
 
-    @staticmethod
-    def metadata_updated_on(item):
+    @classmethod
+    def metadata_updated_on(cls, item):
         """Extracts the update time from a Sonarqube item.
 
-        The timestamp is based on the current time when the metric was extracted.
-        This field is not part of the data provided by Sonarqube API. It is added
-        by this backend.
+        The timestamp is taken from the incremental cursor declared by
+        the category of the item (e.g. the last update of issues), so
+        incremental fetches resume from it. Without cursor, it is based
+        on the current time when the metric was extracted. This field is
+        not part of the data provided by Sonarqube API. It is added by
+        this backend.
 
         :param item: item generated by the backend
 
         :returns: a UNIX timestamp
         """
+        category = cls.CATEGORY_REGISTRY.get(cls.metadata_category(item))
+        cursor = category.cursor if category else None
+        if cursor and cursor in item:
+            return str_to_datetime(item[cursor]).timestamp()
         return item['fetched_on']
 
     @staticmethod
     def metadata_category(item):
-        """Extracts the category from a Sonarqube item."""
+        """Extracts the category from a Sonarqube item.
+
+        Items fetched before they were tagged with their category, which
+        can only be metrics, measures or histories, get it guessed from
+        their fields.
+        """
         METRIC_KEY = ('key', 'type', 'name', 'description', 'domain', 'direction', 'qualitative', 'hidden', 'custom')
         CURRENT_METRIC = ('metric', 'value', 'bestValue')
 
-        if all(key in item.keys() for key in (METRIC_KEY)):
+        if CATEGORY_FIELD in item:
+            return item[CATEGORY_FIELD]
+        elif all(key in item.keys() for key in (METRIC_KEY)):
             return 'metric'
         elif all(key in item.keys() for key in (CURRENT_METRIC)):
             return 'measures'
         else:
             return 'history'
 
+    @property
+    def client(self):
+        """Client of the backend, built on first use.
+
+        Building it imports the HTTP stack and reads the configuration,
+        which the command line doesn't need until items are fetched.
+        """
+        if self._client is None:
+            self._client = self._init_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
     def _init_client(self, from_archive=False):
-        """Init client"""
+        """Init client
+
+        The client is kept across fetches using the same archive, so
+        its sessions and caches (e.g. metric types) stay warm.
+        """
+        client = self._client
+        archive = getattr(client, 'archive', None)
+        if client is not None and getattr(archive, 'archive', archive) is self.archive \
+                and client.from_archive == from_archive:
+            return client
+
+        from .client import SonarClient
 
         return SonarClient(self.component, self.base_url, self.archive, from_archive)
 
 
-class SonarClient(HttpClient):
-    """Client for retrieving information from Sonarqube API
+class SonarCategory:
+    """Declares how a category of items is fetched from Sonarqube.
+
+    :param name: name of the category
+    :param fetch: name of the `Sonar` method, or callable taking the
+        backend, returning the generator of items out of the backend
+        arguments
+    :param item_id: callable returning the id of an item out of the
+        backend and the item; `None` when it is set by `fetch`
+    :param cursor: field of the items holding their last update, to
+        resume incremental fetches; `None` for the fetch time
+    :param checkpoint: callable returning the state record of an item
+        out of the backend and the item, as a (metric, dict of
+        `StateStore` fields) pair; `None` when items aren't recorded
+    :param metric_keys: whether the items are fetched for the metric
+        keys given in `metricKeys`, or configured
+    """
 
-    :param component: Sonar component (ie project)
-    :param base_url: Sonar URL in enterprise edition case;
-        when no value is set the backend will be fetch the data
-        from the Sonar public site.
-    :param archive: archive to store/retrieve items
+    def __init__(self, name, fetch, item_id=None, cursor=None, checkpoint=None, metric_keys=False):
+        self.name = name
+        self.fetch = fetch
+        self.item_id = item_id
+        self.cursor = cursor
+        self.checkpoint = checkpoint
+        self.metric_keys = metric_keys
+
+    def fetcher(self, backend):
+        """Get the callable fetching the items with a given backend."""
+
+        if callable(self.fetch):
+            return lambda **kwargs: self.fetch(backend, **kwargs)
+        return getattr(backend, self.fetch)
+
+
+Sonar.register_category(SonarCategory('metric', '_fetch_metrics'))
+Sonar.register_category(SonarCategory('measures', '_fetch_measures',
+                                      metric_keys=True,
+                                      checkpoint=lambda backend, item: (item['metric'],
+                                                                        {'digest': measure_digest(item)})))
+Sonar.register_category(SonarCategory('history', '_fetch_history',
+                                      metric_keys=True,
+                                      checkpoint=lambda backend, item: (item['metric'],
+                                                                        {'measured_on': utc_date(item['measured_on'])})))
+Sonar.register_category(SonarCategory('component_tree', '_fetch_component_tree',
+                                      metric_keys=True))
+Sonar.register_category(SonarCategory('issues', '_fetch_issues',
+                                      item_id=lambda backend, item: item['key'],
+                                      cursor='updateDate'))
+Sonar.register_category(SonarCategory('hotspots', '_fetch_hotspots',
+                                      item_id=lambda backend, item: item['key'],
+                                      cursor='updateDate'))
+Sonar.register_category(SonarCategory('duplications', '_fetch_duplications',
+                                      item_id=lambda backend, item: backend._duplication_id(item)))
+
+
+def measure_digest(measure):
+    """Digest of a measure, leaving aside the fields set on fetching."""
+
+    content = {k: v for k, v in measure.items() if k not in VOLATILE_FIELDS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def flatten_measures(response):
+    """Flatten the measures of a `measures/component` response.
+
+    The response must carry the periods and metric definitions asked
+    for with `additionalFields=periods,metrics`. Each measure becomes a
+    flat item with its value and the value of its first (new code)
+    period, typed after the metric type, along with the period and the
+    metric definition, all taken from the same response.
+
+    :param response: decoded `measures/component` response
+    :returns: a generator of flattened measures
     """
+    definitions = {metric['key']: metric for metric in response.get('metrics', [])}
 
-    RATE_LIMIT_HEADER = "RateLimit-Remaining"
-    RATE_LIMIT_RESET_HEADER = "RateLimit-Reset"
+    # Older versions list the periods; newer ones only give the first
+    period = response.get('period') or (response.get('periods') or [{}])[0]
 
-    _users = {}       # users cache
+    for measure in response['component']['measures']:
+        definition = definitions.get(measure['metric'], {})
+        metric_type = definition.get('type')
 
-    def __init__(self, component, base_url=SONAR_URL, archive=None, from_archive=False, config=CONFIGURATION_FILE):
-        self.component = component
+        measure_period = measure.get('period') or (measure.get('periods') or [{}])[0]
 
-        logger.info("Reading sonarqube backend configuration from %s", config)
-        configuration = configparser.RawConfigParser()
-        configuration.read( config )
+        item = {
+            'metric': measure['metric'],
+            'value': typed_value(measure.get('value'), metric_type),
+            'best_value': measure.get('bestValue'),
+            'period_index': measure_period.get('index', period.get('index')),
+            'period_mode': period.get('mode'),
+            'period_date': period.get('date'),
+            'period_parameter': period.get('parameter'),
+            'period_value': typed_value(measure_period.get('value'), metric_type),
+            'period_best_value': measure_period.get('bestValue')
+        }
+        for field in METRIC_DEFINITION_FIELDS:
+            item['metric_' + field] = definition.get(field)
 
-        try:
-            ssl_verify_text = configuration.get( 'connection' , 'SSL_VERIFY' )
-            self.ssl_verify = not ssl_verify_text.lower() in ('false', 'no', 'n')
-        except configparser.NoSectionError:
-            self.ssl_verify = True
-        except configparser.NoOptionError:
-            self.ssl_verify = True
+        yield item
 
-        try:
-            token = configuration.get( 'connection' , 'API_TOKEN' )
-            self.auth = HTTPBasicAuth(token, '')
-        except configparser.NoSectionError:
-            self.auth = None
-        except configparser.NoOptionError:
-            self.auth = None
 
-        base_url = urijoin(base_url, 'api')
+def typed_value(value, metric_type):
+    """Convert a measure value, given as a string, after its metric type.
 
-        super().__init__(base_url, sleep_time=DEFAULT_DATETIME, max_retries=MAX_RETRIES,
-                         archive=archive, from_archive=from_archive,
-                         ssl_verify=self.ssl_verify)
+    Values of unknown types, or which can't be converted, are returned
+    as they are.
+    """
+    if value is None:
+        return None
+    try:
+        if metric_type in INT_METRIC_TYPES:
+            return int(value)
+        if metric_type in FLOAT_METRIC_TYPES:
+            return float(value)
+    except ValueError:
+        return value
+    if metric_type == 'BOOL':
+        return value == 'true'
+    return value
 
-    def metric_keys_configured_on_client(self):
-        """Get list of metric keys configured for the client.
 
-        :returns: a list of metrics
-        """
-        config = configparser.RawConfigParser()
-        config.read( CONFIGURATION_FILE )
-        metric_list = config.get( 'sonarqube' , 'TARGET_METRIC_FIELDS' )
-        return metric_list.split(',')
+def branch_of(item):
+    """Get the branch or pull request parameters of an item, or of fetch arguments."""
 
-    def metrics_configured_on_server(self):
-        """Get list of metric keys enabled on the Sonarqube instance.
+    return {param: item[param] for param in BRANCH_PARAMS if item.get(param)}
 
-        :returns: a generator of metric keys
-        """
-        endpoint = self.base_url + '/metrics/search'
-        response = super().fetch(endpoint, auth=self.auth)
-        return response.json()
 
-    def measures(self, **kwargs):
-        """Get metrics for a given component.
+def branch_label(target):
+    """Label of a branch or pull request, as recorded in the state."""
 
-        :param from_date: obtain metrics updated since this date. Not implemented yet.
-        :returns: a generator of metrics
-        """
-        try:
-            metricKeys = kwargs['metricKeys']
-        except KeyError as ke:
-            metricKeys = ','.join(self.metric_keys_configured_on_client())
-        endpoint = '{b}/measures/component?component={c}&metricKeys={k}'
-        endpoint = endpoint.format(b=self.base_url, c=self.component, k=metricKeys)
+    return ','.join('{}:{}'.format(param, value) for param, value in sorted(target.items()))
 
-        response = super().fetch(endpoint, auth=self.auth)
-        return response.json()
 
-    def history(self, **kwargs):
-        """Get histories of metrics for a given component.
+def utc_date(date):
+    """Normalize a Sonarqube date to UTC, so dates compare as strings.
 
-        :param from_date: obtain metrics updated since this date. Not implemented yet.
-        :returns: a generator of measures
-        """
-        fetch = super().fetch
-        page_size = 50
-
-        def _format(measures):
-            '''Formats the histories of measures for easier accumulation.'''
-            output = {}
-            for metric in measures:
-                key = metric['metric']
-                output[key] = metric['history']
-            return output
-
-        def _get_page(page):
-            global page_size
-            pager = '&ps={s}&p={p}'.format(s=page_size,p=page) if page > 1 else ''
-            response = fetch(endpoint + pager, auth=self.auth)
-            aux = response.json()
-            response.close()
-            page_size = int(aux['paging']['pageSize'])
-            return aux['paging'], _format(aux['measures'])
+    Dates which can't be parsed are returned as they are.
+    """
+    try:
+        return datetime_to_utc(str_to_datetime(date)).isoformat()
+    except InvalidDateError:
+        return date
 
-        try:
-            metricKeys = kwargs['metricKeys']
-        except KeyError as ke:
-            metricKeys = ','.join(self.metric_keys_configured_on_client())
-        endpoint = '{b}/measures/search_history?component={c}&metrics={k}'
-        endpoint = endpoint.format(b=self.base_url, c=self.component, k=metricKeys)
-
-        page = 1
-        paging, output = _get_page(page)
-        while paging['pageIndex'] * paging['pageSize'] < paging['total']:
-            page = page + 1
-            paging, chunk = _get_page(page)
-            for metric, history in chunk.items():
-                output[metric].extend(history)
 
-        return output
+def _seconds_or_none(value):
+    """Parse a number of seconds, or `none`."""
+
+    return None if value.lower() == 'none' else float(value)
+
+
+def _parse_date(date):
+    """Parse a date normalized by `utc_date`."""
+
+    try:
+        return datetime_to_utc(str_to_datetime(date))
+    except InvalidDateError:
+        return DEFAULT_DATETIME
 
 
 class SonarCommand(BackendCommand):
-    """Class to run Sonaqube backend from the command line."""
+    """Class to run Sonaqube backend from the command line.
+
+    With `--sink`, items are written in batches to a sink (see `sinks`)
+    instead of one by one to the output.
+    """
 
     BACKEND = Sonar
 
+    # Arguments of the sinks, left out of the backend arguments
+    SINK_ARGS = ('sink', 'sink_path', 'sink_batch_size', 'sink_flush_interval',
+                 'sink_compression', 'sink_index', 'sink_table')
+
+    def _post_init(self):
+        """Set the sink arguments apart."""
+
+        self.sink_args = {}
+        for name in self.SINK_ARGS:
+            self.sink_args[name] = getattr(self.parsed_args, name, None)
+            if hasattr(self.parsed_args, name):
+                delattr(self.parsed_args, name)
+
+        if self.sink_args['sink'] and not self.sink_args['sink_path']:
+            raise InvalidArgument('combination: --sink needs --sink-path.')
+
+    def run(self):
+        """Fetch and write items, to the sink when one is given.
+
+        See `BackendCommand.run`.
+        """
+        if not self.sink_args['sink']:
+            return super().run()
+
+        backend_args = vars(self.parsed_args)
+        category = backend_args.pop('category', None)
+        filter_classified = backend_args.pop('filter_classified', False)
+        fetch_archive = self.archive_manager and self.parsed_args.fetch_archive
+        archived_since = backend_args.pop('archived_since', None)
+
+        from .sinks import open_sink
+
+        sink = open_sink(self.sink_args['sink'], self.sink_args['sink_path'],
+                         batch_size=self.sink_args['sink_batch_size'],
+                         flush_interval=self.sink_args['sink_flush_interval'],
+                         compression=self.sink_args['sink_compression'],
+                         index=self.sink_args['sink_index'],
+                         table=self.sink_args['sink_table'])
+
+        with BackendItemsGenerator(self.BACKEND, backend_args, category,
+                                   filter_classified=filter_classified,
+                                   manager=self.archive_manager,
+                                   fetch_archive=fetch_archive,
+                                   archived_after=archived_since) as big, sink:
+            try:
+                for item in big.items:
+                    sink.write(item)
+
+                self._log_summary(big.summary)
+            except Exception as e:
+                logger.exception(f"Error!: {e}", exc_info=self.debug)
+
     @classmethod
     def setup_cmd_parser(cls):
         """Returns the Sonarqube argument parser."""
 
+        from .sinks import COMPRESSIONS, NOT_GIVEN, SINKS
+
         parser = BackendCommandArgumentParser(cls.BACKEND,
                                               from_date=True,
                                               archive=True)
@@ -406,6 +1022,63 @@ class SonarCommand(BackendCommand):
                            type=str, default=None,
                            help="Comma-separated list of Sonarqube metrics to fetch")
 
+        group.add_argument('--all-branches', dest='all_branches',
+                           action='store_true',
+                           help="Fetch measures and histories of every branch and pull request too")
+        group.add_argument('--flatten-measures', dest='flatten_measures',
+                           action='store_true',
+                           help="Flatten measures with typed values, periods and metric definitions")
+
+        history = group.add_mutually_exclusive_group()
+        history.add_argument('--compact-history', dest='compact_history',
+                             action='store_true',
+                             help="Collapse repeated history values into intervals")
+        history.add_argument('--history-resolution', dest='history_resolution',
+                             choices=HISTORY_RESOLUTIONS, default=None,
+                             help="Reduce histories to one value per day, week or month")
+        group.add_argument('--prefetch', dest='prefetch',
+                           type=int, default=0,
+                           help="Number of pages (or files) to request ahead concurrently")
+        group.add_argument('--workers', dest='workers',
+                           type=int, default=1,
+                           help="Number of issue time slices, or of branches and pull requests, to fetch concurrently")
+        group.add_argument('--buffer-pages', dest='buffer_pages',
+                           type=int, default=None,
+                           help="Maximum number of pages fetched ahead of the consumer")
+        group.add_argument('--buffer-bytes', dest='buffer_bytes',
+                           type=int, default=None,
+                           help="Maximum size in bytes of the pages fetched ahead of the consumer")
+        group.add_argument('--preflight', dest='preflight',
+                           action='store_true',
+                           help="Check the component and metric keys before fetching (results cached on disk)")
+        group.add_argument('--state-file', dest='state',
+                           default=None,
+                           help="State store to resume fetches from (created when missing)")
+
+        # Sink options
+        sinks = parser.parser.add_argument_group('Sink arguments')
+        sinks.add_argument('--sink', dest='sink',
+                           choices=tuple(SINKS), default=None,
+                           help="Write items in batches to this kind of sink instead of the output")
+        sinks.add_argument('--sink-path', dest='sink_path',
+                           default=None,
+                           help="File the sink writes to")
+        sinks.add_argument('--sink-batch-size', dest='sink_batch_size',
+                           type=int, default=NOT_GIVEN,
+                           help="Number of items written at once")
+        sinks.add_argument('--sink-flush-interval', dest='sink_flush_interval',
+                           type=_seconds_or_none, default=NOT_GIVEN,
+                           help="Seconds after which pending items are written; 'none' to only write full batches")
+        sinks.add_argument('--sink-compression', dest='sink_compression',
+                           choices=COMPRESSIONS, default=NOT_GIVEN,
+                           help="Compression of ndjson and es-bulk sinks (guessed from .gz/.zst suffixes)")
+        sinks.add_argument('--sink-index', dest='sink_index',
+                           default=NOT_GIVEN,
+                           help="Index of the es-bulk sink")
+        sinks.add_argument('--sink-table', dest='sink_table',
+                           default=NOT_GIVEN,
+                           help="Table of the sqlite sink")
+
         # Positional arguments
         parser.parser.add_argument('component',
                                    help="Sonarqube component/project")
@@ -413,6 +1086,203 @@ class SonarCommand(BackendCommand):
         return parser
 
 
+class HistoryCompactor:
+    """Collapses runs of identical values in metric histories.
+
+    Points are fed in date order for each metric, either metric by
+    metric or interleaved. A run is closed when its metric takes a
+    different value; runs still open are returned by `flush`. Memory
+    use is bounded by the number of metrics, not by the number of points.
+    """
+
+    def __init__(self):
+        self._runs = {}
+
+    def feed(self, metric, point):
+        """Add a `{'date':..., 'value':...}` point of a metric.
+
+        :returns: the run closed by this point, if any; None otherwise
+        """
+        value = point.get('value')
+        run = self._runs.get(metric)
+        if run and run['value'] == value:
+            run['last_date'] = point['date']
+            run['count'] += 1
+            return None
+
+        self._runs[metric] = {
+            'metric': metric,
+            'value': value,
+            'first_date': point['date'],
+            'last_date': point['date'],
+            'count': 1
+        }
+        return run
+
+    def flush(self):
+        """Close and return all the open runs."""
+        runs = list(self._runs.values())
+        self._runs = {}
+        return runs
+
+
+class HistoryDownsampler:
+    """Reduces metric histories to one value per day, week or month.
+
+    Points are fed in date order for each metric, either metric by
+    metric or interleaved. Buckets are labelled after the local date of
+    the analyses (`2022-01-31`, `2022-W05`, `2022-01`). The value of a
+    bucket depends on the type of its metric: the mean for FLOAT and
+    PERCENT metrics, the last value together with the minimum and
+    maximum for INT, WORK_DUR and MILLISEC metrics and the last value
+    for any other type. Values of those metrics which aren't numbers
+    are left out of the mean and the range. Only one open bucket per
+    metric is kept.
+
+    :param resolution: one of `HISTORY_RESOLUTIONS`
+    :param metric_types: dict of metric types by metric key
+    """
+
+    def __init__(self, resolution, metric_types=None):
+        if resolution not in HISTORY_RESOLUTIONS:
+            raise InvalidArgument('history resolution {}.'.format(resolution))
+
+        self.resolution = resolution
+        self.metric_types = metric_types or {}
+        self._buckets = {}
+
+    def bucket(self, date):
+        """Get the label of the bucket a date falls in."""
+
+        day = date[:10]
+        if self.resolution == 'day':
+            return day
+        elif self.resolution == 'month':
+            return day[:7]
+
+        year, week, _ = datetime.date.fromisoformat(day).isocalendar()
+        return '{}-W{:02d}'.format(year, week)
+
+    def feed(self, metric, point):
+        """Add a `{'date':..., 'value':...}` point of a metric.
+
+        Points without a value are skipped.
+
+        :returns: the bucket closed by this point, if any; None otherwise
+        """
+        value = point.get('value')
+        if value is None:
+            return None
+
+        label = self.bucket(point['date'])
+        state = self._buckets.get(metric)
+        if state and state['bucket'] == label:
+            self._update(state, point['date'], value)
+            return None
+
+        self._buckets[metric] = {
+            'metric': metric,
+            'bucket': label,
+            'first_date': point['date'],
+            'count': 0,
+            'numbers': 0,
+            'sum': 0.0,
+            'last': None,
+            'min': None,
+            'max': None
+        }
+        self._update(self._buckets[metric], point['date'], value)
+
+        return self._close(state) if state else None
+
+    def flush(self):
+        """Close and return all the open buckets."""
+
+        buckets = [self._close(state) for state in self._buckets.values()]
+        self._buckets = {}
+        return buckets
+
+    def _update(self, state, date, value):
+        state['last_date'] = date
+        state['value'] = value
+        state['count'] += 1
+
+        if self.metric_types.get(state['metric']) in MEAN_METRIC_TYPES + RANGE_METRIC_TYPES:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                logger.debug("Value %s of %s on %s isn't a number", value, state['metric'], date)
+                return
+            state['numbers'] += 1
+            state['sum'] += number
+            state['last'] = number
+            state['min'] = number if state['min'] is None else min(state['min'], number)
+            state['max'] = number if state['max'] is None else max(state['max'], number)
+
+    def _close(self, state):
+        metric_type = self.metric_types.get(state['metric'])
+        bucket = {
+            'metric': state['metric'],
+            'resolution': self.resolution,
+            'bucket': state['bucket'],
+            'first_date': state['first_date'],
+            'last_date': state['last_date'],
+            'count': state['count'],
+            'value': state['value']
+        }
+        if metric_type in MEAN_METRIC_TYPES and state['numbers']:
+            bucket['value'] = state['sum'] / state['numbers']
+        elif metric_type in RANGE_METRIC_TYPES and state['numbers']:
+            bucket['value'] = state['last']
+        if metric_type in MEAN_METRIC_TYPES + RANGE_METRIC_TYPES:
+            bucket['min'] = state['min']
+            bucket['max'] = state['max']
+        return bucket
+
+
+def expand_history(component, items, dates=None):
+    """Expand compacted history items back into point items.
+
+    Only the first and last dates of a run are kept when compacting.
+    Given the analysis dates of the component, in chronological order,
+    one point is rebuilt for every date within each run; otherwise the
+    first and last points of each run are rebuilt. Any other history
+    items are passed through unchanged.
+
+    :param component: Sonar component the items were fetched from
+    :param items: history items, as yielded by `Sonar.fetch_items`
+    :param dates: optional sequence of analysis dates of the component
+    :returns: a generator of point history items
+    """
+    if dates is not None:
+        dates = list(dates)
+        position = {date: index for index, date in enumerate(dates)}
+
+    for item in items:
+        if 'count' not in item or 'bucket' in item:
+            yield item
+            continue
+
+        if dates is None:
+            measured = [item['first_date']]
+            if item['count'] > 1:
+                measured.append(item['last_date'])
+        else:
+            first = position[item['first_date']]
+            last = position[item['last_date']]
+            measured = dates[first:last + 1]
+
+        for date in measured:
+            yield {
+                'id': uuid(component, item['metric'], date),
+                'metric': item['metric'],
+                'value': item['value'],
+                'measured_on': date,
+                'fetched_on': item['fetched_on'],
+                CATEGORY_FIELD: 'history'
+            }
+
+
 class UsageError(Exception):
     '''Abstract exception for marking exceptions caused by wrong usage.'''
     def __init__(self, message=''):
@@ -425,3 +1295,10 @@ class MandatoryArgumentMissig( UsageError ):
         ERR_MESSAGE = 'Tried to init a SonarClient without {}'
         if details:
             super().__init__( ERR_MESSAGE.format(details) )
+
+
+class InvalidArgument( UsageError ):
+    '''A call was made with an invalid argument or combination of arguments.'''
+    def __init__(self, details=''):
+        ERR_MESSAGE = 'Invalid {}'
+        super().__init__( ERR_MESSAGE.format(details) )
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Fields kept for each component, category and metric
+STATE_FIELDS = ('measured_on', 'analysis_date', 'digest', 'etag')
+
+# Metric of the records about a whole category of a component
+CATEGORY_RECORD = ''
+
+# Seconds to wait for a store locked by another process
+BUSY_TIMEOUT = 30
+
+
+class StateStore:
+    """Remembers what was last fetched, to resume fetches.
+
+    It is a SQLite database with one record per component, category
+    and metric (`CATEGORY_RECORD` for the records of the whole
+    category). A record holds the last `measured_on` date, the last
+    analysis date, the digest of the last measure seen and the ETag
+    of the last response.
+
+    Updates are buffered with `put` and written in a single transaction
+    by `commit`, so a crash never leaves half a batch behind. Several
+    processes can share the same file.
+
+    :param path: path of the database, created when missing
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state (
+            component TEXT NOT NULL,
+            category TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            measured_on TEXT,
+            analysis_date TEXT,
+            digest TEXT,
+            etag TEXT,
+            PRIMARY KEY (component, category, metric)
+        )
+    """
+
+    # `measured_on` only moves forward; other fields keep their last value
+    UPSERT = """
+        INSERT INTO state (component, category, metric, measured_on, analysis_date, digest, etag)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (component, category, metric) DO UPDATE SET
+            measured_on = CASE WHEN measured_on IS NULL OR excluded.measured_on > measured_on
+                               THEN coalesce(excluded.measured_on, measured_on)
+                               ELSE measured_on END,
+            analysis_date = coalesce(excluded.analysis_date, analysis_date),
+            digest = coalesce(excluded.digest, digest),
+            etag = coalesce(excluded.etag, etag)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(self.SCHEMA)
+
+    def get(self, component, category):
+        """Get the committed records of a component and category.
+
+        :returns: a dict of records, as dicts of fields, by metric
+        """
+        query = 'SELECT metric, {} FROM state WHERE component = ? AND category = ?'
+        query = query.format(', '.join(STATE_FIELDS))
+
+        with self._lock:
+            rows = self._db.execute(query, (component, category)).fetchall()
+
+        return {row[0]: dict(zip(STATE_FIELDS, row[1:])) for row in rows}
+
+    def put(self, component, category, metric=CATEGORY_RECORD, **fields):
+        """Buffer an update of a record until the next commit.
+
+        Fields not given, or given as `None`, keep their stored value.
+        """
+        unknown = set(fields) - set(STATE_FIELDS)
+        if unknown:
+            raise ValueError('Unknown state fields: %s' % ', '.join(sorted(unknown)))
+
+        key = (component, category, metric)
+        with self._lock:
+            record = self._pending.setdefault(key, dict.fromkeys(STATE_FIELDS))
+            for field, value in fields.items():
+                if value is None:
+                    continue
+                if field == 'measured_on' and record[field] and record[field] >= value:
+                    continue
+                record[field] = value
+
+    def commit(self):
+        """Write the buffered updates in a single transaction."""
+
+        with self._lock:
+            if not self._pending:
+                return
+            rows = [key + tuple(record[field] for field in STATE_FIELDS)
+                    for key, record in self._pending.items()]
+            with self._db:
+                self._db.executemany(self.UPSERT, rows)
+            self._pending = {}
+
+        logger.debug("State of %s records committed to %s", len(rows), self.path)
+
+    def rollback(self):
+        """Drop the buffered updates."""
+
+        with self._lock:
+            self._pending = {}
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+import argparse
+import heapq
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+from grimoirelab_toolkit.datetime import InvalidDateError, str_to_datetime
+
+from .sonarqube import (DEFAULT_CATEGORY,
+                        SONAR_URL,
+                        Sonar)
+from .state import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Seconds between polls of a component
+DEFAULT_INTERVAL = 300
+
+# Components analysed within HOT_WINDOW seconds are polled HOT_FACTOR
+# times more often; those not analysed for DORMANT_WINDOW seconds,
+# DORMANT_FACTOR times less often
+HOT_WINDOW = 24 * 3600
+HOT_FACTOR = 4
+DORMANT_WINDOW = 30 * 24 * 3600
+DORMANT_FACTOR = 4
+
+# Fraction of the interval polls are randomly moved by
+DEFAULT_JITTER = 0.1
+
+
+def stdout_sink(item):
+    """Write an item to the standard output as a JSON line."""
+
+    sys.stdout.write(json.dumps(item, sort_keys=True) + '\n')
+    sys.stdout.flush()
+
+
+class Watcher:
+    """Poll a list of components on a schedule, from a single process.
+
+    One `Sonar` backend is kept per component, and with it its client,
+    so sessions and metric caches stay warm between polls. A poll asks
+    for the last analysis of the component and, when it changed since
+    the previous poll, fetches the items of `category` and passes them
+    to the `sink`.
+
+    The next poll of a component is scheduled after its interval,
+    shortened for components analysed within `hot_window` seconds and
+    stretched for those not analysed for `dormant_window` seconds, and
+    moved by up to `jitter` times the interval, so polls spread out.
+
+    :param components: list of Sonar components, or dict of intervals
+        (in seconds) by component
+    :param base_url: Sonar URL
+    :param category: category of the items to fetch
+    :param interval: seconds between polls of the components without
+        their own interval
+    :param hot_interval: seconds between polls of hot components;
+        `HOT_FACTOR` times shorter than the interval by default
+    :param dormant_interval: seconds between polls of dormant components;
+        `DORMANT_FACTOR` times longer than the interval by default
+    :param hot_window: seconds since the last analysis of hot components
+    :param dormant_window: seconds since the last analysis of dormant components
+    :param jitter: fraction of the interval polls are randomly moved by
+    :param sink: callable taking each item; `stdout_sink` by default
+    :param tag: label used to mark the data
+    :param fetch_args: dict of extra arguments for `Sonar.fetch`
+    :param state: `StateStore`, or path to one, shared by the backends
+    :param clock: callable returning the current time, in seconds
+    :param sleep: callable waiting a number of seconds; returns `True`
+        when the watch must stop
+    """
+
+    def __init__(self, components, base_url=SONAR_URL, category=DEFAULT_CATEGORY,
+                 interval=DEFAULT_INTERVAL, hot_interval=None, dormant_interval=None,
+                 hot_window=HOT_WINDOW, dormant_window=DORMANT_WINDOW, jitter=DEFAULT_JITTER,
+                 sink=stdout_sink, tag=None, fetch_args=None, state=None,
+                 clock=time.time, sleep=None):
+        if not isinstance(components, dict):
+            components = dict.fromkeys(components, interval)
+        self.intervals = components
+        self.base_url = base_url
+        self.category = category
+        self.hot_interval = hot_interval
+        self.dormant_interval = dormant_interval
+        self.hot_window = hot_window
+        self.dormant_window = dormant_window
+        self.jitter = jitter
+        self.sink = sink
+        self.tag = tag
+        self.fetch_args = fetch_args or {}
+        if isinstance(state, str):
+            state = StateStore(state)
+        self.state = state
+        self.clock = clock
+
+        self._stopped = threading.Event()
+        self.sleep = sleep or self._stopped.wait
+
+        self.backends = {}
+        self.analyses = {}
+        self.polls = dict.fromkeys(components, 0)
+
+        # First polls are spread over the jitter
+        now = self.clock()
+        self._schedule = [(now + random.uniform(0, self.jitter) * self.intervals[component], n, component)
+                          for n, component in enumerate(components)]
+        heapq.heapify(self._schedule)
+        self._counter = len(self._schedule)
+
+    def run(self, polls=None):
+        """Poll the components until stopped.
+
+        :param polls: number of polls to make before returning; `None`
+            to keep polling until `stop` is called
+        :returns: the number of items passed to the sink
+        """
+        nitems = 0
+        npolls = 0
+        while self._schedule and not self._stopped.is_set():
+            if polls is not None and npolls >= polls:
+                break
+
+            due, _, component = self._schedule[0]
+            delay = due - self.clock()
+            if delay > 0 and self.sleep(delay):
+                break
+
+            heapq.heappop(self._schedule)
+            analysis_date = None
+            try:
+                analysis_date, fetched = self.poll(component)
+                nitems += fetched
+            except Exception as e:
+                logger.error("Poll of %s failed: %s", component, e)
+            npolls += 1
+
+            self._counter += 1
+            next_due = self.clock() + self.next_interval(component, analysis_date)
+            heapq.heappush(self._schedule, (next_due, self._counter, component))
+
+        return nitems
+
+    def stop(self):
+        """Stop the watch after the current poll."""
+
+        self._stopped.set()
+
+    def poll(self, component):
+        """Fetch the items of a component when it was analysed again.
+
+        :returns: the date of the last analysis and the number of items
+            passed to the sink
+        """
+        backend = self.backends.get(component)
+        if backend is None:
+            backend = Sonar(component, base_url=self.base_url, tag=self.tag, state=self.state)
+            self.backends[component] = backend
+
+        self.polls[component] += 1
+        analysis_date = backend.client.analysis_date()
+        if analysis_date and analysis_date == self.analyses.get(component):
+            logger.debug("%s not analysed since %s", component, analysis_date)
+            return analysis_date, 0
+
+        nitems = 0
+        for item in backend.fetch(category=self.category, **self.fetch_args):
+            self.sink(item)
+            nitems += 1
+        self.analyses[component] = analysis_date
+
+        logger.info("%s items of %s passed to the sink", nitems, component)
+        return analysis_date, nitems
+
+    def next_interval(self, component, analysis_date):
+        """Seconds until the next poll of a component.
+
+        :param component: Sonar component
+        :param analysis_date: date of its last analysis, if known
+        """
+        interval = self.intervals[component]
+
+        age = self._age(analysis_date)
+        if age is not None and age <= self.hot_window:
+            interval = self.hot_interval or interval / HOT_FACTOR
+        elif age is not None and age >= self.dormant_window:
+            interval = self.dormant_interval or interval * DORMANT_FACTOR
+
+        return self._jittered(interval)
+
+    def _age(self, analysis_date):
+        if not analysis_date:
+            return None
+        try:
+            return self.clock() - str_to_datetime(analysis_date).timestamp()
+        except InvalidDateError:
+            return None
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+def main(args=None):
+    """Watch many components from the command line, writing items to stdout."""
+
+    parser = argparse.ArgumentParser(description="Sonarqube watch")
+    parser.add_argument('--base-url', dest='base_url', default=SONAR_URL,
+                        help="Base URL for Sonarqube instance")
+    parser.add_argument('--category', default=DEFAULT_CATEGORY,
+                        choices=Sonar.CATEGORIES, help="Category of items to fetch")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between polls of a component")
+    parser.add_argument('--hot-interval', dest='hot_interval', type=float, default=None,
+                        help="Seconds between polls of recently analysed components")
+    parser.add_argument('--dormant-interval', dest='dormant_interval', type=float, default=None,
+                        help="Seconds between polls of long unanalysed components")
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER,
+                        help="Fraction of the interval polls are randomly moved by")
+    parser.add_argument('--state-file', dest='state', default=None,
+                        help="State store to resume fetches from (created when missing)")
+    parser.add_argument('components', nargs='+',
+                        help="Sonarqube components/projects, optionally as COMPONENT=SECONDS")
+    args = parser.parse_args(args)
+
+    components = {}
+    for component in args.components:
+        key, _, seconds = component.partition('=')
+        components[key] = float(seconds) if seconds else args.interval
+
+    watcher = Watcher(components, base_url=args.base_url, category=args.category,
+                      hot_interval=args.hot_interval, dormant_interval=args.dormant_interval,
+                      jitter=args.jitter, state=args.state)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Fifth Floor, Boston, MA 02110-1335, USA.
+#
+# Authors:
+#     Igor Zubiaurre <izubiaurre@bitergia.com>
+#
+
+import argparse
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import queue
+import sys
+import threading
+
+from .sonarqube import SONAR_URL, Sonar, branch_label
+from .state import StateStore
+from .watch import stdout_sink
+
+logger = logging.getLogger(__name__)
+
+# Categories fetched for each analysis notified
+WEBHOOK_CATEGORIES = ('measures', 'history')
+
+# Header holding the HMAC of the payload, when the webhook has a secret
+SIGNATURE_HEADER = 'X-Sonar-Webhook-HMAC-SHA256'
+
+# Status of the analyses whose data is fetched
+SUCCESS = 'SUCCESS'
+
+# Type of the analysed branches which are pull requests
+PULL_REQUEST = 'PULL_REQUEST'
+
+
+class WebhookReceiver:
+    """Fetch the data of each component as soon as Sonarqube analyses it.
+
+    It is a small HTTP server receiving the webhooks Sonarqube posts
+    when it completes an analysis. Each successful analysis queues its
+    component, along with its branch or pull request when it isn't the
+    main branch, whose items of `categories` are fetched on a worker
+    thread and passed to the `sink`. One `Sonar` backend is kept per
+    component, so their clients share the pooled sessions, and, with
+    the `state`, histories are fetched from the last point recorded.
+
+    :param base_url: Sonar URL
+    :param host: address to listen on
+    :param port: port to listen on; 0 for any free port
+    :param sink: callable taking each item; `stdout_sink` by default
+    :param secret: secret of the webhook, to check the payload signatures
+    :param state: `StateStore`, or path to one; an in-memory store by
+        default, which keeps the cursors while the receiver runs
+    :param tag: label used to mark the data
+    :param categories: categories of the items to fetch
+    """
+
+    def __init__(self, base_url=SONAR_URL, host='127.0.0.1', port=0, sink=stdout_sink,
+                 secret=None, state=None, tag=None, categories=WEBHOOK_CATEGORIES):
+        self.base_url = base_url
+        self.sink = sink
+        self.secret = secret
+        self.tag = tag
+        self.categories = categories
+
+        if state is None:
+            state = ':memory:'
+        if isinstance(state, str):
+            state = StateStore(state)
+        self.state = state
+
+        self.backends = {}
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+        self._server = http.server.ThreadingHTTPServer((host, port), _WebhookHandler)
+        self._server.receiver = self
+        self._threads = []
+
+    @property
+    def address(self):
+        """Host and port the receiver listens on."""
+
+        return self._server.server_address[:2]
+
+    def start(self):
+        """Start serving and fetching on background threads."""
+
+        for target in (self._server.serve_forever, self._work):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info("Listening to Sonarqube webhooks on %s:%s", *self.address)
+
+    def stop(self):
+        """Stop serving, once the queued components are fetched."""
+
+        self._queue.join()
+        self._server.shutdown()
+        self._server.server_close()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self):
+        """Wait until the queued components are fetched."""
+
+        self._queue.join()
+
+    def receive(self, payload):
+        """Queue the component, and branch or pull request, of a webhook payload.
+
+        :param payload: decoded webhook payload
+        :returns: whether the component was queued; analyses which
+            didn't succeed are ignored, as well as components (and
+            branches) already waiting to be fetched
+
+        :raises ValueError: when the payload has no project
+        """
+        try:
+            component = payload['project']['key']
+        except (KeyError, TypeError):
+            raise ValueError('webhook payload without project key')
+
+        if payload.get('status', SUCCESS) != SUCCESS:
+            logger.info("Analysis %s of %s ignored: %s", payload.get('taskId'), component, payload['status'])
+            return False
+
+        target = self.target(payload)
+        key = (component, branch_label(target))
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+
+        self._queue.put((component, target))
+        return True
+
+    @staticmethod
+    def target(payload):
+        """Get the `branch` or `pullRequest` argument of an analysis payload.
+
+        Analyses of the main branch, and payloads of Sonarqube versions
+        without branches, get no argument.
+        """
+        branch = payload.get('branch') or {}
+        if not branch.get('name') or branch.get('isMain', True):
+            return {}
+        param = 'pullRequest' if branch.get('type') == PULL_REQUEST else 'branch'
+        return {param: str(branch['name'])}
+
+    def verify(self, body, signature):
+        """Check the signature of a payload against the secret, if any."""
+
+        if not self.secret:
+            return True
+        expected = hmac.new(self.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def fetch(self, component, **target):
+        """Fetch the items of a component and pass them to the sink.
+
+        :param target: `branch` or `pullRequest` to fetch, instead of
+            the main branch
+        :returns: the number of items passed to the sink
+        """
+        backend = self.backends.get(component)
+        if backend is None:
+            backend = Sonar(component, base_url=self.base_url, tag=self.tag, state=self.state)
+            self.backends[component] = backend
+
+        nitems = 0
+        for category in self.categories:
+            for item in backend.fetch(category=category, **target):
+                self.sink(item)
+                nitems += 1
+
+        logger.info("%s items of %s%s passed to the sink", nitems, component,
+                    ' ({})'.format(branch_label(target)) if target else '')
+        return nitems
+
+    def _work(self):
+        while True:
+            queued = self._queue.get()
+            if queued is None:
+                self._queue.task_done()
+                return
+
+            component, target = queued
+            with self._lock:
+                self._pending.discard((component, branch_label(target)))
+            try:
+                self.fetch(component, **target)
+            except Exception as e:
+                logger.error("Fetch of %s failed: %s", component, e)
+            finally:
+                self._queue.task_done()
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the webhook posts of Sonarqube."""
+
+    def do_POST(self):
+        receiver = self.server.receiver
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if not receiver.verify(body, self.headers.get(SIGNATURE_HEADER)):
+            self._answer(401, 'invalid signature')
+            return
+
+        try:
+            queued = receiver.receive(json.loads(body))
+        except ValueError as e:
+            self._answer(400, str(e))
+            return
+
+        self._answer(202 if queued else 200, 'queued' if queued else 'ignored')
+
+    def _answer(self, status, message):
+        content = json.dumps({'status': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main(args=None):
+    """Receive Sonarqube webhooks from the command line, writing items to stdout."""
+
+    parser = argparse.ArgumentParser(description="Sonarqube webhook receiver")
+    parser.add_argument('--base-url', dest='base_url', default=SONAR_URL,
+                        help="Base URL for Sonarqube instance")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="Port to listen on")
+    parser.add_argument('--secret', default=None,
+                        help="Secret of the webhook")
+    parser.add_argument('--state-file', dest='state', default=None,
+                        help="State store to resume fetches from (created when missing)")
+    args = parser.parse_args(args)
+
+    receiver = WebhookReceiver(base_url=args.base_url, host=args.host, port=args.port,
+                               secret=args.secret, state=args.state)
+    receiver.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        receiver.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,7 +33,14 @@ import unittest                       # common usage.
 import configparser                   # common usage.
 import httpretty as mock              # for TestSonarClientAgainstMockServer.
 import os
+import re
 import json
+import datetime
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
 
 import pkg_resources
 pkg_resources.declare_namespace('backends')
@@ -41,8 +48,15 @@ pkg_resources.declare_namespace('backends')
 from grimoirelab_toolkit.datetime import datetime_utcnow
 
 # for common usage:
-from perceval.backends.sonarqube.sonarqube import SonarClient
 from perceval.backends.sonarqube.sonarqube import *
+from perceval.backends.sonarqube.client import *
+from perceval.backends.sonarqube.archive import BodyStore, DedupArchive, archive_headers, default_body_store, fingerprint, prune_bodies
+from perceval.backends.sonarqube.sinks import DEFAULT_FLUSH_INTERVAL, NOT_GIVEN, Sink, open_sink
+from perceval.backends.sonarqube.preflight import PreflightCache
+from perceval.backends.sonarqube.shards import ShardedRunner, RateBudget, main as shards_main, partition, shard_of
+from perceval.backends.sonarqube.state import StateStore
+from perceval.backends.sonarqube.watch import Watcher
+from perceval.backends.sonarqube.webhook import WebhookReceiver
 
 
 CFG_FILE = 'test_sonarqube.cfg'
@@ -106,6 +120,16 @@ class TestSonarCommand(unittest.TestCase):
         self.assertEqual( TST_URL , pa.base_url   )
         self.assertEqual( TST_LST , pa.metricKeys )
 
+        # TC04: history resolution:
+        args = [ '--history-resolution' , 'week'
+               , TST_ORI
+               ]
+
+        pa = parser.parse(*args)
+
+        self.assertEqual( 'week' , pa.history_resolution )
+        self.assertFalse( pa.compact_history )
+
 
 
 class TestSonarBackend(unittest.TestCase):
@@ -215,7 +239,7 @@ class TestSonarBackend(unittest.TestCase):
 
     def test_categories(self):
         '''No exception raised when accessing that member.'''
-        self.assertEqual( 3 , len(Sonar.CATEGORIES) )
+        self.assertEqual( 7 , len(Sonar.CATEGORIES) )
 
 
     @mock.activate
@@ -235,6 +259,1438 @@ class TestSonarBackend(unittest.TestCase):
                 self.assertEqual( category , tbe.metadata_category( item ) )
                 break
 
+    @mock.activate
+    def test_flatten_measures(self):
+        '''Measures are flattened with typed values, periods and definitions from a single response.'''
+        response = { 'component': { 'key': 'c01' , 'measures': [
+                         { 'metric': 'bugs' , 'value': '5' , 'bestValue': False }
+                       , { 'metric': 'new_technical_debt' , 'period': { 'index': 1 , 'value': '12' , 'bestValue': False } }
+                       , { 'metric': 'coverage' , 'value': '81.5' , 'periods': [ { 'index': 1 , 'value': '-0.5' } ] }
+                       ] }
+                   , 'metrics': [ { 'key': 'bugs' , 'type': 'INT' , 'name': 'Bugs' , 'domain': 'Reliability' , 'direction': -1 }
+                                , { 'key': 'new_technical_debt' , 'type': 'WORK_DUR' , 'name': 'Added Technical Debt' }
+                                , { 'key': 'coverage' , 'type': 'PERCENT' , 'name': 'Coverage' } ]
+                   , 'period': { 'mode': 'previous_version' , 'date': '2022-06-01T10:00:00+0200' }
+                   }
+        mock.register_uri( mock.GET , self.TST_URL + 'api/measures/component?component=c01&metricKeys=bugs,new_technical_debt,coverage&additionalFields=periods,metrics'
+                         , match_querystring=True , body=json.dumps( response ) )
+
+        tbe = Sonar( 'c01' , base_url=self.TST_URL )
+        items = { i['metric']: i for i in tbe.fetch_items( 'measures' , metricKeys='bugs,new_technical_debt,coverage' , flatten_measures=True ) }
+
+        # AC1: base and period values are typed after the metric type:
+        self.assertEqual( ( 5 , None ) , ( items['bugs']['value'] , items['bugs']['period_value'] ) )
+        self.assertEqual( ( None , 12 ) , ( items['new_technical_debt']['value'] , items['new_technical_debt']['period_value'] ) )
+        self.assertEqual( ( 81.5 , -0.5 ) , ( items['coverage']['value'] , items['coverage']['period_value'] ) )
+
+        # AC2: the period and the metric definition come along:
+        self.assertEqual( ( 1 , 'previous_version' ) , ( items['coverage']['period_index'] , items['coverage']['period_mode'] ) )
+        self.assertEqual( ( 'Bugs' , 'INT' , 'Reliability' ) , ( items['bugs']['metric_name'] , items['bugs']['metric_type'] , items['bugs']['metric_domain'] ) )
+
+        # AC3: one single request, without asking for the metric definitions:
+        self.assertEqual( 1 , len( mock.latest_requests() ) )
+        self.assertEqual( [ 'periods,metrics' ] , mock.last_request().querystring['additionalFields'] )
+
+        # AC4: values which don't match their type are kept:
+        self.assertEqual( 'n/a' , typed_value( 'n/a' , 'INT' ) )
+        self.assertEqual( True , typed_value( 'true' , 'BOOL' ) )
+
+class TestSonarHistoryCompaction(unittest.TestCase):
+    """Tests run-length compaction of history items."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_compactor(self):
+        '''Runs are closed on value changes and flushed at the end.'''
+        hc = HistoryCompactor()
+
+        self.assertIsNone( hc.feed( 'bugs' , {'date':'d1', 'value':'1'} ) )
+        self.assertIsNone( hc.feed( 'bugs' , {'date':'d2', 'value':'1'} ) )
+        self.assertIsNone( hc.feed( 'code_smells' , {'date':'d1', 'value':'7'} ) )
+        run = hc.feed( 'bugs' , {'date':'d3', 'value':'2'} )
+
+        self.assertEqual( ('1', 'd1', 'd2', 2) , (run['value'], run['first_date'], run['last_date'], run['count']) )
+
+        runs = hc.flush()
+        self.assertEqual( 2 , len(runs) )
+        self.assertEqual( [] , hc.flush() )
+
+
+    @mock.activate
+    def test_fetch_compacted(self):
+        '''Compacted items cover every point and expand back to them.'''
+
+        TST_QUERY = 'api/measures/search_history?component=c02&metrics=accessors,new_technical_debt'
+        Utilities.mock_pages( 'c02_history_component_6' , self.TST_URL + TST_QUERY , 4 , HISTORY_PER_PAGE )
+        tbe = Sonar( 'c02' , base_url=self.TST_URL )
+
+        points = list( tbe.fetch_items( 'history' ) )
+        intervals = list( tbe.fetch_items( 'history', compact_history=True ) )
+
+        # AC1: fewer items, same number of points:
+        self.assertLess( len(intervals) , len(points) )
+        self.assertEqual( len(points) , sum( i['count'] for i in intervals ) )
+
+        # AC2: they are still history items:
+        for item in intervals:
+            self.assertEqual( 'history' , tbe.metadata_category( item ) )
+
+        # AC3: expansion with the analysis dates restores the points:
+        expanded = []
+        for metric in set( p['metric'] for p in points ):
+            dates = [ p['measured_on'] for p in points if p['metric'] == metric ]
+            runs  = [ i for i in intervals if i['metric'] == metric ]
+            expanded.extend( expand_history( 'c02' , runs , dates ) )
+        key = lambda i: (i['id'], i['metric'], i['value'], i['measured_on'])
+        self.assertEqual( sorted(map(key, points)) , sorted(map(key, expanded)) )
+
+        # AC4: expansion without dates restores the run boundaries:
+        expanded = list( expand_history( 'c02' , intervals ) )
+        self.assertEqual( sum( min(i['count'], 2) for i in intervals ) , len(expanded) )
+
+
+
+class TestSonarHistoryDownsampling(unittest.TestCase):
+    """Tests downsampling of history items."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_downsampler(self):
+        '''Buckets are reduced according to the metric type.'''
+        TYPES = {'bugs': 'INT', 'coverage': 'PERCENT', 'sqale_rating': 'RATING'}
+        hd = HistoryDownsampler( 'month' , TYPES )
+
+        for metric , values in ( ('bugs', ('5', '3', '4')), ('coverage', ('10.0', '20.0', '60.0')), ('sqale_rating', ('1.0', '2.0', '3.0')) ):
+            for day , value in zip( ('01', '15', '31'), values ):
+                self.assertIsNone( hd.feed( metric , {'date':'2022-01-{}T10:00:00+0100'.format(day), 'value':value} ) )
+
+        closed = hd.feed( 'bugs' , {'date':'2022-02-01T10:00:00+0100', 'value':'9'} )
+        self.assertEqual( ('2022-01', 3, 4.0, 3.0, 5.0) , (closed['bucket'], closed['count'], closed['value'], closed['min'], closed['max']) )
+
+        buckets = { b['metric']:b for b in hd.flush() }
+        self.assertEqual( 30.0  , buckets['coverage']['value'] )
+        self.assertEqual( '3.0' , buckets['sqale_rating']['value'] )
+        self.assertNotIn( 'min' , buckets['sqale_rating'] )
+        self.assertEqual( 1 , buckets['bugs']['count'] )
+
+        # AC2: week labels follow the ISO calendar:
+        self.assertEqual( '2022-W52' , HistoryDownsampler( 'week' ).bucket( '2023-01-01T10:00:00+0100' ) )
+
+        # AC3: unknown resolutions are rejected:
+        with self.assertRaises( InvalidArgument ):
+            HistoryDownsampler( 'year' )
+
+        # AC4: values which aren't numbers are left out of means and ranges:
+        hd = HistoryDownsampler( 'month' , TYPES )
+        for metric , values in ( ('bugs', ('5', 'n/a', '4')), ('coverage', ('10.0', '', '60.0')) ):
+            for day , value in zip( ('01', '15', '31'), values ):
+                hd.feed( metric , {'date':'2022-01-{}T10:00:00+0100'.format(day), 'value':value} )
+
+        buckets = { b['metric']:b for b in hd.flush() }
+        self.assertEqual( (3, 4.0, 4.0, 5.0) , (buckets['bugs']['count'], buckets['bugs']['value'], buckets['bugs']['min'], buckets['bugs']['max']) )
+        self.assertEqual( 35.0 , buckets['coverage']['value'] )
+
+
+    @mock.activate
+    def test_fetch_downsampled(self):
+        '''There is one item per metric and month.'''
+
+        TST_QUERY = 'api/measures/search_history?component=c02&metrics=accessors,new_technical_debt'
+        Utilities.mock_pages( 'c02_history_component_6' , self.TST_URL + TST_QUERY , 4 , HISTORY_PER_PAGE )
+        metrics = [ { 'key': 'accessors' , 'type': 'INT' } , { 'key': 'new_technical_debt' , 'type': 'WORK_DUR' } ]
+        mock.register_uri( mock.GET , self.TST_URL + 'api/metrics/search?ps=500&p=1' , match_querystring=True
+                         , body=json.dumps( { 'metrics': metrics , 'total': 2 , 'p': 1 , 'ps': 500 } ) )
+        tbe = Sonar( 'c02' , base_url=self.TST_URL )
+
+        points = list( tbe.fetch_items( 'history' ) )
+        buckets = list( tbe.fetch_items( 'history', history_resolution='month' ) )
+
+        # one bucket per change of month of each metric, as points come (not always sorted in mocks):
+        last , expected = {} , 0
+        for p in points:
+            if last.get( p['metric'] ) != p['measured_on'][:7]:
+                expected += 1
+            last[ p['metric'] ] = p['measured_on'][:7]
+        self.assertEqual( expected , len(buckets) )
+        self.assertEqual( len(points) , sum( b['count'] for b in buckets ) )
+        for item in buckets:
+            self.assertEqual( 'history' , tbe.metadata_category( item ) )
+
+        # AC2: it can't be combined with compaction:
+        with self.assertRaises( InvalidArgument ):
+            list( tbe.fetch_items( 'history', history_resolution='month', compact_history=True ) )
+
+
+
+class TestSonarComponentTree(unittest.TestCase):
+    """Tests the component_tree category."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+    TST_QUERY = 'api/measures/component_tree?component=c0{}&metricKeys={}'
+
+
+    @mock.activate
+    def test_fetch_paged(self):
+        '''All the pages are walked, with or without prefetching.'''
+
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        tbe = Sonar( 'c02' , base_url=self.TST_URL )
+
+        for prefetch in ( 0 , 1 , 3 ):
+            items = list( tbe.fetch_items( 'component_tree', prefetch=prefetch ) )
+
+            self.assertEqual( expected['02']['component_tree'] , len(items) )
+            # pages come in order:
+            self.assertEqual( 'c02:src/mod0' , items[0]['component'] )
+            self.assertEqual( 'c02:src/mod4/file24.py' , items[-1]['component'] )
+            self.assertEqual( set(('DIR', 'FIL')) , set( i['qualifier'] for i in items ) )
+            self.assertEqual( len(items) , len(set( i['id'] for i in items )) )
+
+
+    @mock.activate
+    def test_metric_batches(self):
+        '''Metric keys are requested in batches.'''
+
+        keys = [ 'm{:02d}'.format(k) for k in range( MAX_TREE_METRIC_KEYS + 1 ) ]
+        for batch in ( keys[:MAX_TREE_METRIC_KEYS] , keys[MAX_TREE_METRIC_KEYS:] ):
+            Utilities.mock_pages( 'c01_component_tree' , self.TST_URL + self.TST_QUERY.format( 1 , ','.join(batch) ) , 1 , PER_PAGE )
+
+        tsc = SonarClient( 'c01' , base_url=self.TST_URL )
+        pages = list( tsc.component_tree( metricKeys=','.join(keys) ) )
+
+        self.assertEqual( 2 , len(pages) )
+        self.assertEqual( 2 , len(mock.latest_requests()) )
+
+
+
+class TestSonarIssues(unittest.TestCase):
+    """Tests the issues category."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+    TST_CAP = 8
+
+
+    @mock.activate
+    def test_sliced(self):
+        '''Time slices keep every query under the cap.'''
+
+        issues = Utilities.fake_issues( 'c01' , 30 )
+        Utilities.mock_issues( self.TST_URL , { 'c01': issues } , cap=self.TST_CAP , page_size=4 )
+        tbe = Sonar( 'c01' , base_url=self.TST_URL )
+
+        with patch( 'perceval.backends.sonarqube.client.ISSUES_CAP' , self.TST_CAP ):
+            for workers in ( 1 , 3 ):
+                items = list( tbe.fetch_items( 'issues', workers=workers ) )
+
+                self.assertEqual( [ i['key'] for i in issues ] , [ i['id'] for i in items ] )
+                for item in items:
+                    self.assertEqual( 'issues' , tbe.metadata_category( item ) )
+
+        # AC2: slices are harvested asking for the largest pages, then with the size answered:
+        harvests = [ r.querystring for r in mock.latest_requests() if r.querystring.get( 'ps' ) != ['1'] ]
+        self.assertTrue( harvests )
+        for qs in harvests:
+            self.assertEqual( ['4'] if 'p' in qs else [str(PER_PAGE)] , qs['ps'] )
+
+
+    @mock.activate
+    def test_incremental(self):
+        '''Issues updated since a date are walked by update date.'''
+
+        issues = Utilities.fake_issues( 'c01' , 30 )
+        Utilities.mock_issues( self.TST_URL , { 'c01': issues } , cap=self.TST_CAP , page_size=4 )
+        tbe = Sonar( 'c01' , base_url=self.TST_URL )
+        since = datetime.datetime( 2021, 2, 20, tzinfo=datetime.timezone.utc )
+
+        updated = [ i['key'] for i in issues if since <= str_to_datetime( i['updateDate'] ) ]
+        self.assertLess( len(updated) , self.TST_CAP )
+
+        with patch( 'perceval.backends.sonarqube.client.ISSUES_CAP' , self.TST_CAP ):
+            items = list( tbe.fetch_items( 'issues', from_date=since ) )
+            self.assertEqual( sorted(updated) , sorted( i['key'] for i in items ) )
+
+            # resuming is driven by the update dates:
+            stamps = [ tbe.metadata_updated_on( i ) for i in items ]
+            self.assertEqual( sorted(stamps, reverse=True) , stamps )
+            self.assertLessEqual( since.timestamp() , min(stamps) )
+
+            # AC2: too many updates fall back to a full fetch:
+            items = list( tbe.fetch_items( 'issues', from_date=since - datetime.timedelta( days=365 ) ) )
+            self.assertEqual( 30 , len(items) )
+            self.assertEqual( 30 , len(set( i['key'] for i in items )) )
+
+
+
+class TestSonarHotspotsAndDuplications(unittest.TestCase):
+    """Tests the hotspots and duplications categories."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_ordered_map(self):
+        '''Results keep the input order, with or without workers.'''
+        for workers in ( 0 , 1 , 4 ):
+            self.assertEqual( [ n * n for n in range(20) ] , list( ordered_map( lambda n: n * n , range(20) , workers ) ) )
+
+
+    @mock.activate
+    def test_hotspots(self):
+        '''All the pages are walked, with or without prefetching.'''
+
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        tbe = Sonar( 'c02' , base_url=self.TST_URL )
+
+        for prefetch in ( 0 , 2 ):
+            items = list( tbe.fetch_items( 'hotspots', prefetch=prefetch ) )
+
+            self.assertEqual( expected['02']['hotspots'] , len(items) )
+            self.assertEqual( [ 'AXc02hs{:04d}'.format(n) for n in range(23) ] , [ i['id'] for i in items ] )
+            for item in items:
+                self.assertEqual( 'hotspots' , tbe.metadata_category( item ) )
+
+
+    @mock.activate
+    def test_duplications(self):
+        '''Groups are fetched once, from the first file they span.'''
+
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        tbe = Sonar( 'c01' , base_url=self.TST_URL )
+
+        for prefetch in ( 0 , 2 ):
+            items = list( tbe.fetch_items( 'duplications', prefetch=prefetch ) )
+
+            self.assertEqual( 2 , len(items) )
+            self.assertEqual( 2 , len(set( i['id'] for i in items )) )
+            self.assertEqual( ['c01:src/app0.py', 'c01:src/app0.py'] , [ i['file'] for i in items ] )
+            self.assertEqual( {'file': 'c01:src/app2.py', 'from': 5, 'size': 10} , items[0]['blocks'][1] )
+            for item in items:
+                self.assertEqual( 'duplications' , tbe.metadata_category( item ) )
+
+
+
+class TestSonarCategoryRegistry(unittest.TestCase):
+    """Tests the pluggable registry of categories."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_declared(self):
+        '''Every category is declared in the registry.'''
+        self.assertEqual( tuple(Sonar.CATEGORY_REGISTRY) , Sonar.CATEGORIES )
+        for name , category in Sonar.CATEGORY_REGISTRY.items():
+            self.assertEqual( name , category.name )
+            self.assertTrue( callable( category.fetcher( Sonar( 'c01' , base_url=self.TST_URL ) ) ) )
+
+
+    def test_untagged(self):
+        '''Items fetched before being tagged get their category from their fields.'''
+        point = { 'metric': 'bugs' , 'date': '2022-07-01T10:00:00+0200' , 'value': '3' , 'fetched_on': 5 }
+        measure = { 'metric': 'bugs' , 'value': '3' , 'bestValue': False , 'fetched_on': 7 }
+
+        self.assertEqual( 'history' , Sonar.metadata_category( point ) )
+        self.assertEqual( 'measures' , Sonar.metadata_category( measure ) )
+        self.assertEqual( 5 , Sonar.metadata_updated_on( point ) )
+        self.assertEqual( 7 , Sonar.metadata_updated_on( measure ) )
+
+
+    def test_plugged(self):
+        '''New categories plug in without touching the backend.'''
+
+        class Plugged( Sonar ):
+            pass
+
+        def fetch_quality_gate( backend , **kwargs ):
+            yield { 'key': backend.component + '-gate' , 'status': 'OK' , 'changedAt': '2022-07-01T10:00:00+0200' , 'fetched_on': 0 }
+
+        Plugged.register_category( SonarCategory( 'quality_gate' , fetch_quality_gate
+                                                , item_id=lambda backend, item: item['key']
+                                                , cursor='changedAt'
+                                                ) )
+
+        tbe = Plugged( 'c01' , base_url=self.TST_URL )
+        items = list( tbe.fetch_items( 'quality_gate' ) )
+
+        self.assertEqual( 1 , len(items) )
+        self.assertEqual( 'c01-gate' , tbe.metadata_id( items[0] ) )
+        self.assertEqual( 'quality_gate' , tbe.metadata_category( items[0] ) )
+        self.assertEqual( str_to_datetime( '2022-07-01T10:00:00+0200' ).timestamp() , tbe.metadata_updated_on( items[0] ) )
+
+        # AC2: the parent backend is left untouched:
+        self.assertIn( 'quality_gate' , Plugged.CATEGORIES )
+        self.assertNotIn( 'quality_gate' , Sonar.CATEGORIES )
+
+
+
+class TestSonarWatch(unittest.TestCase):
+    """Tests the long running watch of components."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.now = datetime_utcnow().timestamp()
+
+
+    def clock( self ):
+        return self.now
+
+
+    def sleep( self , seconds ):
+        self.now += seconds
+        return False
+
+
+    def mock_analysis( self , component , age ):
+        '''Mocks the last analysis of a component, some seconds ago.'''
+        date = datetime.datetime.fromtimestamp( self.now - age , tz=datetime.timezone.utc )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_analyses/search?project={}&ps=1'.format( component )
+                         , match_querystring=True
+                         , body=json.dumps( { 'analyses': [ { 'key': 'a1' , 'date': date.strftime( '%Y-%m-%dT%H:%M:%S%z' ) } ] } )
+                         )
+
+
+    def test_intervals(self):
+        '''Hot components are polled more often, dormant ones less.'''
+        watcher = Watcher( { 'c01': 100 , 'c02': 60 } , jitter=0 , clock=self.clock )
+        date = lambda age: datetime.datetime.fromtimestamp( self.now - age , tz=datetime.timezone.utc ).isoformat()
+
+        self.assertEqual( 100 , watcher.next_interval( 'c01' , None ) )
+        self.assertEqual( 100 , watcher.next_interval( 'c01' , date( 3 * 24 * 3600 ) ) )
+        self.assertEqual(  25 , watcher.next_interval( 'c01' , date( 3600 ) ) )
+        self.assertEqual( 400 , watcher.next_interval( 'c01' , date( 365 * 24 * 3600 ) ) )
+        self.assertEqual(  15 , watcher.next_interval( 'c02' , date( 3600 ) ) )
+
+        # AC2: jitter moves polls within its fraction:
+        watcher = Watcher( [ 'c01' ] , interval=100 , jitter=0.1 , clock=self.clock )
+        for n in range( 20 ):
+            self.assertTrue( 90 <= watcher.next_interval( 'c01' , None ) <= 110 )
+
+
+    @mock.activate
+    def test_run(self):
+        '''Components are polled on schedule; items only flow after new analyses.'''
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        self.mock_analysis( 'c01' , 3600 )
+        self.mock_analysis( 'c02' , 365 * 24 * 3600 )
+
+        items = []
+        watcher = Watcher( [ 'c01' , 'c02' ] , base_url=self.TST_URL , interval=100 , jitter=0
+                         , sink=items.append , clock=self.clock , sleep=self.sleep )
+
+        fetched = watcher.run( polls=12 )
+        self.assertEqual( { 'c01': 11 , 'c02': 1 } , watcher.polls )
+        self.assertEqual( expected['01']['measures_component_2'] + expected['02']['measures_component_2'] , fetched )
+        self.assertEqual( fetched , len(items) )
+        self.assertEqual( 'measures' , items[0]['category'] )
+
+        # AC2: the client is kept warm across polls:
+        client = watcher.backends['c01'].client
+        self.mock_analysis( 'c01' , 0 )
+        self.assertEqual( expected['01']['measures_component_2'] , watcher.run( polls=1 ) )
+        self.assertIs( client , watcher.backends['c01'].client )
+
+        # AC3: the watch can be stopped:
+        watcher.stop()
+        self.assertEqual( 0 , watcher.run() )
+
+
+
+class TestSonarImportTime(unittest.TestCase):
+    """Guards the import of the backend module, as used from Python, against heavy imports.
+
+    The perceval command imports every module of every backend package, its own included, so it
+    loads requests whatever this backend does.
+    """
+
+    HEAVY = ( 'requests' , 'urllib3' , 'httpx' , 'perceval.client' , 'perceval.backends.sonarqube.client' )
+
+
+    def importtime( self , code ):
+        '''Runs some code on a fresh interpreter, returning the cumulative import time (us) by module.'''
+        run = subprocess.run( [ sys.executable , '-X' , 'importtime' , '-c' , code ]
+                            , capture_output=True , text=True , check=True )
+        times = {}
+        for line in run.stderr.splitlines():
+            fields = line.split( '|' )
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                times[ fields[2].strip() ] = int( fields[1] )
+        return times
+
+
+    def test_command_line(self):
+        '''Parsing the arguments and building the backend don't load the HTTP stack.'''
+        times = self.importtime( 'from perceval.backends.sonarqube.sonarqube import Sonar, SonarCommand\n'
+                                 'SonarCommand.setup_cmd_parser().parse( "c01" )\n'
+                                 'Sonar( "c01" )\n' )
+
+        self.assertIn( 'perceval.backends.sonarqube.sonarqube' , times )
+        for module in self.HEAVY:
+            self.assertNotIn( module , times )
+
+        # AC2: the state store and the sinks are only loaded when used:
+        times = self.importtime( 'import perceval.backends.sonarqube.sonarqube' )
+        for module in ( 'perceval.backends.sonarqube.state' , 'perceval.backends.sonarqube.sinks' ):
+            self.assertNotIn( module , times )
+
+
+    def test_first_fetch(self):
+        '''The HTTP client is still reachable from the backend module.'''
+        import perceval.backends.sonarqube.sonarqube as backend
+        import perceval.backends.sonarqube.client as client
+
+        self.assertIs( client.SonarClient , backend.SonarClient )
+        self.assertIsInstance( Sonar( 'c01' ).client , client.SonarClient )
+        self.assertIs( StateStore , backend.StateStore )
+        self.assertIs( open_sink , backend.open_sink )
+        with self.assertRaises( AttributeError ):
+            backend.missing
+
+
+
+class TestSonarBackpressure(unittest.TestCase):
+    """Tests the bounded buffer between page producers and consumers."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_caps(self):
+        '''The producer never gets further ahead than the caps.'''
+        for caps , limit in ( ( { 'max_items': 3 } , lambda b: b.depth <= 3 )
+                            , ( { 'max_bytes': 35 } , lambda b: b.nbytes <= 35 )
+                            ):
+            buffer = BoundedBuffer( **caps )
+            consumed = []
+            for element in buffer.drain( range( 50 ) , sizeof=lambda e: 10 ):
+                time.sleep( 0.001 )
+                self.assertTrue( limit( buffer ) )
+                consumed.append( element )
+
+            self.assertEqual( list(range( 50 )) , consumed )
+            self.assertEqual( 0 , buffer.depth )
+
+
+    def test_failures_and_closing(self):
+        '''Producer failures reach the consumer; closing stops the producer.'''
+
+        def failing():
+            yield 1
+            yield 2
+            raise ValueError( 'broken' )
+
+        # AC1: elements produced before the failure are consumed first:
+        consumed = []
+        with self.assertRaises( ValueError ):
+            for element in BoundedBuffer( max_items=1 ).drain( failing() ):
+                consumed.append( element )
+        self.assertEqual( [ 1 , 2 ] , consumed )
+
+        # AC2: an endless producer stops when the consumer does:
+        def endless():
+            n = 0
+            while True:
+                n += 1
+                yield n
+
+        elements = BoundedBuffer( max_items=2 ).drain( endless() )
+        self.assertEqual( [ 1 , 2 , 3 ] , [ next( elements ) for n in range( 3 ) ] )
+        elements.close()
+
+
+    @mock.activate
+    def test_fetch(self):
+        '''Buffered fetches yield the same items.'''
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        tbe = Sonar( 'c02' , base_url=self.TST_URL )
+
+        plain = [ i['key'] for i in tbe.fetch_items( 'hotspots' ) ]
+        self.assertIsNone( tbe.client.buffer )
+
+        buffered = [ i['key'] for i in tbe.fetch_items( 'hotspots' , buffer_pages=1 , buffer_bytes=1024 ) ]
+        self.assertEqual( plain , buffered )
+        self.assertEqual( expected['02']['hotspots'] , len(buffered) )
+        self.assertEqual( 0 , tbe.client.buffer.depth )
+
+
+
+class TestSonarStateStore(unittest.TestCase):
+    """Tests resuming fetches from the state store."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.tmp.name , 'state.db' )
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def mock_analysis( self , date ):
+        '''Mocks the last analysis of c01.'''
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_analyses/search?project=c01&ps=1'
+                         , match_querystring=True
+                         , body=json.dumps( { 'analyses': [ { 'key': 'a1' , 'date': date } ] } )
+                         )
+
+
+    def test_store(self):
+        '''Records are written on commit only, and dates only move forward.'''
+        store = StateStore( self.path )
+        store.put( 'c01' , 'history' , 'bugs' , measured_on='2022-03-02T00:00:00+00:00' , digest='d1' )
+        store.put( 'c01' , 'history' , 'bugs' , measured_on='2022-03-01T00:00:00+00:00' )
+
+        # AC1: nothing is visible before the commit:
+        self.assertEqual( {} , store.get( 'c01' , 'history' ) )
+        store.commit()
+
+        # AC2: committed records persist across stores:
+        other = StateStore( self.path )
+        record = other.get( 'c01' , 'history' )['bugs']
+        self.assertEqual( '2022-03-02T00:00:00+00:00' , record['measured_on'] )
+        self.assertEqual( 'd1' , record['digest'] )
+
+        other.put( 'c01' , 'history' , 'bugs' , measured_on='2022-03-01T00:00:00+00:00' , etag='e1' )
+        other.commit()
+        record = store.get( 'c01' , 'history' )['bugs']
+        self.assertEqual( '2022-03-02T00:00:00+00:00' , record['measured_on'] )
+        self.assertEqual( ( 'd1' , 'e1' ) , ( record['digest'] , record['etag'] ) )
+
+        # AC3: buffered updates can be dropped; unknown fields are refused:
+        store.put( 'c02' , 'history' , 'bugs' , digest='d2' )
+        store.rollback()
+        store.commit()
+        self.assertEqual( {} , store.get( 'c02' , 'history' ) )
+        with self.assertRaises( ValueError ):
+            store.put( 'c01' , 'history' , 'bugs' , unknown='field' )
+
+
+    @mock.activate
+    def test_measures(self):
+        '''Measures are only fetched for new analyses, and only changes are yielded.'''
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        self.mock_analysis( '2022-07-01T10:00:00+0200' )
+
+        # AC1: a first fetch yields every measure:
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' ) )
+        self.assertEqual( expected['01']['measures_component_2'] , len(items) )
+
+        # AC2: nothing is fetched while there is no new analysis:
+        requests_sent = len( mock.latest_requests() )
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' ) )
+        self.assertEqual( [] , items )
+        self.assertEqual( requests_sent + 1 , len( mock.latest_requests() ) )
+
+        # AC3: a new analysis which changed nothing yields nothing either:
+        self.mock_analysis( '2022-07-02T10:00:00+0200' )
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' ) )
+        self.assertEqual( [] , items )
+        self.assertIn( 'measures/component' , mock.last_request().path )
+
+
+    @mock.activate
+    def test_history(self):
+        '''Histories are fetched from the last point recorded.'''
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/search_history.*' )
+                         , body=read_file( 'data/c01_history_component_6.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_history_component_6.P1.head.RS' ).replace( "'" , '"' ) )
+                         )
+
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='history' ) )
+        self.assertEqual( 6 , len(set( i['data']['metric'] for i in items )) )
+        self.assertNotIn( 'from' , mock.last_request().querystring )
+
+        # AC1: no point is yielded twice:
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='history' ) )
+        self.assertEqual( [] , items )
+        self.assertIn( 'from' , mock.last_request().querystring )
+
+
+    @mock.activate
+    def test_new_metrics(self):
+        '''Metrics requested after a first fetch get their whole history and their measures.'''
+        def search_history( request , uri , headers ):
+            metrics = request.querystring['metrics'][0].split( ',' )
+            body = { 'paging': { 'pageIndex': 1 , 'pageSize': 1000 , 'total': len(metrics) }
+                   , 'measures': [ { 'metric': metric
+                                   , 'history': [ { 'date': '2022-0{}-01T10:00:00+0000'.format( month ) , 'value': str( month ) }
+                                                  for month in range( 1 , 6 ) if metric != 'accessors' ] }
+                                   for metric in metrics ]
+                   }
+            return [ 200 , headers , json.dumps( body ) ]
+
+        def measures( request , uri , headers ):
+            metrics = request.querystring['metricKeys'][0].split( ',' )
+            body = { 'component': { 'key': 'c01' , 'measures': [ { 'metric': metric , 'value': '1' } for metric in metrics ] } }
+            return [ 200 , headers , json.dumps( body ) ]
+
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/search_history.*' ) , body=search_history )
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' ) , body=measures )
+        self.mock_analysis( '2022-07-01T10:00:00+0200' )
+
+        def fetch( category , metric_keys ):
+            backend = Sonar( 'c01' , base_url=self.TST_URL , state=self.path )
+            return list( backend.fetch( category=category , metricKeys=metric_keys ) )
+
+        # AC1: a metric added later gets its whole history, only once:
+        self.assertEqual( 5 , len( fetch( 'history' , 'bugs' ) ) )
+        items = fetch( 'history' , 'bugs,coverage' )
+        self.assertNotIn( 'from' , mock.last_request().querystring )
+        self.assertEqual( [ 'coverage' ] * 5 , [ i['data']['metric'] for i in items ] )
+        self.assertEqual( [] , fetch( 'history' , 'bugs,coverage' ) )
+        self.assertIn( 'from' , mock.last_request().querystring )
+
+        # AC2: metrics without points don't keep the history from resuming:
+        self.assertEqual( [] , fetch( 'history' , 'bugs,coverage,accessors' ) )
+        self.assertEqual( [] , fetch( 'history' , 'bugs,coverage,accessors' ) )
+        self.assertIn( 'from' , mock.last_request().querystring )
+
+        # AC3: measures of a metric added later are fetched without a new analysis:
+        self.assertEqual( [ 'bugs' ] , [ i['data']['metric'] for i in fetch( 'measures' , 'bugs' ) ] )
+        self.assertEqual( [ 'coverage' ] , [ i['data']['metric'] for i in fetch( 'measures' , 'bugs,coverage' ) ] )
+        requests_sent = len( mock.latest_requests() )
+        self.assertEqual( [] , fetch( 'measures' , 'bugs,coverage' ) )
+        self.assertEqual( requests_sent + 1 , len( mock.latest_requests() ) )
+
+
+    @mock.activate
+    def test_resume(self):
+        '''A broken fetch records nothing, so every issue arrives once the fetch is resumed.'''
+        issues = Utilities.fake_issues( 'c01' , 30 )
+        Utilities.mock_issues( self.TST_URL , { 'c01': issues } )
+
+        items = Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='issues' )
+        consumed = [ next( items ) for n in range( 5 ) ]
+        items.close()
+
+        # AC1: the latest update isn't recorded until every issue is consumed:
+        self.assertEqual( {} , StateStore( self.path ).get( 'c01' , 'issues' ) )
+
+        # AC2: the resumed fetch gets every issue:
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='issues' ) )
+        self.assertEqual( sorted( i['key'] for i in issues ) , sorted( i['data']['key'] for i in items ) )
+
+        last = max( str_to_datetime( i['updateDate'] ) for i in issues )
+        stored = StateStore( self.path ).get( 'c01' , 'issues' )['']['measured_on']
+        self.assertEqual( last , str_to_datetime( stored ) )
+
+        # AC3: the next fetch only gets the issues updated since:
+        updated = [ i['key'] for i in issues if last <= str_to_datetime( i['updateDate'] ) ]
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='issues' ) )
+        self.assertEqual( sorted(updated) , sorted( i['data']['key'] for i in items ) )
+
+
+
+class TestSonarShards(unittest.TestCase):
+    """Tests the multi-process sharded runner."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def test_partition(self):
+        '''Components land on stable shards, in their input order.'''
+        components = [ 'c{:02d}'.format( n ) for n in range( 40 ) ]
+        shards = partition( components , 3 )
+
+        # AC1: every component is in one shard and only one:
+        self.assertEqual( list(enumerate( components )) , sorted( sum( shards , [] ) ) )
+
+        # AC2: the shard only depends on the component:
+        for shard , members in enumerate( shards ):
+            self.assertEqual( sorted( members ) , members )
+            for position , component in members:
+                self.assertEqual( shard , shard_of( component , 3 ) )
+        self.assertEqual( 0 , shard_of( 'c01' , 3 ) )
+
+
+    def test_rate_budget(self):
+        '''Requests are spaced out to the shared rate.'''
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join( tmp , 'budget' )
+            first  = RateBudget( path , 20 )
+            second = RateBudget( path , 20 )
+
+            started = time.time()
+            for n in range( 5 ):
+                first.acquire()
+                second.acquire()
+
+            # 10 requests at 20/s, the first one free:
+            self.assertLessEqual( 0.4 , time.time() - started )
+
+
+    @mock.activate
+    def test_run(self):
+        '''Shards are fetched on their own processes and merged in order.'''
+        projects , expected = Utilities.mock_full_projects( self.TST_URL )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/hotspots/search?projectKey=c03&ps={}'.format( PER_PAGE ) , match_querystring=True , status=404 )
+        components = [ 'c02' , 'c03' , 'c01' ]
+
+        # AC1: merged stream, by component in the input order; failures are left out:
+        runner = ShardedRunner( components , 3 , base_url=self.TST_URL , category='hotspots'
+                              , rate=1000 , start_method='fork' )
+        items = list( runner.items() )
+
+        self.assertEqual( expected['02']['hotspots'] + expected['01']['hotspots'] , len(items) )
+        projects = [ i['data']['project'] for i in items ]
+        self.assertEqual( [ 'c02' ] * expected['02']['hotspots'] + [ 'c01' ] * expected['01']['hotspots'] , projects )
+        self.assertEqual( 'hotspots' , items[0]['category'] )
+        self.assertEqual( [ 'c03' ] , runner.failed )
+        self.assertFalse( os.path.exists( runner._dir ) )
+
+        # AC2: one file per shard:
+        with tempfile.TemporaryDirectory() as tmp:
+            runner = ShardedRunner( [ 'c01' , 'c02' ] , 2 , base_url=self.TST_URL , output_dir=tmp
+                                  , start_method='fork' )
+            paths = runner.run()
+
+            self.assertEqual( [ os.path.join( tmp , 'shard-0.jsonl' ) , os.path.join( tmp , 'shard-1.jsonl' ) ] , paths )
+            with open( paths[ shard_of( 'c01' , 2 ) ] ) as f:
+                lines = [ json.loads( line ) for line in f ]
+            self.assertEqual( expected['01']['measures_component_2'] + expected['02']['measures_component_2'] , len(lines) )
+
+        # AC3: the components of a process dying outside their fetch fail, instead of hanging:
+        runner = ShardedRunner( [ 'c01' , 'c02' ] , 2 , base_url=self.TST_URL , state='/nonexistent/dir/state.db'
+                              , start_method='fork' )
+        self.assertEqual( [] , list( runner.items() ) )
+        self.assertEqual( [ 'c01' , 'c02' ] , sorted( runner.failed ) )
+
+        # AC4: the command line passes the tag and fetch arguments to the shards:
+        with patch( 'perceval.backends.sonarqube.shards.ShardedRunner' ) as runner:
+            runner.return_value.failed = []
+            runner.return_value.items.return_value = []
+            status = shards_main( [ '--base-url' , self.TST_URL , '--shards' , '2' , '--tag' , 'sharded'
+                                  , '--metricKeys' , 'bugs' , '--from-date' , '2022-01-01' , '--prefetch' , '3' , 'c01' ] )
+
+        self.assertEqual( 0 , status )
+        args , kwargs = runner.call_args
+        self.assertEqual( ( [ 'c01' ] , 2 ) , args )
+        self.assertEqual( 'sharded' , kwargs['tag'] )
+        self.assertEqual( { 'metricKeys': 'bugs' , 'prefetch': 3 , 'from_date': str_to_datetime( '2022-01-01' ) }
+                        , kwargs['fetch_args'] )
+
+
+
+class TestSonarWebhook(unittest.TestCase):
+    """Tests the webhook receiver, posting to it as Sonarqube would."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.tmp.name , 'state.db' )
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def mock_sonar(self):
+        '''Mocks the measures and history of c01.'''
+        Utilities.mock_pages( 'c01_measures_component_2' , self.TST_URL + 'api/measures/component?component=c01&metricKeys=accessors,new_technical_debt' , 1 )
+        Utilities.mock_pages( 'c01_metric_keys' , self.TST_URL + 'api/metrics/search' , 1 )
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/search_history.*' )
+                         , body=read_file( 'data/c01_history_component_6.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_history_component_6.P1.head.RS' ).replace( "'" , '"' ) )
+                         )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_analyses/search?project=c01&ps=1'
+                         , match_querystring=True
+                         , body=json.dumps( { 'analyses': [ { 'key': 'a1' , 'date': '2022-07-01T10:00:00+0200' } ] } )
+                         )
+
+
+    def post( self , receiver , payload , headers=None ):
+        '''Fake sender: posts a payload to the receiver and returns the status.'''
+        import http.client
+        body = payload if isinstance( payload , bytes ) else json.dumps( payload ).encode( 'utf-8' )
+        connection = http.client.HTTPConnection( *receiver.address , timeout=10 )
+        try:
+            connection.request( 'POST' , '/' , body=body , headers=headers or {} )
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+
+    def test_post(self):
+        '''Posts of successful analyses queue their component.'''
+        fetched = []
+        receiver = WebhookReceiver( sink=None )
+        receiver.fetch = fetched.append
+        receiver.start()
+        try:
+            analysis = { 'taskId': 't1' , 'status': 'SUCCESS' , 'project': { 'key': 'c01' } }
+
+            # AC1: the component of a successful analysis is fetched:
+            self.assertEqual( 202 , self.post( receiver , analysis ) )
+            receiver.join()
+            self.assertEqual( [ 'c01' ] , fetched )
+
+            # AC2: failed analyses and broken payloads fetch nothing:
+            self.assertEqual( 200 , self.post( receiver , dict( analysis , status='FAILED' ) ) )
+            self.assertEqual( 400 , self.post( receiver , { 'status': 'SUCCESS' } ) )
+            self.assertEqual( 400 , self.post( receiver , b'not json' ) )
+            receiver.join()
+            self.assertEqual( [ 'c01' ] , fetched )
+        finally:
+            receiver.stop()
+
+
+    def test_signature(self):
+        '''Payloads are only accepted with the signature of the secret.'''
+        import hashlib , hmac
+        receiver = WebhookReceiver( secret='s3cret' , sink=None )
+        receiver.fetch = lambda component: 0
+        receiver.start()
+        try:
+            body = json.dumps( { 'status': 'SUCCESS' , 'project': { 'key': 'c01' } } ).encode( 'utf-8' )
+            signature = hmac.new( b's3cret' , body , hashlib.sha256 ).hexdigest()
+
+            self.assertEqual( 401 , self.post( receiver , body ) )
+            self.assertEqual( 401 , self.post( receiver , body , { 'X-Sonar-Webhook-HMAC-SHA256': 'f00' } ) )
+            self.assertEqual( 202 , self.post( receiver , body , { 'X-Sonar-Webhook-HMAC-SHA256': signature } ) )
+        finally:
+            receiver.stop()
+
+
+    def test_fetch(self):
+        '''Measures and history of a component are fetched from the last cursor.'''
+        items = []
+        # httpretty takes over sockets, so payloads are handed over directly:
+        receiver = WebhookReceiver( base_url=self.TST_URL , sink=items.append , state=self.path )
+        receiver.start()
+        mock.enable()
+        try:
+            self.mock_sonar()
+            analysis = { 'taskId': 't1' , 'status': 'SUCCESS' , 'project': { 'key': 'c01' } }
+
+            # AC1: measures and history of the component reach the sink:
+            self.assertTrue( receiver.receive( analysis ) )
+            receiver.join()
+            categories = [ i['category'] for i in items ]
+            self.assertEqual( 2 , categories.count( 'measures' ) )
+            self.assertEqual( 6 , len(set( i['data']['metric'] for i in items if i['category'] == 'history' )) )
+
+            # AC2: history is fetched from the last point; nothing is repeated:
+            del items[:]
+            self.assertTrue( receiver.receive( analysis ) )
+            receiver.join()
+            self.assertEqual( [] , items )
+            self.assertIn( 'from' , mock.last_request().querystring )
+            self.assertEqual( [ 'c01' ] , list( receiver.backends ) )
+        finally:
+            mock.disable()
+            mock.reset()
+            receiver.stop()
+
+
+    def test_branches(self):
+        '''Analyses of branches and pull requests fetch them instead of the main branch.'''
+        fetched = []
+        receiver = WebhookReceiver( sink=None )
+        receiver.fetch = lambda component , **target: fetched.append( ( component , target ) )
+        receiver.start()
+        try:
+            analysis = { 'taskId': 't1' , 'status': 'SUCCESS' , 'project': { 'key': 'c01' } }
+            main = dict( analysis , branch={ 'name': 'main' , 'type': 'BRANCH' , 'isMain': True } )
+            branch = dict( analysis , branch={ 'name': 'feature/x' , 'type': 'BRANCH' , 'isMain': False } )
+            pull_request = dict( analysis , branch={ 'name': '12' , 'type': 'PULL_REQUEST' , 'isMain': False } )
+
+            for payload in ( main , branch , pull_request ):
+                self.assertEqual( 202 , self.post( receiver , payload ) )
+                receiver.join()
+            self.assertEqual( [ ( 'c01' , {} ) , ( 'c01' , { 'branch': 'feature/x' } ) , ( 'c01' , { 'pullRequest': '12' } ) ]
+                            , fetched )
+        finally:
+            receiver.stop()
+
+        # AC2: their items carry the branch, which takes part in their ids:
+        items = []
+        receiver = WebhookReceiver( base_url=self.TST_URL , sink=items.append , categories=( 'measures' , ) )
+        receiver.start()
+        mock.enable()
+        try:
+            mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' )
+                             , body=read_file( 'data/c01_measures_component_2.P1.body.RS' , mode='rb' )
+                             , forcing_headers=json.loads( read_file( 'data/c01_measures_component_2.P1.head.RS' ).replace( "'" , '"' ) ) )
+            mock.register_uri( mock.GET , self.TST_URL + 'api/project_analyses/search?project=c01&ps=1'
+                             , match_querystring=True
+                             , body=json.dumps( { 'analyses': [ { 'key': 'a1' , 'date': '2022-07-01T10:00:00+0200' } ] } )
+                             )
+            self.assertTrue( receiver.receive( branch ) )
+            receiver.join()
+            self.assertEqual( [ 'feature/x' ] , mock.last_request().querystring['branch'] )
+            self.assertEqual( [ 'feature/x' ] * 2 , [ i['data']['branch'] for i in items ] )
+
+            self.assertTrue( receiver.receive( analysis ) )
+            receiver.join()
+            self.assertNotIn( 'branch' , mock.last_request().querystring )
+            self.assertEqual( 4 , len(set( i['uuid'] for i in items )) )
+        finally:
+            mock.disable()
+            mock.reset()
+            receiver.stop()
+
+
+
+class TestSonarArchive(unittest.TestCase):
+    """Tests request fingerprints and archived body deduplication."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def test_fingerprint(self):
+        '''The same logical request gets the same fingerprint.'''
+        base = 'https://a.sonarqube.instance/api/measures/component'
+
+        # AC1: parameters and metric keys are sorted, and repeated keys dropped:
+        self.assertEqual( fingerprint( base + '?component=c01&metricKeys=bugs,accessors' )
+                        , fingerprint( base + '?metricKeys=accessors,bugs,bugs&component=c01' ) )
+
+        # AC2: the first page is the one without page number; others differ:
+        self.assertEqual( fingerprint( base + '?component=c01' ) , fingerprint( base + '?component=c01&p=1' ) )
+        self.assertNotEqual( fingerprint( base + '?component=c01' ) , fingerprint( base + '?component=c01&ps=20&p=2' ) )
+
+        # AC3: ETags are left out of the key:
+        self.assertEqual( { 'Accept': 'json' } , archive_headers( { 'Accept': 'json' , 'If-None-Match': '"e1"' } ) )
+
+
+    @mock.activate
+    def test_dedup(self):
+        '''Identical bodies are archived once across runs.'''
+        from perceval.archive import ArchiveManager
+        from perceval.errors import ArchiveError
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' )
+                         , body=read_file( 'data/c01_measures_component_2.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_measures_component_2.P1.head.RS' ).replace( "'" , '"' ) )
+                         )
+        manager = ArchiveManager( self.tmp.name )
+
+        # AC1: runs with the metric keys in any order share the body:
+        archives = []
+        for keys in ( 'accessors,new_technical_debt' , 'new_technical_debt,accessors' ):
+            archive = manager.create_archive()
+            items = list( Sonar( 'c01' , base_url=self.TST_URL , archive=archive ).fetch( category='measures' , metricKeys=keys ) )
+            self.assertEqual( 2 , len(items) )
+            archives.append( archive )
+
+        bodies = BodyStore( os.path.join( self.tmp.name , 'sonarqube-bodies.sqlite3' ) )
+        self.assertEqual( 1 , len(bodies) )
+
+        # AC2: archived responses get their body back:
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , archive=archives[1] ).fetch_from_archive() )
+        self.assertEqual( [ 'blocker_violations' , 'bugs' ] , [ i['data']['metric'] for i in items ] )
+
+        # AC3: a lost body is reported:
+        bodies._db.execute( 'DELETE FROM bodies' )
+        bodies._db.commit()
+        with self.assertRaises( ArchiveError ):
+            list( Sonar( 'c01' , base_url=self.TST_URL , archive=archives[0] ).fetch_from_archive() )
+
+
+    def response(self , status , body ):
+        '''Makes a response as requests would.'''
+        import requests
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        return response
+
+
+    def test_conditional(self):
+        '''Responses to conditional requests are only found with their ETag.'''
+        from perceval.archive import ArchiveManager
+        archive = DedupArchive( ArchiveManager( self.tmp.name ).create_archive() , BodyStore( os.path.join( self.tmp.name , 'bodies' ) ) )
+        url = self.TST_URL + 'api/measures/component?component=c01'
+
+        archive.store( url , None , { 'If-None-Match': '"e1"' } , self.response( 200 , b'{"v": 1}' ) )
+        archive.store( url , None , { 'If-None-Match': '"e2"' } , self.response( 304 , b'' ) )
+
+        # AC1: the 304 answers the ETag it was sent with:
+        self.assertEqual( 304 , archive.retrieve( url , None , { 'If-None-Match': '"e2"' } ).status_code )
+
+        # AC2: any other request gets the full response:
+        for headers in ( { 'If-None-Match': '"e1"' } , { 'If-None-Match': '"e3"' } , None ):
+            response = archive.retrieve( url , None , headers )
+            self.assertEqual( ( 200 , b'{"v": 1}' ) , ( response.status_code , response.content ) )
+
+
+    def test_prune(self):
+        '''Bodies of deleted archives can be removed.'''
+        from perceval.archive import Archive, ArchiveManager
+        manager = ArchiveManager( self.tmp.name )
+        url = self.TST_URL + 'api/measures/component?component=c01'
+
+        # AC1: managed archives share the store at the root; others get one next to them:
+        archives = [ manager.create_archive() , manager.create_archive() ]
+        self.assertEqual( os.path.join( self.tmp.name , 'sonarqube-bodies.sqlite3' ) , default_body_store( archives[0] ) )
+        other = Archive.create( os.path.join( self.tmp.name , 'other.sqlite3' ) )
+        self.assertEqual( os.path.join( self.tmp.name , 'sonarqube-bodies.sqlite3' ) , default_body_store( other ) )
+        os.makedirs( os.path.join( self.tmp.name , 'runs' ) )
+        other = Archive.create( os.path.join( self.tmp.name , 'runs' , 'other.sqlite3' ) )
+        self.assertEqual( os.path.join( self.tmp.name , 'runs' , 'sonarqube-bodies.sqlite3' ) , default_body_store( other ) )
+
+        # AC2: only the bodies no archive points at are removed:
+        bodies = BodyStore( default_body_store( archives[0] ) )
+        for n , archive in enumerate( archives ):
+            DedupArchive( archive , bodies ).store( url , None , None , self.response( 200 , b'shared' ) )
+            DedupArchive( archive , bodies ).store( url + '&p=2' , None , None , self.response( 200 , str( n ).encode() ) )
+        self.assertEqual( 3 , len(bodies) )
+
+        os.remove( archives[0].archive_path )
+        self.assertEqual( 1 , prune_bodies( self.tmp.name ) )
+        self.assertEqual( 2 , len(bodies) )
+        self.assertEqual( b'1' , DedupArchive( archives[1] , bodies ).retrieve( url + '&p=2' , None , None ).content )
+
+
+
+class TestSonarBranches(unittest.TestCase):
+    """Tests the fan out to branches and pull requests."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.tmp.name , 'state.db' )
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def mock_branches( self , feature_date ):
+        '''Mocks the main branch, a feature branch and a pull request of c01.'''
+        branches = [ { 'name': 'master' , 'isMain': True , 'analysisDate': '2022-07-01T10:00:00+0200' }
+                   , { 'name': 'feature/x' , 'isMain': False , 'analysisDate': feature_date }
+                   , { 'name': 'stale' , 'isMain': False } ]
+        pull_requests = [ { 'key': '12' , 'branch': 'fix' , 'analysisDate': '2022-07-03T10:00:00+0200' } ]
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_branches/list?project=c01'
+                         , match_querystring=True , body=json.dumps( { 'branches': branches } ) )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_pull_requests/list?project=c01'
+                         , match_querystring=True , body=json.dumps( { 'pullRequests': pull_requests } ) )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/project_analyses/search?project=c01&ps=1'
+                         , match_querystring=True
+                         , body=json.dumps( { 'analyses': [ { 'key': 'a1' , 'date': '2022-07-01T10:00:00+0200' } ] } ) )
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' )
+                         , body=read_file( 'data/c01_measures_component_2.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_measures_component_2.P1.head.RS' ).replace( "'" , '"' ) ) )
+
+
+    def measures_requests(self):
+        '''Branches and pull requests of the measures requests sent.'''
+        requests_sent = [ r.querystring for r in mock.latest_requests() if 'measures/component' in r.path ]
+        return sorted( ( q.get( 'branch' , [''] )[0] , q.get( 'pullRequest' , [''] )[0] ) for q in requests_sent )
+
+
+    @mock.activate
+    def test_fan_out(self):
+        '''Measures of every analysed branch and pull request are fetched.'''
+        self.mock_branches( '2022-07-02T10:00:00+0200' )
+
+        items = list( Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , all_branches=True , workers=2 ) )
+
+        # AC1: main branch, feature branch and pull request; never analysed branches are left out:
+        self.assertEqual( [ ( '' , '' ) , ( '' , '12' ) , ( 'feature/x' , '' ) ] , self.measures_requests() )
+        targets = [ ( i['data'].get( 'branch' ) , i['data'].get( 'pullRequest' ) ) for i in items ]
+        self.assertEqual( [ ( None , None ) ] * 2 + [ ( 'feature/x' , None ) ] * 2 + [ ( None , '12' ) ] * 2 , targets )
+
+        # AC2: the branch or pull request takes part in the ids:
+        self.assertEqual( 6 , len(set( i['data']['id'] for i in items )) )
+
+        # AC3: targets stream through bounded buffers, which stop when the fetch is closed:
+        with patch( 'perceval.backends.sonarqube.sonarqube.BRANCH_BUFFER_ITEMS' , 1 ):
+            items = list( Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , all_branches=True , workers=2 ) )
+            self.assertEqual( targets , [ ( i['data'].get( 'branch' ) , i['data'].get( 'pullRequest' ) ) for i in items ] )
+
+            items = Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , all_branches=True , workers=2 )
+            consumed = [ next( items ) for n in range( 3 ) ]
+            items.close()
+            self.assertEqual( 'feature/x' , consumed[2]['data']['branch'] )
+
+
+    @mock.activate
+    def test_skip_unchanged(self):
+        '''Branches not analysed since the last fetch are skipped.'''
+        self.mock_branches( '2022-07-02T10:00:00+0200' )
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' , all_branches=True ) )
+        self.assertEqual( 6 , len(items) )
+
+        # AC1: nothing was analysed again, nothing is fetched:
+        mock.reset()
+        self.mock_branches( '2022-07-02T10:00:00+0200' )
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' , all_branches=True ) )
+        self.assertEqual( [] , items )
+        self.assertEqual( [] , self.measures_requests() )
+
+        # AC2: only the branch analysed again is fetched:
+        mock.reset()
+        self.mock_branches( '2022-07-04T10:00:00+0200' )
+        items = list( Sonar( 'c01' , base_url=self.TST_URL , state=self.path ).fetch( category='measures' , all_branches=True ) )
+        self.assertEqual( [ 'feature/x' ] * 2 , [ i['data']['branch'] for i in items ] )
+        self.assertEqual( [ ( 'feature/x' , '' ) ] , self.measures_requests() )
+
+        # AC3: branch items don't touch the records of the main branch:
+        self.assertEqual( { '' , 'blocker_violations' , 'bugs' , 'branch:feature/x' , 'pullRequest:12' }
+                        , set( StateStore( self.path ).get( 'c01' , 'measures' ) ) )
+
+
+
+class TestSonarSinks(unittest.TestCase):
+    """Tests the output sinks."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def items( self , n ):
+        '''Fake perceval items.'''
+        return [ { 'uuid': 'u{}'.format( i ) , 'category': 'measures' , 'updated_on': float( i ) , 'data': { 'value': i } }
+                 for i in range( n ) ]
+
+
+    def test_batches(self):
+        '''Items are written in full batches, or when they waited long enough.'''
+        now = [ 0 ]
+        written = []
+        sink = Sink( 'nowhere' , batch_size=3 , flush_interval=10 , clock=lambda: now[0] )
+        sink._write_batch = lambda items: written.append( [ i['uuid'] for i in items ] )
+
+        # AC1: a full batch is written at once:
+        for item in self.items( 4 ):
+            sink( item )
+        self.assertEqual( [ [ 'u0' , 'u1' , 'u2' ] ] , written )
+
+        # AC2: pending items are written after the flush interval, and on closing:
+        now[0] = 11
+        sink.write( self.items( 6 )[5] )
+        self.assertEqual( [ 'u3' , 'u5' ] , written[-1] )
+        sink.write( self.items( 7 )[6] )
+        sink.close()
+        self.assertEqual( [ 'u6' ] , written[-1] )
+        self.assertEqual( ( 6 , 3 ) , ( sink.nitems , sink.nbatches ) )
+
+        # AC3: pending items are written on time, even when no more items arrive:
+        written = []
+        sink = Sink( 'nowhere' , batch_size=3 , flush_interval=0.05 )
+        sink._write_batch = lambda items: written.append( [ i['uuid'] for i in items ] )
+        sink.write( self.items( 1 )[0] )
+        for _ in range( 100 ):
+            if written:
+                break
+            time.sleep( 0.05 )
+        self.assertEqual( [ [ 'u0' ] ] , written )
+        sink.close()
+        self.assertEqual( ( 1 , 1 ) , ( sink.nitems , sink.nbatches ) )
+
+
+    def test_files(self):
+        '''File sinks write JSON lines, compressed or as Elasticsearch bulk bodies.'''
+        import gzip
+
+        # AC1: compression is guessed from the suffix:
+        path = os.path.join( self.tmp.name , 'items.ndjson.gz' )
+        with open_sink( 'ndjson' , path , batch_size=2 ) as sink:
+            for item in self.items( 5 ):
+                sink.write( item )
+        self.assertEqual( 'gzip' , sink.compression )
+        with gzip.open( path , 'rt' ) as f:
+            self.assertEqual( self.items( 5 ) , [ json.loads( line ) for line in f ] )
+
+        # AC2: bulk bodies index each item by its uuid:
+        path = os.path.join( self.tmp.name , 'items.bulk' )
+        with open_sink( 'es-bulk' , path , index='sonar-test' ) as sink:
+            for item in self.items( 2 ):
+                sink.write( item )
+        with open( path ) as f:
+            lines = [ json.loads( line ) for line in f ]
+        self.assertEqual( { 'index': { '_index': 'sonar-test' , '_id': 'u1' } } , lines[2] )
+        self.assertEqual( self.items( 2 )[1] , lines[3] )
+
+        # AC3: unknown sinks and compressions are refused:
+        with self.assertRaises( ValueError ):
+            open_sink( 'csv' , path )
+        with self.assertRaises( ValueError ):
+            open_sink( 'ndjson' , path , compression='lzma' )
+
+        # AC4: options not given take their default, but None is passed through:
+        with open_sink( 'ndjson' , path , flush_interval=NOT_GIVEN , table=NOT_GIVEN ) as sink:
+            self.assertEqual( DEFAULT_FLUSH_INTERVAL , sink.flush_interval )
+        with open_sink( 'ndjson' , path , flush_interval=None ) as sink:
+            self.assertIsNone( sink.flush_interval )
+
+        # AC5: options of other kinds of sinks are left out, unknown options are refused:
+        with open_sink( 'ndjson' , path , index='sonar-test' , table='items' ) as sink:
+            self.assertIsNone( sink.compression )
+        with open_sink( 'sqlite' , os.path.join( self.tmp.name , 'items.db' ) , compression='gzip' , index='sonar-test' ) as sink:
+            self.assertEqual( 'items' , sink.table )
+        with self.assertRaises( ValueError ):
+            open_sink( 'ndjson' , path , level=9 )
+
+
+    def test_sqlite(self):
+        '''Items are written into a table, replacing those written before.'''
+        import sqlite3
+        path = os.path.join( self.tmp.name , 'items.db' )
+        for n in ( 3 , 5 ):
+            with open_sink( 'sqlite' , path , batch_size=2 ) as sink:
+                for item in self.items( n ):
+                    sink.write( item )
+
+        rows = sqlite3.connect( path ).execute( 'SELECT uuid, category, item FROM items ORDER BY uuid' ).fetchall()
+        self.assertEqual( [ 'u0' , 'u1' , 'u2' , 'u3' , 'u4' ] , [ r[0] for r in rows ] )
+        self.assertEqual( self.items( 5 )[4] , json.loads( rows[4][2] ) )
+
+
+    @mock.activate
+    def test_command(self):
+        '''The command writes the fetched items to the sink.'''
+        import sqlite3
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' )
+                         , body=read_file( 'data/c01_measures_component_2.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_measures_component_2.P1.head.RS' ).replace( "'" , '"' ) ) )
+        path = os.path.join( self.tmp.name , 'items.db' )
+
+        # AC1: a sink needs a path:
+        with self.assertRaises( InvalidArgument ):
+            SonarCommand( '--base-url' , self.TST_URL , '--no-archive' , '--sink' , 'sqlite' , 'c01' )
+
+        cmd = SonarCommand( '--base-url' , self.TST_URL , '--no-archive' , '--category' , 'measures'
+                          , '--sink' , 'sqlite' , '--sink-path' , path , '--sink-batch-size' , '10' , 'c01' )
+        self.assertNotIn( 'sink' , vars( cmd.parsed_args ) )
+        self.assertIs( NOT_GIVEN , cmd.sink_args['sink_flush_interval'] )
+        cmd.run()
+
+        # AC2: the items went to the sink:
+        rows = sqlite3.connect( path ).execute( 'SELECT category, item FROM items' ).fetchall()
+        self.assertEqual( [ 'measures' ] * 2 , [ r[0] for r in rows ] )
+        self.assertEqual( { 'blocker_violations' , 'bugs' } , set( json.loads( r[1] )['data']['metric'] for r in rows ) )
+
+        # AC3: options of other sinks don't get in the way:
+        path = os.path.join( self.tmp.name , 'other.db' )
+        SonarCommand( '--base-url' , self.TST_URL , '--no-archive' , '--category' , 'measures'
+                    , '--sink' , 'sqlite' , '--sink-path' , path , '--sink-compression' , 'gzip' , 'c01' ).run()
+        rows = sqlite3.connect( path ).execute( 'SELECT category FROM items' ).fetchall()
+        self.assertEqual( 2 , len(rows) )
+
+        # AC4: the flush interval can be turned off:
+        cmd = SonarCommand( '--base-url' , self.TST_URL , '--no-archive' , '--category' , 'measures'
+                          , '--sink' , 'sqlite' , '--sink-path' , path , '--sink-flush-interval' , 'none' , 'c01' )
+        self.assertIsNone( cmd.sink_args['sink_flush_interval'] )
+
+
+
+class TestSonarPreflight(unittest.TestCase):
+    """Tests the cached preflight checks."""
+
+    TST_URL = 'https://a.sonarqube.instance/'
+
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.tmp.name , 'preflight.json' )
+        PreflightCache._caches.clear()
+
+
+    def tearDown(self):
+        PreflightCache._caches.clear()
+        self.tmp.cleanup()
+
+
+    def mock_sonar(self):
+        '''Mocks c01, a missing c0x, three metrics and the measures of c01.'''
+        mock.register_uri( mock.GET , self.TST_URL + 'api/components/show?component=c01'
+                         , match_querystring=True , body=json.dumps( { 'component': { 'key': 'c01' } } ) )
+        mock.register_uri( mock.GET , self.TST_URL + 'api/components/show?component=c0x'
+                         , match_querystring=True , status=404 , body=json.dumps( { 'errors': [] } ) )
+        for page , keys in ( ( 1 , [ 'accessors' , 'bugs' ] ) , ( 2 , [ 'new_technical_debt' ] ) ):
+            mock.register_uri( mock.GET , self.TST_URL + 'api/metrics/search?ps=500&p={}'.format( page )
+                             , match_querystring=True
+                             , body=json.dumps( { 'metrics': [ { 'key': k } for k in keys ] , 'total': 501 , 'p': page , 'ps': 500 } ) )
+        mock.register_uri( mock.GET , re.compile( re.escape( self.TST_URL ) + r'api/measures/component.*' )
+                         , body=read_file( 'data/c01_measures_component_2.P1.body.RS' , mode='rb' )
+                         , forcing_headers=json.loads( read_file( 'data/c01_measures_component_2.P1.head.RS' ).replace( "'" , '"' ) ) )
+
+
+    def paths(self):
+        '''Paths of the requests sent.'''
+        return [ r.path.split( '?' )[0] for r in mock.latest_requests() ]
+
+
+    def test_cache(self):
+        '''Entries expire after the TTL and persist across processes.'''
+        now = [ 1000 ]
+        cache = PreflightCache( self.path , ttl=60 , clock=lambda: now[0] )
+        cache.put( 'component c01' , True )
+
+        # AC1: entries are valid until they expire:
+        self.assertTrue( cache.get( 'component c01' ) )
+        now[0] += 60
+        self.assertIsNone( cache.get( 'component c01' ) )
+
+        # AC2: entries are kept on disk:
+        cache.put( 'metrics' , [ 'bugs' ] )
+        other = PreflightCache( self.path , ttl=60 , clock=lambda: now[0] )
+        self.assertEqual( [ 'bugs' ] , other.get( 'metrics' ) )
+
+        # AC3: the caches of a path are shared by the process:
+        self.assertIs( PreflightCache.open( self.path ) , PreflightCache.open( self.path ) )
+
+
+    @mock.activate
+    def test_preflight(self):
+        '''Missing components and unknown metric keys fail before any fetch.'''
+        self.mock_sonar()
+
+        with patch( 'perceval.backends.sonarqube.client.DEFAULT_PREFLIGHT_FILE' , self.path ):
+            # AC1: a missing component fails fast:
+            with self.assertRaises( InvalidArgument ):
+                list( Sonar( 'c0x' , base_url=self.TST_URL ).fetch( category='measures' , preflight=True ) )
+            self.assertEqual( [ '/api/components/show' ] , self.paths() )
+
+            # AC2: so do unknown metric keys, checked against every page of metrics:
+            with self.assertRaises( InvalidArgument ):
+                list( Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , metricKeys='bugs,bugz' , preflight=True ) )
+            self.assertNotIn( '/api/measures/component' , self.paths() )
+
+            items = list( Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , metricKeys='new_technical_debt,bugs' , preflight=True ) )
+            self.assertEqual( 2 , len(items) )
+
+            # AC3: results are memoized in memory and on disk, but for missing components:
+            PreflightCache._caches.clear()
+            requests_sent = len( mock.latest_requests() )
+            with self.assertRaises( InvalidArgument ):
+                list( Sonar( 'c0x' , base_url=self.TST_URL ).fetch( category='measures' , preflight=True ) )
+            items = list( Sonar( 'c01' , base_url=self.TST_URL ).fetch( category='measures' , metricKeys='bugs' , preflight=True ) )
+            self.assertEqual( [ '/api/components/show' , '/api/measures/component' ] , self.paths()[requests_sent:] )
+
+        # AC4: the metric types come from every page of metrics, requested once per client:
+        client = SonarClient( 'c01' , base_url=self.TST_URL )
+        requests_sent = len( mock.latest_requests() )
+        self.assertEqual( [ 'accessors' , 'bugs' , 'new_technical_debt' ] , sorted( client.metric_types() ) )
+        self.assertEqual( [ 'accessors' , 'bugs' , 'new_technical_debt' ] , sorted( client.metric_keys_on_server() ) )
+        self.assertEqual( [ '/api/metrics/search' ] * 2 , self.paths()[requests_sent:] )
+
+
+
 class TestSonarClientAgainstConfigurations(unittest.TestCase):
 
     @classmethod
@@ -286,6 +1742,188 @@ class TestSonarClientAgainstConfigurations(unittest.TestCase):
 
 
 
+class TestSonarClientSessionPool(unittest.TestCase):
+    """Tests the process-wide pool of HTTP sessions."""
+
+    API_URL = 'https://a.sonarqube.instance/'
+    TST_DIR = 'tests/data/'
+
+
+    def tearDown(self):
+        close_pooled_sessions()
+
+
+    def test_shared_by_host(self):
+        '''Clients of the same host and settings share one session.'''
+        sc1 = SonarClient( 'c01', base_url=self.API_URL )
+        sc2 = SonarClient( 'c02', base_url=self.API_URL )
+        self.assertIs( sc1.session , sc2.session )
+
+        # AC2: other hosts and SSL settings get their own session:
+        sc3 = SonarClient( 'c01', base_url='https://another.sonarqube.instance/' )
+        sc4 = SonarClient( 'c01', base_url=self.API_URL, config=self.TST_DIR + 'sonarqube-ssl_verify-No.cfg' )
+        self.assertIsNot( sc1.session , sc3.session )
+        self.assertIsNot( sc1.session , sc4.session )
+
+        # AC3: the pool size reaches the adapters:
+        adapter = sc1.session.get_adapter( self.API_URL )
+        self.assertEqual( DEFAULT_POOL_SIZE , adapter._pool_maxsize )
+
+        # AC4: deleting a client leaves the session alive for the others:
+        del sc2
+        self.assertIs( sc1.session , SonarClient( 'c03', base_url=self.API_URL ).session )
+
+
+    def test_transports(self):
+        '''Transports are pluggable.'''
+        used = []
+
+        def factory( client , retries ):
+            used.append( client.component )
+            return requests.adapters.HTTPAdapter( max_retries=retries )
+
+        register_transport( 'custom' , factory )
+        sc = SonarClient( 'c01', base_url=self.API_URL )
+        sc.transport = 'custom'
+        pooled_session( sc )
+        self.assertEqual( ['c01'] , used )
+
+        # AC2: unknown transports are rejected:
+        sc.transport = 'pigeon'
+        with self.assertRaises( InvalidArgument ):
+            pooled_session( sc )
+
+
+
+class TestSonarHTTP2Adapter(unittest.TestCase):
+    """Tests the HTTP/2 transport adapter against a stub httpx module."""
+
+
+    def stub_httpx(self):
+        '''Builds an httpx module whose clients send out its answers, or raise them, in order.'''
+        import types
+        httpx = types.ModuleType( 'httpx' )
+        httpx.answers = []
+        httpx.sent = []
+
+        class TransportError( Exception ):
+            pass
+
+        class Answer:
+            def __init__( self , status_code , content=b'' , headers=None ):
+                self.status_code = status_code
+                self.content = content
+                self.headers = headers or {}
+                self.reason_phrase = 'Whatever'
+                self.encoding = 'utf-8'
+                self.closed = False
+
+            def iter_bytes( self , chunk_size=None ):
+                size = chunk_size or len( self.content )
+                for start in range( 0 , len( self.content ) , size ):
+                    yield self.content[ start : start + size ]
+
+            def read( self ):
+                return self.content
+
+            def close( self ):
+                self.closed = True
+
+        class Client:
+            def __init__( self , **kwargs ):
+                self.kwargs = kwargs
+
+            def build_request( self , method , url , **kwargs ):
+                return ( method , url , kwargs )
+
+            def send( self , request , stream=False ):
+                httpx.sent.append( ( request , stream ) )
+                answer = httpx.answers.pop( 0 )
+                if isinstance( answer , Exception ):
+                    raise answer
+                return answer
+
+            def close( self ):
+                pass
+
+        httpx.TransportError = TransportError
+        httpx.ConnectError = type( 'ConnectError' , ( TransportError , ) , {} )
+        httpx.ConnectTimeout = type( 'ConnectTimeout' , ( TransportError , ) , {} )
+        httpx.ReadTimeout = type( 'ReadTimeout' , ( TransportError , ) , {} )
+        httpx.Timeout = lambda timeout , **kwargs: ( timeout , kwargs )
+        httpx.Limits = lambda **kwargs: kwargs
+        httpx.Client = Client
+        httpx.Answer = Answer
+        return httpx
+
+
+    def send( self , httpx , retries=2 , **kwargs ):
+        '''Sends a GET through an adapter using the stub httpx.'''
+        policy = urllib3.util.Retry( total=retries , status_forcelist=[ 503 ] , backoff_factor=0 )
+        request = requests.Request( 'GET' , 'https://a.sonarqube.instance/api/metrics/search' ).prepare()
+        with patch.dict( sys.modules , { 'httpx': httpx } ):
+            return HTTP2Adapter( max_retries=policy ).send( request , **kwargs )
+
+
+    def test_retry_on_status(self):
+        '''Statuses listed by the policy are sent again.'''
+        httpx = self.stub_httpx()
+        busy = httpx.Answer( 503 )
+        httpx.answers += [ busy , httpx.Answer( 200 , b'{"metrics": []}' ) ]
+
+        response = self.send( httpx , timeout=( 3 , 7 ) )
+        self.assertEqual( 200 , response.status_code )
+        self.assertEqual( { 'metrics': [] } , response.json() )
+        self.assertEqual( 2 , len( httpx.sent ) )
+        self.assertTrue( busy.closed )
+
+        # AC2: timeouts reach httpx as connect and read timeouts:
+        self.assertEqual( ( None , { 'connect': 3 , 'read': 7 } ) , httpx.sent[0][0][2]['timeout'] )
+
+
+    def test_retry_on_error(self):
+        '''Transport errors are sent again.'''
+        httpx = self.stub_httpx()
+        httpx.answers += [ httpx.ConnectError( 'refused' ) , httpx.ReadTimeout( 'slow' ) , httpx.Answer( 200 , b'{}' ) ]
+
+        response = self.send( httpx )
+        self.assertEqual( 200 , response.status_code )
+        self.assertEqual( 3 , len( httpx.sent ) )
+
+
+    def test_out_of_retries(self):
+        '''Errors and statuses are raised as requests exceptions once the retries run out.'''
+        httpx = self.stub_httpx()
+        httpx.answers += [ httpx.ConnectError( 'refused' ) , httpx.ConnectError( 'refused' ) ]
+        with self.assertRaises( requests.exceptions.ConnectionError ):
+            self.send( httpx , retries=1 )
+
+        httpx = self.stub_httpx()
+        httpx.answers += [ httpx.ReadTimeout( 'slow' ) ]
+        with self.assertRaises( requests.exceptions.ReadTimeout ):
+            self.send( httpx , retries=0 )
+
+        httpx = self.stub_httpx()
+        httpx.answers += [ httpx.Answer( 503 ) , httpx.Answer( 503 ) ]
+        with self.assertRaises( requests.exceptions.RetryError ):
+            self.send( httpx , retries=1 )
+        self.assertEqual( 2 , len( httpx.sent ) )
+
+
+    def test_stream(self):
+        '''Streamed answers are read as requests does.'''
+        httpx = self.stub_httpx()
+        answer = httpx.Answer( 200 , b'0123456789' )
+        httpx.answers.append( answer )
+
+        response = self.send( httpx , stream=True )
+        self.assertTrue( httpx.sent[0][1] )
+        self.assertEqual( [ b'0123' , b'4567' , b'89' ] , list( response.iter_content( 4 ) ) )
+        response.close()
+        self.assertTrue( answer.closed )
+
+
+
 class TestSonarClientAgainstMockServer(unittest.TestCase):
     """Unit testing.
 
@@ -318,7 +1956,7 @@ class TestSonarClientAgainstMockServer(unittest.TestCase):
         return Utilities.http_code_nr( name )
 
 
-    def mock_pages(self, identifier , endpoint , max_page ):
+    def mock_pages(self, identifier , endpoint , max_page , first_size=None ):
         '''Mocks paged responses.
 
         The page urls to mock are mapped with the endpoint. The stored responses are retrieved by identifier.
@@ -327,8 +1965,9 @@ class TestSonarClientAgainstMockServer(unittest.TestCase):
         :param: identifier: a text identier of the endpoint for retrieving the stored mock responses.
         :param: endpoint: endpoint to mock.
         :param: max_pages: number of first consecutive pages to mock for the (same) endpoint.
+        :param: first_size: page size requested for the first page, if any.
         '''
-        Utilities.mock_pages( identifier , endpoint , max_page )
+        Utilities.mock_pages( identifier , endpoint , max_page , first_size )
 
 
     def setUp(self):
@@ -462,7 +2101,7 @@ class TestSonarClientAgainstMockServer(unittest.TestCase):
 
         # test setup:
         TST_URL = self.API_URL + TST_QUERY
-        self.mock_pages( TST_PREFIX , TST_URL , TST_AVAILABLE )
+        self.mock_pages( TST_PREFIX , TST_URL , TST_AVAILABLE , HISTORY_PER_PAGE )
 
         # Smoke test
         history = self.TST_DTC.history()
@@ -481,7 +2120,7 @@ class TestSonarClientAgainstMockServer(unittest.TestCase):
         # test setup:
         print('DEBUG Testing paged')
         TST_URL = self.API_URL + TST_QUERY
-        self.mock_pages( TST_PREFIX , TST_URL , TST_AVAILABLE )
+        self.mock_pages( TST_PREFIX , TST_URL , TST_AVAILABLE , HISTORY_PER_PAGE )
 
         # Smoke test
         self.TST_DTC = SonarClient( 'c02', base_url=self.API_URL )
@@ -545,8 +2184,11 @@ class Utilities(unittest.TestCase):
         self.assertEqual(  200  , nr( 'OK' ) )
 
 
-    def mock_pages( name , query , max_page ):
-        '''Mocks a series of pages.'''
+    def mock_pages( name , query , max_page , first_size=None ):
+        '''Mocks a series of pages.
+
+        The first page is requested with first_size items, if any; the rest with the size the fixtures answer.
+        '''
 
         for p in range( max_page ):
             page = p + 1
@@ -554,6 +2196,8 @@ class Utilities(unittest.TestCase):
             url = query
             if 0 < p:
                 url += '&ps=20&p={}'.format( page )
+            elif first_size:
+                url += '&ps={}'.format( first_size )
 
             TST_DIR = 'data/'
             body_file = '{}{}.P{}.body.RS'.format( TST_DIR , name , page )
@@ -571,17 +2215,20 @@ class Utilities(unittest.TestCase):
     def mock_full_projects( api_url ):
         '''Mocks the full sequence for a list of projects.
         '''
-        def mock_url( list_name , query , project , max_page ):
+        def mock_url( list_name , query , project , max_page , first_size ):
             name  = 'c{}_{}'.format(project , list_name )
             url   = api_url + query.format( project )
-            Utilities.mock_pages( name , url , max_page )
+            Utilities.mock_pages( name , url , max_page , first_size )
 
         # config:
-        #                      item ,  url cccc                                                                         , (P ,exp) , (P ,exp)
+        #                      item ,  url cccc                                                                         , (P ,exp) , (P ,exp) , first page size
         STEPS = (
-            ('measures_component_2' , 'api/measures/component?component=c{}&metricKeys=accessors,new_technical_debt'    , (1 , 2) , (1 , 2) ),
-            ('metric_keys'          , 'api/metrics/search'                                                              , (1 , 2) , (1 , 2) ),
-            ('history_component_6'  , 'api/measures/search_history?component=c{}&metrics=accessors,new_technical_debt'  , (1 , 2) , (3 , 2) ),
+            ('measures_component_2' , 'api/measures/component?component=c{}&metricKeys=accessors,new_technical_debt'    , (1 , 2) , (1 , 2) , None ),
+            ('metric_keys'          , 'api/metrics/search'                                                              , (1 , 2) , (1 , 2) , None ),
+            ('history_component_6'  , 'api/measures/search_history?component=c{}&metrics=accessors,new_technical_debt'  , (1 , 2) , (3 , 2) , HISTORY_PER_PAGE ),
+            ('component_tree'       , 'api/measures/component_tree?component=c{}&metricKeys=accessors,new_technical_debt' , (1 , 10) , (2 , 45) , PER_PAGE ),
+            ('hotspots'             , 'api/hotspots/search?projectKey=c{}'                                              , (1 , 3) , (2 , 23) , PER_PAGE ),
+            ('duplicated_files'     , 'api/measures/component_tree?component=c{}&metricKeys=duplicated_blocks&qualifiers=FIL' , (1 , 3) , (1 , 2) , PER_PAGE ),
         )
         PROJECTS = ('01' , '02')
 
@@ -599,15 +2246,101 @@ class Utilities(unittest.TestCase):
                 page = s[1+pn][0]
                 size = s[1+pn][1]
 
-                mock_url( item , url , project , page )
+                mock_url( item , url , project , page , s[4] )
                 sizes_project.update( { item:size } )
 
             all_sizes.update( { project: sizes_project } )
 
+        # issues are served by a fake search:
+        issues = {}
+        for project in PROJECTS:
+            issues[ 'c' + project ] = Utilities.fake_issues( 'c' + project , 30 )
+            all_sizes[ project ].update( { 'issues': 30 } )
+        Utilities.mock_issues( api_url , issues )
+
+        # and so are duplications, shown from each of the files they span:
+        Utilities.mock_duplications( api_url , ( ( ('c01:src/app0.py', 1, 10) , ('c01:src/app2.py', 5, 10) )
+                                               , ( ('c01:src/app0.py', 20, 11) , ('c01:src/app0.py', 40, 11) )
+                                               , ( ('c02:src/app0.py', 3, 30) , ('c02:src/app1.py', 3, 30) )
+                                               ) )
 
         return PROJECTS , all_sizes 
 
 
+    def fake_issues( component , count ):
+        '''Makes a list of issues created one per day and updated some days later.'''
+        created = datetime.datetime( 2021, 1, 1, 10, 0, 0, tzinfo=datetime.timezone.utc )
+        issues = []
+        for n in range( count ):
+            creation = created + datetime.timedelta( days=n )
+            update   = creation + datetime.timedelta( days=(n * 7) % 40 )
+            issues.append( { 'key'          : '{}-issue-{:05d}'.format( component , n )
+                           , 'rule'         : 'python:S1192'
+                           , 'severity'     : 'MINOR'
+                           , 'component'    : component
+                           , 'project'      : component
+                           , 'status'       : 'OPEN'
+                           , 'type'         : 'CODE_SMELL'
+                           , 'creationDate' : creation.strftime( '%Y-%m-%dT%H:%M:%S%z' )
+                           , 'updateDate'   : update.strftime( '%Y-%m-%dT%H:%M:%S%z' )
+                           } )
+        return issues
+
+
+    def mock_duplications( api_url , groups ):
+        '''Mocks api/duplications/show over groups of (file, from, size) blocks.'''
+
+        def show( request , uri , headers ):
+            key = request.querystring['key'][0]
+            refs = { key: '1' }
+            duplications = []
+            for group in groups:
+                if key in [ block[0] for block in group ]:
+                    for block in group:
+                        refs.setdefault( block[0] , str( len(refs) + 1 ) )
+                    duplications.append( { 'blocks': [ { 'from': b[1] , 'size': b[2] , '_ref': refs[ b[0] ] } for b in group ] } )
+
+            body = { 'duplications' : duplications
+                   , 'files'        : { ref: { 'key': file , 'name': file.split('/')[-1] } for file , ref in refs.items() }
+                   }
+            return [ 200 , headers , json.dumps( body ) ]
+
+        mock.register_uri( mock.GET , re.compile( re.escape( api_url ) + 'api/duplications/show.*' ) , body=show )
+
+
+    def mock_issues( api_url , issues , cap=10000 , page_size=500 ):
+        '''Mocks api/issues/search over lists of issues by component.
+
+        It filters by creation dates, sorts, pages and refuses pages beyond the cap like Sonarqube does.
+        Pages hold at most page_size issues, whatever the size requested.
+        '''
+        def parse( text ):
+            # httpretty decodes the '+' of the time zones twice:
+            return datetime.datetime.strptime( text.replace( ' ' , '+' ) , '%Y-%m-%dT%H:%M:%S%z' )
+
+        def search( request , uri , headers ):
+            qs = request.querystring
+            found = issues[ qs['componentKeys'][0] ]
+            if 'createdAfter' in qs:
+                found = [ i for i in found if parse( qs['createdAfter'][0] ) <= parse( i['creationDate'] ) ]
+            if 'createdBefore' in qs:
+                found = [ i for i in found if parse( i['creationDate'] ) < parse( qs['createdBefore'][0] ) ]
+            if qs.get( 's' ) == ['UPDATE_DATE']:
+                found = sorted( found , key=lambda i: parse( i['updateDate'] ) , reverse=qs.get( 'asc' ) == ['false'] )
+
+            page = int( qs.get( 'p' , ['1'] )[0] )
+            size = min( int( qs.get( 'ps' , [100] )[0] ) , page_size )
+            if cap < page * size:
+                return [ 400 , headers , '{"errors":[{"msg":"Can return only the first 10000 results."}]}' ]
+
+            body = { 'paging' : { 'pageIndex': page , 'pageSize': size , 'total': len(found) }
+                   , 'issues' : found[ (page - 1) * size : page * size ]
+                   }
+            return [ 200 , headers , json.dumps( body ) ]
+
+        mock.register_uri( mock.GET , re.compile( re.escape( api_url ) + 'api/issues/search.*' ) , body=search )
+
+
 def read_file(filename, mode='r'):
     '''Taken from test_gitlab.
 